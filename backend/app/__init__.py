@@ -1,11 +1,21 @@
 from flask import Flask
 from flask_cors import CORS
+import atexit
 import logging
 from .config import Config
-from .services.llm_service import LLMService
+from .services.inference_pool import InferencePool, create_llm_service
+from .services.model_registry import ModelRegistry
+from .services.scheduler import RequestScheduler
+from .services.completion_cache import CompletionCache
+from .services.history_cache import ConversationHistoryCache
+from .services.metrics import InferenceMetrics
+from .services.message_writer import MessageWriter
+from .services.stream_buffer import StreamRegistry
+from .services.training_service import DatasetJobs, SequencePacker, TrainingExporter
 from .routes.chat import chat_bp, init_chat_routes
-from .routes.conversations import conversations_bp
-from .database import db, init_db
+from .routes.conversations import conversations_bp, init_conversation_routes
+from .routes.training import training_bp, init_training_routes
+from .database import db, init_db, CompletionCacheEntry, Conversation, ExportWatermark, Message
 
 # Configure logging
 logging.basicConfig(
@@ -25,6 +35,74 @@ def create_app(config_class=Config):
     #Initialize database
     init_db(app)
     logger.info("Database initialized")
+
+    # All chat requests go through one scheduler, with one slot per worker
+    scheduler = RequestScheduler(
+        max_queue_depth=config_class.MAX_QUEUE_DEPTH,
+        concurrency=config_class.INFERENCE_WORKERS,
+        queue_timeout=config_class.QUEUE_TIMEOUT,
+    )
+
+    # Recently active conversations, so clients can send only the new turn
+    history_cache = ConversationHistoryCache(config_class.HISTORY_CACHE_SIZE)
+
+    # Saves chat turns in the background so responses don't wait on SQLite
+    message_writer = None
+    if config_class.MESSAGE_WRITE_BEHIND:
+        with app.app_context():
+            message_writer = MessageWriter(
+                engine=db.engine,
+                messages_table=Message.__table__,
+                conversations_table=Conversation.__table__,
+                max_queue=config_class.MESSAGE_WRITE_QUEUE,
+                batch_size=config_class.MESSAGE_WRITE_BATCH,
+                # A turn that was not saved must not linger in the history cache
+                on_failure=history_cache.invalidate,
+            )
+        atexit.register(message_writer.shutdown)
+
+    init_conversation_routes(history_cache, message_writer)
+
+    # Conversations as JSONL datasets for fine-tuning
+    with app.app_context():
+        training_exporter = TrainingExporter(
+            engine=db.engine,
+            messages_table=Message.__table__,
+            conversations_table=Conversation.__table__,
+            watermarks_table=ExportWatermark.__table__,
+            output_dir=config_class.EXPORT_DIR,
+            chunk_records=config_class.EXPORT_CHUNK_RECORDS,
+            batch_size=config_class.EXPORT_BATCH_SIZE,
+            compression=config_class.EXPORT_COMPRESSION,
+        )
+    sequence_packer = SequencePacker(
+        output_dir=config_class.DATASET_DIR,
+        n_ctx=config_class.N_CTX,
+        workers=config_class.PACK_WORKERS,
+        shard_sequences=config_class.PACK_SHARD_SEQUENCES,
+    )
+    dataset_jobs = DatasetJobs(sequence_packer)
+
+    # Per-request timings, aggregated for /api/metrics
+    inference_metrics = InferenceMetrics()
+
+    # Streamed answers stay available for a while to clients that reconnect
+    stream_registry = StreamRegistry(
+        ttl=config_class.STREAM_RESUME_TTL,
+        grace=config_class.STREAM_RESUME_GRACE,
+        max_frames=config_class.STREAM_BUFFER_FRAMES,
+    )
+
+    completion_cache = None
+    if config_class.COMPLETION_CACHE_ENABLED:
+        with app.app_context():
+            completion_cache = CompletionCache(
+                engine=db.engine,
+                table=CompletionCacheEntry.__table__,
+                max_entries=config_class.COMPLETION_CACHE_SIZE,
+                max_disk_entries=config_class.COMPLETION_CACHE_DISK_SIZE,
+                ttl=config_class.COMPLETION_CACHE_TTL,
+            )
     
     # Only initialize LLM in the main process (not the reloader parent)
     import os
@@ -34,32 +112,74 @@ def create_app(config_class=Config):
         logger.info(f"Config - N_GPU_LAYERS: {config_class.N_GPU_LAYERS}")
         logger.info(f"Config - N_CTX: {config_class.N_CTX}")
         logger.info(f"Config - N_THREADS: {config_class.N_THREADS}")
+        logger.info(f"Config - KV_CACHE_MAX_MB: {config_class.KV_CACHE_MAX_MB}")
+        logger.info(f"Config - LLM_BACKEND: {config_class.LLM_BACKEND}")
+        logger.info(f"Config - INFERENCE_WORKERS: {config_class.INFERENCE_WORKERS}")
         logger.info(f"Config - Model path: {config_class.get_model_path()}")
-        
-        try:
-            model_path = config_class.get_model_path()
-            llm_service = LLMService(
-                model_path=model_path,
-                n_ctx=config_class.N_CTX,
-                n_gpu_layers=config_class.N_GPU_LAYERS,
-                n_threads=config_class.N_THREADS
-            )
-            logger.info("LLM service initialized successfully")
-            
-            # Initialize routes with the service
-            init_chat_routes(llm_service)
-            
-        except Exception as e:
-            logger.error(f"Failed to initialize LLM service: {e}")
-            logger.warning("Server will start but chat endpoints will not work")
-            init_chat_routes(None)
+        logger.info(f"Config - MODEL_MEMORY_BUDGET_MB: {config_class.MODEL_MEMORY_BUDGET_MB}")
+        logger.info(f"Config - SPECULATIVE_DECODING: {config_class.SPECULATIVE_DECODING or 'off'}")
+
+        workers = config_class.INFERENCE_WORKERS
+        service_kwargs = {
+            "n_ctx": config_class.N_CTX,
+            "n_gpu_layers": config_class.N_GPU_LAYERS,
+            # CPU threads are split between the workers
+            "n_threads": max(1, config_class.N_THREADS // workers),
+            "kv_cache_max_bytes": config_class.KV_CACHE_MAX_MB * 1024 * 1024 // workers,
+            "context_reserve_tokens": config_class.CONTEXT_RESERVE_TOKENS,
+            "token_cache_max_tokens": config_class.TOKEN_CACHE_MAX_TOKENS,
+        }
+        if config_class.SPECULATIVE_DECODING:
+            service_kwargs["speculative"] = config_class.SPECULATIVE_DECODING
+            service_kwargs["draft_tokens"] = config_class.DRAFT_TOKENS
+            service_kwargs["lookup_ngram_size"] = config_class.PROMPT_LOOKUP_NGRAM
+            if config_class.DRAFT_MODEL:
+                service_kwargs["draft_model_path"] = str(config_class.MODEL_DIR / config_class.DRAFT_MODEL)
+        if config_class.PROMPT_SNAPSHOTS_ENABLED:
+            service_kwargs["snapshot_dir"] = str(config_class.PROMPT_SNAPSHOT_DIR)
+            service_kwargs["snapshot_prompts"] = config_class.get_snapshot_prompts()
+        if config_class.LLM_BACKEND == "fake":
+            service_kwargs["prompt_ms_per_token"] = config_class.FAKE_PROMPT_MS_PER_TOKEN
+            service_kwargs["token_ms"] = config_class.FAKE_TOKEN_MS
+
+        def build_service(model_path):
+            """One service per model, a worker pool when there are several workers"""
+            kwargs = dict(service_kwargs, model_path=model_path)
+            if workers > 1:
+                return InferencePool(workers, config_class.LLM_BACKEND, kwargs)
+            return create_llm_service(config_class.LLM_BACKEND, **kwargs)
+
+        # Models in MODEL_DIR, loaded on demand and evicted least recently used
+        model_registry = ModelRegistry(
+            model_dir=config_class.MODEL_DIR,
+            default_model=config_class.DEFAULT_MODEL,
+            service_factory=build_service,
+            memory_budget_bytes=config_class.MODEL_MEMORY_BUDGET_MB * 1024 * 1024,
+            n_ctx=config_class.N_CTX,
+            kv_cache_max_bytes=config_class.KV_CACHE_MAX_MB * 1024 * 1024 // workers,
+            copies=workers,
+            warmup_prompt=config_class.WARMUP_PROMPT,
+        )
+        atexit.register(model_registry.shutdown)
+
+        # The server starts answering right away; chat requests wait for the
+        # default model (or get a 503) and /api/health/ready reports progress
+        model_registry.preload()
+
+        # Initialize routes with the registry
+        init_chat_routes(model_registry, scheduler, completion_cache, history_cache, inference_metrics, message_writer, stream_registry)
     else:
         logger.info("Skipping model load in reloader parent process")
-        init_chat_routes(None)
+        init_chat_routes(None, scheduler, completion_cache, history_cache, inference_metrics, message_writer, stream_registry)
+        model_registry = None
+
+    # Datasets are tokenized with the tokenizer of a model in the registry
+    init_training_routes(training_exporter, message_writer, dataset_jobs, model_registry)
     
     # Register blueprints
     app.register_blueprint(chat_bp, url_prefix='/api')
     app.register_blueprint(conversations_bp, url_prefix='/api')
+    app.register_blueprint(training_bp, url_prefix='/api')
     
     @app.route('/')
     def index():
@@ -68,9 +188,19 @@ def create_app(config_class=Config):
             'version': '0.1.0',
             'endpoints': {
                 'chat': '/api/chat',
+                'chat_batch': '/api/chat/batch',
+                'chat_prefill': '/api/chat/prefill',
                 'health': '/api/health',
+                'liveness': '/api/health/live',
+                'readiness': '/api/health/ready',
+                'metrics': '/api/metrics',
                 'models': '/api/chat/models',
                 'conversations': '/api/conversations',
+                'search': '/api/conversations/search',
+                'training_exports': '/api/training/exports',
+                'training_export': '/api/training/export',
+                'training_datasets': '/api/training/datasets',
+                'training_dataset_jobs': '/api/training/datasets/jobs',
             }
         }
     
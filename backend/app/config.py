@@ -1,3 +1,4 @@
+import json
 import os
 from pathlib import Path
 
@@ -18,21 +19,85 @@ class Config:
         "DATABASE_URL",
         f"sqlite:///{DATABASE_DIR / 'webui.db'}"
     )
-    SQLACHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # SQLite storage profile, applied to every connection
+    SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")  # WAL lets reads proceed during a write
+    SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")  # NORMAL is safe with WAL, FULL fsyncs every commit
+    SQLITE_CACHE_SIZE_MB = int(os.getenv("SQLITE_CACHE_SIZE_MB", "64"))  # Page cache per connection
+    SQLITE_MMAP_SIZE_MB = int(os.getenv("SQLITE_MMAP_SIZE_MB", "256"))  # Memory-mapped reads, 0 = disabled
+    SQLITE_BUSY_TIMEOUT = float(os.getenv("SQLITE_BUSY_TIMEOUT", "30"))  # Seconds to wait for a lock
+
+    # Connection pool shared by the request threads, for a SQLite file
+    # database (init_db leaves other databases on SQLAlchemy's defaults)
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+    DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
 
 
     # Model settings
     BASE_DIR = Path(__file__).parent.parent
-    MODEL_DIR = BASE_DIR / "models"
-    DEFAULT_MODEL = os.getenv("DEFAULT_MODEL", "model.gguf")
+    MODEL_DIR = Path(os.getenv("MODEL_DIR", BASE_DIR / "models"))  # Scanned for .gguf files
+    DEFAULT_MODEL = os.getenv("DEFAULT_MODEL", "model.gguf")  # Used when a request names no model
+    MODEL_MEMORY_BUDGET_MB = int(os.getenv("MODEL_MEMORY_BUDGET_MB", "0"))  # RAM for loaded models together, 0 = one model at a time
+    MODEL_LOAD_WAIT = float(os.getenv("MODEL_LOAD_WAIT", "120"))  # Seconds a request waits for a model to load before 503
+    WARMUP_PROMPT = os.getenv("WARMUP_PROMPT", "You are a helpful assistant.")  # System prompt evaluated after each load, empty = no warmup
 
     # LLM settings
+    LLM_BACKEND = os.getenv("LLM_BACKEND", "llama")  # "llama" or "fake" (deterministic, no model)
+    INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "1"))  # Worker processes, each with its own model
     N_CTX = int(os.getenv("N_CTX", "8192"))  # Context window size
     N_GPU_LAYERS = int(os.getenv("N_GPU_LAYERS", "-1"))  # Changed default to -1 for GPU
     N_THREADS = int(os.getenv("N_THREADS", "4"))  # CPU threads to use
+    KV_CACHE_MAX_MB = int(os.getenv("KV_CACHE_MAX_MB", "2048"))  # Saved per-conversation KV states, 0 = disabled
+    TOKEN_CACHE_MAX_TOKENS = int(os.getenv("TOKEN_CACHE_MAX_TOKENS", "2000000"))  # Cached token ids of chat messages
+    SPECULATIVE_DECODING = os.getenv("SPECULATIVE_DECODING", "")  # "", "prompt_lookup" or "draft"; keeps logits for the whole context
+    DRAFT_MODEL = os.getenv("DRAFT_MODEL", "")  # Small .gguf in MODEL_DIR with the same vocabulary, for "draft"
+    DRAFT_TOKENS = int(os.getenv("DRAFT_TOKENS", "10"))  # Tokens drafted per step
+    PROMPT_LOOKUP_NGRAM = int(os.getenv("PROMPT_LOOKUP_NGRAM", "2"))  # Longest n-gram prompt lookup matches
+    PROMPT_SNAPSHOTS_ENABLED = os.getenv("PROMPT_SNAPSHOTS_ENABLED", "True") == "True"  # Save evaluated system prompts to disk
+    PROMPT_SNAPSHOT_DIR = Path(os.getenv("PROMPT_SNAPSHOT_DIR", DATABASE_DIR / "kv_snapshots"))
+    SYSTEM_PROMPTS_FILE = os.getenv("SYSTEM_PROMPTS_FILE", "")  # JSON list of system prompts to snapshot, besides WARMUP_PROMPT
+    FAKE_PROMPT_MS_PER_TOKEN = float(os.getenv("FAKE_PROMPT_MS_PER_TOKEN", "0"))  # Simulated prompt eval time (fake backend)
+    FAKE_TOKEN_MS = float(os.getenv("FAKE_TOKEN_MS", "0"))  # Simulated time per generated token (fake backend)
+
+    # Request scheduling
+    MAX_QUEUE_DEPTH = int(os.getenv("MAX_QUEUE_DEPTH", "16"))  # Waiting requests before 429
+    QUEUE_TIMEOUT = float(os.getenv("QUEUE_TIMEOUT", "120"))  # Seconds to wait before 503
+    MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "256"))  # Items per /api/chat/batch request
+
+    # Streamed tokens are coalesced into SSE frames
+    STREAM_FRAME_MS = float(os.getenv("STREAM_FRAME_MS", "30"))  # Time tokens are collected per frame, 0 = one frame per token
+    STREAM_FRAME_CHARS = int(os.getenv("STREAM_FRAME_CHARS", "1024"))  # Buffered characters that force a frame
+    STREAM_BUFFER_FRAMES = int(os.getenv("STREAM_BUFFER_FRAMES", "4096"))  # Frames kept per stream for clients that reconnect
+    STREAM_RESUME_TTL = float(os.getenv("STREAM_RESUME_TTL", "60"))  # Seconds a finished stream can still be resumed
+    STREAM_RESUME_GRACE = float(os.getenv("STREAM_RESUME_GRACE", "30"))  # Seconds a generation runs with no client before it is cancelled
+
+    # Chat turns are saved by a background writer in grouped transactions
+    MESSAGE_WRITE_BEHIND = os.getenv("MESSAGE_WRITE_BEHIND", "True") == "True"
+    MESSAGE_WRITE_QUEUE = int(os.getenv("MESSAGE_WRITE_QUEUE", "1024"))  # Turns waiting before saving inline
+    MESSAGE_WRITE_BATCH = int(os.getenv("MESSAGE_WRITE_BATCH", "64"))  # Turns per transaction at most
+
+    # Conversations whose history is kept in memory for server-side prompts
+    HISTORY_CACHE_SIZE = int(os.getenv("HISTORY_CACHE_SIZE", "256"))
+
+    # Completion cache (temperature 0 requests only)
+    COMPLETION_CACHE_ENABLED = os.getenv("COMPLETION_CACHE_ENABLED", "True") == "True"
+    COMPLETION_CACHE_SIZE = int(os.getenv("COMPLETION_CACHE_SIZE", "1024"))  # Entries kept in memory
+    COMPLETION_CACHE_DISK_SIZE = int(os.getenv("COMPLETION_CACHE_DISK_SIZE", "10000"))  # Entries kept in SQLite
+    COMPLETION_CACHE_TTL = float(os.getenv("COMPLETION_CACHE_TTL", "86400"))  # Seconds, 0 = never expire
+
+    # Conversations exported as JSONL datasets for fine-tuning
+    EXPORT_DIR = Path(os.getenv("EXPORT_DIR", DATABASE_DIR / "exports"))
+    EXPORT_COMPRESSION = os.getenv("EXPORT_COMPRESSION", "gzip")  # "none", "gzip" or "zstd" (needs zstandard)
+    EXPORT_CHUNK_RECORDS = int(os.getenv("EXPORT_CHUNK_RECORDS", "10000"))  # Conversations per export file
+    EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "500"))  # Messages read from the database at a time
+    DATASET_DIR = Path(os.getenv("DATASET_DIR", DATABASE_DIR / "datasets"))  # Tokenized, packed datasets
+    PACK_WORKERS = int(os.getenv("PACK_WORKERS", "4"))  # Tokenizer processes, 0 = tokenize in the server process
+    PACK_SHARD_SEQUENCES = int(os.getenv("PACK_SHARD_SEQUENCES", "1024"))  # Packed sequences per shard
 
     # Generation settings
     MAX_TOKENS = int(os.getenv("MAX_TOKENS", "8192"))
+    CONTEXT_RESERVE_TOKENS = int(os.getenv("CONTEXT_RESERVE_TOKENS", "0"))  # Kept free for generation when trimming history, 0 = N_CTX / 4
     TEMPERATURE = float(os.getenv("TEMPERATURE", "0.7"))
     TOP_P = float(os.getenv("TOP_P", "0.9"))
     TOP_K = int(os.getenv("TOP_K", "40"))
@@ -41,3 +106,12 @@ class Config:
     def get_model_path(cls):
         """Get the full path to the model file"""
         return cls.MODEL_DIR / cls.DEFAULT_MODEL
+
+    @classmethod
+    def get_snapshot_prompts(cls):
+        """System prompts whose evaluated KV state is kept on disk"""
+        prompts = [cls.WARMUP_PROMPT] if cls.WARMUP_PROMPT else []
+        if cls.SYSTEM_PROMPTS_FILE:
+            with open(cls.SYSTEM_PROMPTS_FILE, encoding="utf-8") as f:
+                prompts.extend(json.load(f))
+        return prompts
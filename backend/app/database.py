@@ -1,61 +1,270 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
 from datetime import datetime, timezone
 import json
+import logging
+
+logger = logging.getLogger(__name__)
 
 db = SQLAlchemy()
 
+
+def _utcnow():
+    """Evaluated per row, unlike datetime.now() passed directly as a default"""
+    return datetime.now(timezone.utc)
+
+
 class Conversation(db.Model):
     """Model for storing chat conversations"""
     __tablename__ = 'conversations'
+    __table_args__ = (
+        # Keyset pagination of the sidebar, most recently updated first
+        db.Index('ix_conversations_updated_at_id', 'updated_at', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.now(timezone.utc), nullable=False)
-    updated_at = db.Column(db.DateTime, default=datetime.now(timezone.utc),  onupdate=datetime.now(timezone.utc), nullable=False)
+    created_at = db.Column(db.DateTime, default=_utcnow, nullable=False)
+    updated_at = db.Column(db.DateTime, default=_utcnow, onupdate=_utcnow, nullable=False)
 
     #Relationship to messages
     message = db.relationship('Message', backref='conversation', lazy=True, cascade='all, delete-orphan')
 
-    def to_dict(self):
-        """Convert conversation to dictionary"""
+    def to_dict(self, message_count=None):
+        """
+        Convert conversation to dictionary
+
+        Args:
+            message_count: Number of messages if already known, otherwise
+                counted with a query (the messages themselves are not loaded)
+        """
+        if message_count is None:
+            message_count = db.session.query(db.func.count(Message.id)).filter(
+                Message.conversation_id == self.id
+            ).scalar()
         return {
             'id': self.id,
             'title': self.title,
             'created_at': self.created_at.isoformat(),
             'updated_at': self.updated_at.isoformat(),
-            'message_count': len(self.messages)
+            'message_count': message_count
         }
     
 class Message(db.Model):
     """Model for storing individual messages in a conversation"""
     __tablename__ = 'messages'
+    __table_args__ = (
+        # Per-conversation message counts and history in order
+        db.Index('ix_messages_conversation_created', 'conversation_id', 'created_at', 'id'),
+        # Ids of deleted messages are never handed out again, so "newer than
+        # id N" (the training export watermarks) cannot miss a message
+        {'sqlite_autoincrement': True},
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     conversation_id = db.Column(db.Integer, db.ForeignKey('conversations.id'), nullable=False)
     role = db.Column(db.String(20), nullable=False)
     content = db.Column(db.Text, nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.now(timezone.utc), nullable=False)
+    created_at = db.Column(db.DateTime, default=_utcnow, nullable=False)
     message_metadata = db.Column(db.Text, nullable=True)
 
     def to_dict(self):
         """Convert message to dictionary"""
-        result = {
-            'id': self.id,
-            'conversation_id': self.conversation_id,
-            'role': self.role,
-            'content': self.content,
-            'created_at': self.created_at.isoformat()
-        }
-        if self.message_metadata:
-            try:
-                result['message_metadata'] = json.loads(self.message_metadata)
-            except:
-                result['message_metadata'] = None
-        return result
-    
+        return message_to_dict(self)
+
+
+def message_to_dict(message):
+    """
+    Convert a message to a dictionary
+
+    Accepts a Message or a result row with the same column names, so large
+    listings can skip building ORM objects.
+    """
+    result = {
+        'id': message.id,
+        'conversation_id': message.conversation_id,
+        'role': message.role,
+        'content': message.content,
+        'created_at': message.created_at.isoformat()
+    }
+    if message.message_metadata:
+        try:
+            result['message_metadata'] = json.loads(message.message_metadata)
+        except:
+            result['message_metadata'] = None
+    return result
+
+
+class CompletionCacheEntry(db.Model):
+    """Cached response for a deterministic completion request"""
+    __tablename__ = 'completion_cache'
+
+    key = db.Column(db.String(64), primary_key=True)
+    response = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.Float, nullable=False, index=True)
+
+class ExportWatermark(db.Model):
+    """Newest message written by an incremental training export, per export name"""
+    __tablename__ = 'export_watermarks'
+
+    name = db.Column(db.String(100), primary_key=True)
+    last_message_id = db.Column(db.Integer, nullable=False, default=0)
+    records = db.Column(db.Integer, nullable=False, default=0)  # Written under this name so far
+    exported_at = db.Column(db.DateTime, default=_utcnow, nullable=False)
+
+
+# Keep messages_fts in step with every write to messages, including the
+# background message writer's
+_MESSAGES_FTS_TRIGGERS = [
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN "
+    "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN "
+    "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN "
+    "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+    "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); END",
+]
+
+# Schema changes for databases created by earlier versions, applied in
+# order. The number of applied steps is kept in PRAGMA user_version.
+MIGRATIONS = [
+    # 1: indexes for the conversation listing and per-conversation message
+    # reads; pad timestamps written by CURRENT_TIMESTAMP to the ORM's format
+    # so they compare correctly against pagination cursors
+    [
+        "CREATE INDEX IF NOT EXISTS ix_conversations_updated_at_id ON conversations (updated_at, id)",
+        "CREATE INDEX IF NOT EXISTS ix_messages_conversation_created ON messages (conversation_id, created_at, id)",
+        "UPDATE conversations SET updated_at = updated_at || '.000000' WHERE length(updated_at) = 19",
+    ],
+    # 2: full-text search over message contents and conversation titles.
+    # External-content FTS5 tables store only the index; triggers keep them
+    # in step with every write, including the background message writer's.
+    [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+        "content, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS conversations_fts USING fts5("
+        "title, content='conversations', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+        *_MESSAGES_FTS_TRIGGERS,
+        "CREATE TRIGGER IF NOT EXISTS conversations_fts_insert AFTER INSERT ON conversations BEGIN "
+        "INSERT INTO conversations_fts(rowid, title) VALUES (new.id, new.title); END",
+        "CREATE TRIGGER IF NOT EXISTS conversations_fts_delete AFTER DELETE ON conversations BEGIN "
+        "INSERT INTO conversations_fts(conversations_fts, rowid, title) VALUES ('delete', old.id, old.title); END",
+        "CREATE TRIGGER IF NOT EXISTS conversations_fts_update AFTER UPDATE OF title ON conversations BEGIN "
+        "INSERT INTO conversations_fts(conversations_fts, rowid, title) VALUES ('delete', old.id, old.title); "
+        "INSERT INTO conversations_fts(rowid, title) VALUES (new.id, new.title); END",
+        # Index what is already there
+        "INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')",
+        "INSERT INTO conversations_fts(conversations_fts) VALUES ('rebuild')",
+    ],
+    # 3: AUTOINCREMENT message ids, so a deleted newest message's id is not
+    # reused below an export watermark. SQLite can only add it by rebuilding
+    # the table; ids are kept, so messages_fts stays valid. Dropping the old
+    # table drops its index and triggers, which are created again.
+    [
+        "CREATE TABLE messages_autoincrement ("
+        "id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, "
+        "conversation_id INTEGER NOT NULL, "
+        "role VARCHAR(20) NOT NULL, "
+        "content TEXT NOT NULL, "
+        "created_at DATETIME NOT NULL, "
+        "message_metadata TEXT, "
+        "FOREIGN KEY(conversation_id) REFERENCES conversations (id))",
+        "INSERT INTO messages_autoincrement (id, conversation_id, role, content, created_at, message_metadata) "
+        "SELECT id, conversation_id, role, content, created_at, message_metadata FROM messages",
+        "DROP TABLE messages",
+        "ALTER TABLE messages_autoincrement RENAME TO messages",
+        "CREATE INDEX IF NOT EXISTS ix_messages_conversation_created ON messages (conversation_id, created_at, id)",
+        *_MESSAGES_FTS_TRIGGERS,
+        # New ids also start above every exported id, in case the newest
+        # messages were deleted before this migration
+        "INSERT INTO sqlite_sequence (name, seq) SELECT 'messages', 0 "
+        "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'messages')",
+        "UPDATE sqlite_sequence SET seq = max(seq, "
+        "(SELECT coalesce(max(last_message_id), 0) FROM export_watermarks)) WHERE name = 'messages'",
+    ],
+]
+
+_JOURNAL_MODES = {"DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"}
+_SYNCHRONOUS_MODES = {"OFF", "NORMAL", "FULL", "EXTRA"}
+
+
+def _sqlite_pragmas(config):
+    """PRAGMA statements of the configured SQLite storage profile"""
+    journal_mode = config.get("SQLITE_JOURNAL_MODE", "WAL").upper()
+    synchronous = config.get("SQLITE_SYNCHRONOUS", "NORMAL").upper()
+    if journal_mode not in _JOURNAL_MODES:
+        raise ValueError(f"Unknown SQLITE_JOURNAL_MODE: {journal_mode}")
+    if synchronous not in _SYNCHRONOUS_MODES:
+        raise ValueError(f"Unknown SQLITE_SYNCHRONOUS: {synchronous}")
+
+    return [
+        f"PRAGMA journal_mode={journal_mode}",
+        f"PRAGMA synchronous={synchronous}",
+        # Negative cache_size is in KiB
+        f"PRAGMA cache_size=-{int(config.get('SQLITE_CACHE_SIZE_MB', 64)) * 1024}",
+        f"PRAGMA mmap_size={int(config.get('SQLITE_MMAP_SIZE_MB', 256)) * 1024 * 1024}",
+        "PRAGMA temp_store=MEMORY",
+    ]
+
+
+def _sqlite_engine_options(config):
+    """
+    Pool and driver options for a SQLite file database, {} for anything else
+
+    In-memory SQLite uses a single-connection pool that takes no pool size,
+    and other drivers don't know SQLite's connect arguments.
+    """
+    url = make_url(config["SQLALCHEMY_DATABASE_URI"])
+    if url.get_backend_name() != "sqlite":
+        return {}
+    if url.database in (None, "", ":memory:") or url.query.get("mode") == "memory":
+        return {}
+    busy_timeout = float(config.get("SQLITE_BUSY_TIMEOUT", 30))
+    return {
+        "pool_size": int(config.get("DB_POOL_SIZE", 10)),
+        "max_overflow": int(config.get("DB_MAX_OVERFLOW", 20)),
+        "pool_timeout": busy_timeout,
+        "connect_args": {"timeout": busy_timeout, "check_same_thread": False},
+    }
+
+
+def _migrate():
+    """Bring an existing database up to the current schema"""
+    with db.engine.begin() as conn:
+        version = conn.exec_driver_sql("PRAGMA user_version").scalar()
+        if version >= len(MIGRATIONS):
+            return
+        for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            for statement in statements:
+                conn.exec_driver_sql(statement)
+            logger.info(f"Applied database migration {number}")
+        conn.exec_driver_sql(f"PRAGMA user_version={len(MIGRATIONS)}")
+        # Refresh the planner's statistics for the new indexes
+        conn.exec_driver_sql("ANALYZE")
+
+
 def init_db(app):
     """Initialize the database"""
+    # Options set explicitly in the app config take precedence
+    options = _sqlite_engine_options(app.config)
+    options.update(app.config.get("SQLALCHEMY_ENGINE_OPTIONS") or {})
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
     db.init_app(app)
 
     with app.app_context():
-        db.create_all()
\ No newline at end of file
+        if db.engine.dialect.name == "sqlite":
+            pragmas = _sqlite_pragmas(app.config)
+
+            def apply_pragmas(dbapi_connection, connection_record):
+                cursor = dbapi_connection.cursor()
+                for pragma in pragmas:
+                    cursor.execute(pragma)
+                cursor.close()
+
+            event.listen(db.engine, "connect", apply_pragmas)
+
+        db.create_all()
+
+        if db.engine.dialect.name == "sqlite":
+            _migrate()
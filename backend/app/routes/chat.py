@@ -1,20 +1,175 @@
-from flask import Blueprint, request, jsonify, Response, stream_with_context
+from flask import Blueprint, request, jsonify, Response, stream_with_context, current_app
 from ..database import db, Conversation, Message
+from ..services.completion_cache import CompletionCache, model_fingerprint
+from ..services.llm_service import format_chat_prompt, ContextOverflowError
+from ..services.cancellation import CancellationRegistry
+from ..services.inference_pool import InferencePool
+from ..services.model_registry import ModelUnavailableError
+from ..services.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+from ..services.sse import SSEEncoder
+from ..services.stream_buffer import StreamGapError, StreamRegistry
+from ..services.scheduler import (
+    RequestScheduler,
+    SchedulerError,
+    PRIORITIES,
+    PRIORITY_BULK,
+    PRIORITY_PREFILL,
+)
+from datetime import datetime, timezone
 import logging
 import json
+import re
+import threading
+import time
+import uuid
 
 logger = logging.getLogger(__name__)
 
 chat_bp = Blueprint("chat", __name__)
 
-# LLM service will be injected when blueprint is registered
-llm_service = None
+# Model registry, scheduler and caches will be injected when blueprint is registered
+model_registry = None
+scheduler = None
+completion_cache = None
+history_cache = None
+inference_metrics = None
+message_writer = None
 
+# Cancel events of generations in flight, by request id
+active_requests = CancellationRegistry()
 
-def init_chat_routes(service):
-    """Initialize the chat routes with the LLM service"""
-    global llm_service
-    llm_service = service
+# Frames of streaming generations, kept for clients that reconnect
+stream_registry = StreamRegistry()
+
+# For the uptime reported by the liveness probe
+_started_at = time.monotonic()
+
+# Seconds a readiness probe client is told to wait while the model loads
+READY_RETRY_AFTER = 5
+
+# Word-sized pieces used to replay a cached answer as a stream
+_REPLAY_CHUNK_RE = re.compile(r"\s*\S+\s*|\s+")
+
+
+def init_chat_routes(
+    registry,
+    request_scheduler=None,
+    cache=None,
+    histories=None,
+    request_metrics=None,
+    writer=None,
+    streams=None,
+):
+    """Initialize the chat routes with the model registry, request scheduler, caches, metrics, message writer and stream buffers"""
+    global model_registry, scheduler, completion_cache, history_cache, inference_metrics, message_writer, stream_registry
+    model_registry = registry
+    scheduler = request_scheduler or RequestScheduler()
+    completion_cache = cache
+    history_cache = histories
+    inference_metrics = request_metrics
+    message_writer = writer
+    if streams is not None:
+        stream_registry = streams
+
+
+def _release(ticket):
+    """Release a scheduler ticket if one was taken"""
+    if ticket is not None:
+        scheduler.release(ticket)
+
+
+def _finish_request(ticket, request_id, lease=None):
+    """Free the model slot and model and stop tracking a request. Safe to call twice."""
+    _release(ticket)
+    if lease is not None:
+        lease.release()
+    if request_id is not None:
+        active_requests.unregister(request_id)
+
+
+def _record_request(started, ticket, perf, cached, ttft_ms, status):
+    """
+    Build a request's metrics summary and add it to the aggregated metrics
+
+    Args:
+        started: perf_counter() when the request arrived
+        ticket: Scheduler ticket, None if the model was not needed
+        perf: Timings filled in by the LLM service
+        cached: Whether the answer came from the completion cache
+        ttft_ms: Time from arrival to the first token, None if unknown
+        status: Request outcome ("completed", "cancelled" or "error")
+
+    Returns:
+        The summary, for the response
+    """
+    summary = {
+        "queue_wait_ms": round(ticket.queue_wait_ms, 1) if ticket else 0.0,
+        "ttft_ms": round(ttft_ms, 2) if ttft_ms is not None else None,
+        "total_ms": round((time.perf_counter() - started) * 1000, 2),
+        "cached": cached,
+    }
+    summary.update(perf)
+    if inference_metrics is not None:
+        inference_metrics.record(summary, status)
+    return summary
+
+
+def _cache_lookup(messages, max_tokens, temperature, model_path):
+    """
+    Check the completion cache for a deterministic request
+
+    Args:
+        messages: Chat messages of the request
+        max_tokens: Generation limit
+        temperature: Sampling temperature
+        model_path: File of the model that would answer
+
+    Returns:
+        (key, cached response) - key is None when the request is not
+        cacheable, cached response is None on a miss
+    """
+    if completion_cache is None or not CompletionCache.is_deterministic(temperature):
+        return None, None
+
+    key = CompletionCache.make_key(
+        format_chat_prompt(messages),
+        model_fingerprint(model_path),
+        {"max_tokens": max_tokens, "temperature": float(temperature)},
+    )
+    return key, completion_cache.get(key)
+
+
+def _replay_chunks(text):
+    """Split a cached answer into stream chunks"""
+    return _REPLAY_CHUNK_RE.findall(text)
+
+
+def _busy_response(error):
+    """Response for a request the scheduler refused to queue"""
+    return (
+        jsonify({"error": str(error), "retry_after": error.retry_after}),
+        error.status_code,
+        {"Retry-After": str(error.retry_after)},
+    )
+
+
+def _model_error(error):
+    """Response for a model that is unknown, failed to load or is still loading"""
+    headers = {"Retry-After": str(error.retry_after)} if error.retry_after else {}
+    return jsonify({"error": str(error), "retry_after": error.retry_after}), error.status_code, headers
+
+
+def _validate_messages(messages):
+    """Return an error string if messages is not a valid chat message list"""
+    if not isinstance(messages, list) or len(messages) == 0:
+        return "Messages must be a non-empty list"
+
+    for msg in messages:
+        if not isinstance(msg, dict) or "role" not in msg or "content" not in msg:
+            return "Each message must have role and content"
+        if not isinstance(msg["role"], str) or not isinstance(msg["content"], str):
+            return "Message role and content must be strings"
+    return None
 
 
 @chat_bp.route("/chat", methods=["POST"])
@@ -33,39 +188,138 @@ def chat():
         "save_conversation": true,  // optional, default false
         "stream": false,
         "max_tokens": 512,
-        "temperature": 0.7
+        "temperature": 0.7,
+        "priority": "interactive",  // optional, "interactive" or "bulk";
+                                    // defaults to interactive when streaming
+        "request_id": "abc123",  // optional, generated if not provided
+        "model": "mistral-7b.gguf"  // optional, see /chat/models; default model if omitted
+    }
+
+    A model that is not loaded is loaded first, evicting the least recently
+    used idle model if the memory budget requires it; a request that waits
+    longer than MODEL_LOAD_WAIT gets a 503 with Retry-After while the load
+    continues.
+
+    The request id is returned in the X-Request-ID header (and as the first
+    SSE event when streaming) and can be passed to /chat/<request_id>/cancel.
+    A cancelled generation stops at the next token and its partial output is
+    saved with a "cancelled" status.
+
+    A stream is a sequence of JSON events, each with an increasing "seq"
+    (also the SSE id) and a "type": request_id, token ("text", several
+    tokens coalesced per STREAM_FRAME_MS), conversation_id, cancelled,
+    metrics, error and finally done. A client whose connection drops can
+    resume with GET /chat/<request_id>/stream, or by repeating this request
+    with the same request_id and a Last-Event-ID header; the generation
+    keeps running for STREAM_RESUME_GRACE seconds without a client before
+    it is cancelled like above.
+
+    Server-side history: for an existing conversation the client may send
+    only the new turn instead of "messages". The history is read from the
+    stored messages and the turn is always saved.
+    {
+        "conversation_id": 1,
+        "message": {"role": "user", "content": "And then?"},
+        "system": "You are a helpful assistant"  // optional, not stored
     }
     """
+    started = time.perf_counter()
+    ticket = None
+    lease = None
+    request_id = None
+    streaming = False
     try:
         # Check if LLM service is available
-        if llm_service is None:
+        if model_registry is None:
             return jsonify({"error": "LLM service not initialized"}), 503
         
         data = request.get_json()
 
-        if not data or "messages" not in data:
+        if not data or ("messages" not in data and "message" not in data):
             return jsonify({"error": "Missing required field: messages"}), 400
 
-        messages = data["messages"]
         stream = data.get("stream", False)
         max_tokens = data.get("max_tokens", 512)
         temperature = data.get("temperature", 0.7)
         save_conversation = data.get("save_conversation", False)
         conversation_id = data.get("conversation_id")
+        priority = data.get("priority", "interactive" if stream else "bulk")
+        new_message = data.get("message")
+        server_history = new_message is not None
 
-        # Validate messages format
-        if not isinstance(messages, list) or len(messages) == 0:
-            return jsonify({"error": "Messages must be a non-empty list"}), 400
+        if priority not in PRIORITIES:
+            return jsonify({"error": f"Unknown priority: {priority}"}), 400
 
-        for msg in messages:
-            if "role" not in msg or "content" not in msg:
-                return jsonify(
-                    {"error": "Each message must have role and content"}
-                ), 400
+        # A client retrying a stream it lost resumes it instead of generating
+        # the answer again
+        if "Last-Event-ID" in request.headers and isinstance(data.get("request_id"), str):
+            buffer = stream_registry.get(data["request_id"])
+            if buffer is not None:
+                return _resume_stream(buffer)
+
+        try:
+            model = model_registry.resolve(data.get("model"))
+        except ModelUnavailableError as e:
+            return _model_error(e)
+
+        requested_id = data.get("request_id") or uuid.uuid4().hex
+        if not isinstance(requested_id, str) or len(requested_id) > 64:
+            return jsonify({"error": "request_id must be a string of at most 64 characters"}), 400
+        cancel_event = active_requests.register(requested_id)
+        if cancel_event is None:
+            return jsonify({"error": f"Request {requested_id} is already in progress"}), 409
+        request_id = requested_id
 
-        # Create or get conversation if saving
         conversation = None
-        if save_conversation:
+        if server_history:
+            error = _validate_messages([new_message])
+            if error:
+                return jsonify({"error": error}), 400
+            # The turn saved afterwards is this message and the reply
+            if new_message["role"] != "user":
+                return jsonify({"error": "message must have role user"}), 400
+            if not conversation_id:
+                return jsonify({"error": "conversation_id is required when sending a single message"}), 400
+
+            conversation = Conversation.query.get(conversation_id)
+            if not conversation:
+                return jsonify({"error": "Conversation not found"}), 404
+
+            save_conversation = True
+            messages = _conversation_history(conversation.id) + [
+                {"role": new_message["role"], "content": new_message["content"]}
+            ]
+            if data.get("system"):
+                messages = [{"role": "system", "content": data["system"]}] + messages
+        else:
+            messages = data["messages"]
+
+            # Validate messages format
+            error = _validate_messages(messages)
+            if error:
+                return jsonify({"error": error}), 400
+
+        # Deterministic requests may be answered from the cache without
+        # touching the model
+        cache_key, cached = _cache_lookup(messages, max_tokens, temperature, model_registry.path_of(model))
+
+        # Wait for the model and a slot on it before opening a write
+        # transaction, so queued requests don't hold the database lock
+        if cached is None:
+            try:
+                lease = model_registry.acquire(model, timeout=current_app.config.get("MODEL_LOAD_WAIT", 120))
+            except ModelUnavailableError as e:
+                return _model_error(e)
+            try:
+                ticket = scheduler.acquire(PRIORITIES[priority])
+            except SchedulerError as e:
+                return _busy_response(e)
+
+        if cancel_event.is_set():
+            return jsonify({"error": "Request was cancelled", "request_id": request_id}), 409
+
+        # Create or get conversation if saving
+        if save_conversation and conversation is None:
             if conversation_id:
                 conversation = Conversation.query.get(conversation_id)
                 if not conversation:
@@ -77,132 +331,604 @@ def chat():
                 
                 conversation = Conversation(title=title)
                 db.session.add(conversation)
-                db.session.flush()  # Get the ID without committing
-        
+                if message_writer is not None or stream:
+                    # The writer or the stream's generation thread saves the
+                    # turn from its own connection, so the conversation must
+                    # exist before it gets there
+                    db.session.commit()
+                else:
+                    db.session.flush()  # Get the ID without committing
+
+        if conversation is not None:
+            # Read once: after a commit the attribute would be reloaded
+            conversation_id = conversation.id
+
         if stream:
-            # Streaming response
+            # Streaming response. The generation runs in its own thread and
+            # writes to a buffer that outlives the connection, so a client
+            # that drops can reconnect with Last-Event-ID and carry on
+            encoder = SSEEncoder(
+                window_ms=current_app.config.get("STREAM_FRAME_MS", 30),
+                max_chars=current_app.config.get("STREAM_FRAME_CHARS", 1024),
+            )
+            buffer = stream_registry.create(request_id)
+            app = current_app._get_current_object()
+
+            def emit(frame):
+                buffer.append(encoder.seq, frame)
+
             def generate():
-                full_response = ""
+                chunks = None
+                perf = {}
+                first_token_at = None
                 try:
-                    for chunk in llm_service.chat(
-                        messages=messages,
-                        max_tokens=max_tokens,
-                        temperature=temperature,
-                        stream=True,
-                    ):
-                        full_response += chunk
-                        # Send as server-sent events (SSE)
-                        yield f"data: {chunk}\n\n"
+                    emit(encoder.event("request_id", request_id=request_id))
+
+                    if cached is not None:
+                        chunks = iter(_replay_chunks(cached["text"]))
+                    else:
+                        chunks = lease.service.chat(
+                            messages=messages,
+                            max_tokens=max_tokens,
+                            temperature=temperature,
+                            stream=True,
+                            conversation_id=conversation_id,
+                            cancel_event=cancel_event,
+                            perf=perf,
+                        )
+                    for chunk in chunks:
+                        if first_token_at is None:
+                            first_token_at = time.perf_counter()
+                        frame = encoder.token(chunk)
+                        if frame is not None:
+                            emit(frame)
+                        if buffer.abandoned(stream_registry.grace):
+                            # Nobody reconnected: stop the model rather than
+                            # generating up to max_tokens for nobody, and keep
+                            # what was produced so far
+                            logger.info(f"Client gone, cancelling request {request_id}")
+                            cancel_event.set()
+                        if cancel_event.is_set():
+                            break
+                    if hasattr(chunks, "close"):
+                        chunks.close()
+                    frame = encoder.flush()
+                    if frame is not None:
+                        emit(frame)
+
+                    full_response = encoder.text
+                    cancelled = cancel_event.is_set()
+                    if cache_key and cached is None and not cancelled:
+                        completion_cache.put(cache_key, {"text": full_response})
                     
                     # Save conversation after streaming is complete
                     if save_conversation and conversation:
                         try:
-                            # Save user message
-                            last_user_msg = next((m for m in reversed(messages) if m["role"] == "user"), None)
-                            if last_user_msg:
-                                user_message = Message(
-                                    conversation_id=conversation.id,
-                                    role="user",
-                                    content=last_user_msg["content"]
-                                )
-                                db.session.add(user_message)
-                            
-                            # Save assistant response
-                            assistant_message = Message(
-                                conversation_id=conversation.id,
-                                role="assistant",
-                                content=full_response
+                            _save_turn(
+                                conversation_id,
+                                messages,
+                                full_response,
+                                {"status": "cancelled"} if cancelled else None,
                             )
-                            db.session.add(assistant_message)
-                            
-                            conversation.updated_at = db.func.now()
-                            db.session.commit()
-                            
+
                             # Send conversation ID to client
-                            yield f"data: [CONVERSATION_ID:{conversation.id}]\n\n"
+                            emit(encoder.event("conversation_id", conversation_id=conversation_id))
                         except Exception as e:
                             logger.error(f"Error saving conversation: {e}")
                             db.session.rollback()
-                    
-                    yield "data: [DONE]\n\n"
+
+                    if cancelled:
+                        emit(encoder.event("cancelled"))
+
+                    summary = _record_request(
+                        started,
+                        ticket,
+                        perf,
+                        cached is not None,
+                        (first_token_at - started) * 1000 if first_token_at else None,
+                        "cancelled" if cancelled else "completed",
+                    )
+                    summary["stream_frames"] = encoder.frames
+                    emit(encoder.event("metrics", metrics=summary))
+                    emit(encoder.event("done"))
                 except Exception as e:
                     logger.error(f"Streaming error: {e}")
+                    _record_request(started, ticket, perf, cached is not None, None, "error")
                     if save_conversation:
                         db.session.rollback()
-                    yield f"data: [ERROR: {str(e)}]\n\n"
+                    emit(encoder.event("error", error=str(e)))
+                finally:
+                    buffer.finish()
+                    _finish_request(ticket, request_id, lease)
 
-            return Response(
-                stream_with_context(generate()),
-                mimetype="text/event-stream",
-                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
-            )
+            def run():
+                with app.app_context():
+                    generate()
+
+            headers = {"X-Request-ID": request_id}
+            if ticket is not None:
+                headers["X-Queue-Wait-Ms"] = f"{ticket.queue_wait_ms:.1f}"
+            if cache_key:
+                headers["X-Completion-Cache"] = "hit" if cached is not None else "miss"
+
+            response = _stream_response(buffer, 0, headers)
+            threading.Thread(target=run, name=f"stream-{request_id}", daemon=True).start()
+            streaming = True
+            return response
         else:
             # Non-streaming response
-            response = llm_service.chat(
-                messages=messages,
-                max_tokens=max_tokens,
-                temperature=temperature,
-                stream=False,
-            )
+            perf = {}
+            ttft_ms = None
+            if cached is not None:
+                response = cached
+            else:
+                try:
+                    call_started = time.perf_counter()
+                    response = lease.service.chat(
+                        messages=messages,
+                        max_tokens=max_tokens,
+                        temperature=temperature,
+                        stream=False,
+                        conversation_id=conversation_id,
+                        cancel_event=cancel_event,
+                        perf=perf,
+                    )
+                    if perf.get("prompt_eval_ms") is not None:
+                        ttft_ms = (call_started - started) * 1000 + perf["prompt_eval_ms"]
+                except Exception:
+                    _record_request(started, ticket, perf, False, None, "error")
+                    raise
+                finally:
+                    # Free the model before the database work
+                    _release(ticket)
+                    lease.release()
+
+            cancelled = cancel_event.is_set()
+            if cache_key and cached is None and not cancelled:
+                completion_cache.put(cache_key, response)
 
             # Save conversation if requested
             if save_conversation and conversation:
+                metadata = {"tokens_used": response.get("tokens_used", 0)}
+                if cancelled:
+                    metadata["status"] = "cancelled"
                 try:
-                    # Save user message
-                    last_user_msg = next((m for m in reversed(messages) if m["role"] == "user"), None)
-                    if last_user_msg:
-                        user_message = Message(
-                            conversation_id=conversation.id,
-                            role="user",
-                            content=last_user_msg["content"]
-                        )
-                        db.session.add(user_message)
-                    
-                    # Save assistant response
-                    assistant_message = Message(
-                        conversation_id=conversation.id,
-                        role="assistant",
-                        content=response["text"],
-                        message_metadata=json.dumps({"tokens_used": response.get("tokens_used", 0)})
-                    )
-                    db.session.add(assistant_message)
-                    
-                    conversation.updated_at = db.func.now()
-                    db.session.commit()
+                    _save_turn(conversation_id, messages, response["text"], metadata)
                 except Exception as e:
                     logger.error(f"Error saving conversation: {e}")
                     db.session.rollback()
 
+            status = "cancelled" if cancelled else "completed"
+            summary = _record_request(started, ticket, perf, cached is not None, ttft_ms, status)
             result = {
                 "message": {"role": "assistant", "content": response["text"]},
                 "tokens_used": response.get("tokens_used", 0),
+                "queue_wait_ms": summary["queue_wait_ms"],
+                "cached": cached is not None,
+                "request_id": request_id,
+                "model": model,
+                "status": status,
+                "metrics": summary,
             }
             
             if save_conversation and conversation:
-                result["conversation_id"] = conversation.id
+                result["conversation_id"] = conversation_id
 
-            return jsonify(result)
+            return jsonify(result), 200, {"X-Request-ID": request_id}
 
+    except ContextOverflowError as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         logger.error(f"Chat endpoint error: {e}")
-        if save_conversation:
-            db.session.rollback()
+        db.session.rollback()
         return jsonify({"error": str(e)}), 500
+    finally:
+        # A streaming response finishes the request when the stream ends
+        if not streaming:
+            _finish_request(ticket, request_id, lease)
+
+
+def _stream_response(buffer, after, headers=None):
+    """SSE response with the frames of a stream buffer after sequence number `after`"""
+    buffer.attach()
+
+    def read():
+        try:
+            yield from buffer.read(after)
+        except StreamGapError as e:
+            # The client fell too far behind; reconnecting tells it why
+            logger.warning(str(e))
+
+    response = Response(
+        read(),
+        mimetype="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+            "X-Request-ID": buffer.request_id,
+            **(headers or {}),
+        },
+    )
+    # Runs when the stream ends and when the client goes away
+    response.call_on_close(buffer.detach)
+    return response
+
+
+def _resume_stream(buffer):
+    """Reattach a client to a stream after the event in its Last-Event-ID"""
+    after = request.headers.get("Last-Event-ID", request.args.get("last_event_id", "0"))
+    try:
+        after = int(after or 0)
+    except ValueError:
+        return jsonify({"error": "Last-Event-ID must be an event sequence number"}), 400
+    try:
+        buffer.check(after)
+    except StreamGapError as e:
+        return jsonify({"error": str(e), "request_id": buffer.request_id}), e.status_code
+    logger.info(f"Resuming stream {buffer.request_id} after event {after}")
+    return _stream_response(buffer, after)
+
+
+@chat_bp.route("/chat/<request_id>/stream", methods=["GET"])
+def resume_chat_stream(request_id):
+    """
+    Reconnect to a streaming chat
+
+    Replays the events after the one in the Last-Event-ID header (or the
+    last_event_id query parameter; 0 or missing replays everything) and then
+    follows the generation live. Works while the generation runs and for
+    STREAM_RESUME_TTL seconds after it ends; a generation with no client
+    attached for STREAM_RESUME_GRACE seconds is cancelled. An EventSource
+    pointed at this URL reconnects by itself.
+
+    Returns 404 for an unknown or expired request and 410 when the missed
+    events are no longer buffered.
+    """
+    buffer = stream_registry.get(request_id)
+    if buffer is None:
+        return jsonify({"error": "No stream with that request id"}), 404
+    return _resume_stream(buffer)
+
+
+@chat_bp.route("/chat/<request_id>/cancel", methods=["POST"])
+def cancel_chat(request_id):
+    """
+    Cancel an in-flight chat request
+
+    Generation stops at the next token and the model slot is freed for the
+    next queued request. A request still waiting in the queue is dropped as
+    soon as it reaches the front.
+    """
+    if not active_requests.cancel(request_id):
+        return jsonify({"error": "No active request with that id"}), 404
+    return jsonify({"request_id": request_id, "cancelled": True})
+
+
+@chat_bp.route("/chat/prefill", methods=["POST"])
+def prefill_chat():
+    """
+    Evaluate a chat's prompt into the model's KV cache before it is sent
+
+    Called while the user is typing, so prompt evaluation of a long history
+    is done by the time the message is sent and the real /chat request
+    finds it in the context. Best effort: it runs only when no other request
+    is running or queued, never loads a model, and stops as soon as a real
+    request arrives.
+
+    Request body (the same history forms as /chat):
+    {
+        "messages": [...],  // the chat so far, may end with a draft message
+        "max_tokens": 512,  // the value the chat will be sent with
+        "model": "mistral-7b.gguf"  // optional
+    }
+    or
+    {
+        "conversation_id": 1,
+        "message": {"role": "user", "content": "Draft of the next tu"},  // optional
+        "system": "You are a helpful assistant"  // optional
+    }
+
+    Response: {"status": "prefilled" | "cancelled" | "skipped", ...} with
+    the token counts and time taken, or the reason it was skipped.
+    """
+    if model_registry is None:
+        return jsonify({"error": "LLM service not initialized"}), 503
+
+    data = request.get_json()
+    if not data or ("messages" not in data and "conversation_id" not in data):
+        return jsonify({"error": "Missing required field: messages"}), 400
+
+    conversation_id = data.get("conversation_id")
+    if "messages" in data:
+        messages = data["messages"]
+    else:
+        if not Conversation.query.get(conversation_id):
+            return jsonify({"error": "Conversation not found"}), 404
+        messages = _conversation_history(conversation_id)
+        draft = data.get("message")
+        if draft:
+            if not isinstance(draft, dict):
+                return jsonify({"error": "message must be an object with role and content"}), 400
+            messages = messages + [{"role": draft.get("role", "user"), "content": draft.get("content", "")}]
+        if data.get("system"):
+            messages = [{"role": "system", "content": data["system"]}] + messages
+    error = _validate_messages(messages)
+    if error:
+        return jsonify({"error": error}), 400
+
+    try:
+        model = model_registry.resolve(data.get("model"))
+    except ModelUnavailableError as e:
+        return _model_error(e)
+
+    ticket = scheduler.try_acquire(PRIORITY_PREFILL)
+    if ticket is None:
+        return jsonify({"status": "skipped", "reason": "busy"})
+    lease = None
+    try:
+        try:
+            lease = model_registry.acquire(model, load=False)
+        except ModelUnavailableError:
+            return jsonify({"status": "skipped", "reason": "model not loaded"})
+        result = lease.service.prefill(
+            messages,
+            max_tokens=data.get("max_tokens", 512),
+            conversation_id=conversation_id,
+            # Set by the scheduler when a real request arrives
+            cancel_event=ticket.preempted,
+        )
+    except ContextOverflowError as e:
+        return jsonify({"error": str(e)}), 400
+    finally:
+        _finish_request(ticket, None, lease)
+
+    result["status"] = "cancelled" if result.pop("cancelled") else "prefilled"
+    result["model"] = model
+    return jsonify(result)
+
+
+def _conversation_history(conversation_id):
+    """Stored messages of a conversation as role/content dicts, oldest first"""
+    def load():
+        if message_writer is not None:
+            # Turns still queued for writing would be missing from the result
+            message_writer.wait_for(conversation_id)
+        rows = (
+            db.session.query(Message.role, Message.content)
+            .filter(Message.conversation_id == conversation_id)
+            .order_by(Message.created_at.asc(), Message.id.asc())
+            .all()
+        )
+        return [{"role": role, "content": content} for role, content in rows]
+
+    if history_cache is None:
+        return load()
+    return history_cache.get(conversation_id, load)
+
+
+def _save_turn(conversation_id, messages, assistant_content, metadata=None):
+    """
+    Save the latest user message and the assistant's reply
+
+    The turn is handed to the background message writer when there is one,
+    so the response does not wait for the commit. It is written here if the
+    writer's queue is full.
+    """
+    saved = []
+
+    last_user_msg = next((m for m in reversed(messages) if m["role"] == "user"), None)
+    if last_user_msg:
+        saved.append({"role": "user", "content": last_user_msg["content"], "message_metadata": None})
+    saved.append({
+        "role": "assistant",
+        "content": assistant_content,
+        "message_metadata": json.dumps(metadata) if metadata else None,
+    })
+
+    if message_writer is None or not message_writer.submit(conversation_id, saved):
+        for message in saved:
+            db.session.add(Message(conversation_id=conversation_id, **message))
+        Conversation.query.filter_by(id=conversation_id).update(
+            {"updated_at": datetime.now(timezone.utc)}
+        )
+        db.session.commit()
+
+    if history_cache is not None:
+        history_cache.append(
+            conversation_id, [{"role": m["role"], "content": m["content"]} for m in saved]
+        )
+
+
+@chat_bp.route("/chat/batch", methods=["POST"])
+def chat_batch():
+    """
+    Run many non-streaming completions in one request
+
+    Items are run in an order that keeps shared message prefixes (e.g. a
+    common system prompt) adjacent, so llama.cpp's prefix matching evaluates
+    a shared prefix once and every following item only evaluates its own
+    suffix. Results are streamed back as NDJSON lines as each item finishes,
+    followed by a summary line with aggregate throughput.
+
+    Request body:
+    {
+        "items": [
+            {"messages": [...], "max_tokens": 128},  // per-item overrides optional
+            {"messages": [...]}
+        ],
+        "max_tokens": 512,
+        "temperature": 0.7,
+        "model": "mistral-7b.gguf"  // optional, one model for the whole batch
+    }
+
+    Response lines:
+    {"index": 0, "message": {...}, "prompt_tokens": 10, "completion_tokens": 20, "elapsed_ms": 812.3}
+    {"index": 1, "error": "..."}
+    {"summary": {"items": 2, "prompt_tokens_per_s": ..., "eval_tokens_per_s": ...}}
+    """
+    if model_registry is None:
+        return jsonify({"error": "LLM service not initialized"}), 503
+
+    data = request.get_json()
+    if not data or not isinstance(data.get("items"), list) or len(data["items"]) == 0:
+        return jsonify({"error": "Missing required field: items"}), 400
+
+    try:
+        model = model_registry.resolve(data.get("model"))
+    except ModelUnavailableError as e:
+        return _model_error(e)
+    model_path = model_registry.path_of(model)
+
+    items = data["items"]
+    max_batch = current_app.config.get("MAX_BATCH_SIZE", 256)
+    if len(items) > max_batch:
+        return jsonify({"error": f"Batch too large, maximum is {max_batch} items"}), 400
+
+    default_max_tokens = data.get("max_tokens", 512)
+    default_temperature = data.get("temperature", 0.7)
+    for i, item in enumerate(items):
+        error = _validate_messages(item.get("messages") if isinstance(item, dict) else None)
+        if error:
+            return jsonify({"error": f"Item {i}: {error}"}), 400
+
+    # Sorting on the (role, content) sequence puts items that share leading
+    # messages next to each other
+    def prefix_key(i):
+        return [(m["role"], m["content"]) for m in items[i]["messages"]]
+
+    order = sorted(range(len(items)), key=prefix_key)
+    # Messages each item shares with the one run before it, i.e. what the
+    # context already holds when the item starts
+    keys = [prefix_key(i) for i in order]
+    shared_prefix = {order[0]: 0}
+    for prev, index, key in zip(keys, order[1:], keys[1:]):
+        shared_prefix[index] = _common_prefix_length(prev, key)
+
+    # Loading and admission control happen up front so an overloaded
+    # server answers 429/503 instead of a stream of errors
+    try:
+        lease = model_registry.acquire(model, timeout=current_app.config.get("MODEL_LOAD_WAIT", 120))
+    except ModelUnavailableError as e:
+        return _model_error(e)
+    try:
+        first_ticket = scheduler.acquire(PRIORITY_BULK)
+    except SchedulerError as e:
+        lease.release()
+        return _busy_response(e)
+    # A pool runs each request on any idle worker; one routing key keeps the
+    # batch on one worker, so the shared prefixes stay in its context
+    batch_key = f"batch-{uuid.uuid4().hex}" if isinstance(lease.service, InferencePool) else None
+
+    def generate():
+        ticket = first_ticket
+        started = time.monotonic()
+        totals = {"prompt_tokens": 0, "completion_tokens": 0, "completed": 0, "failed": 0, "cached": 0}
+        try:
+            for index in order:
+                item = items[index]
+                item_max_tokens = item.get("max_tokens", default_max_tokens)
+                item_temperature = item.get("temperature", default_temperature)
+                item_started = time.monotonic()
+                try:
+                    cache_key, cached = _cache_lookup(item["messages"], item_max_tokens, item_temperature, model_path)
+                    response = cached
+                    if response is None:
+                        # Re-queue between items so interactive chats can cut in
+                        if ticket is None:
+                            ticket = scheduler.acquire(PRIORITY_BULK)
+                        try:
+                            response = lease.service.chat(
+                                messages=item["messages"],
+                                max_tokens=item_max_tokens,
+                                temperature=item_temperature,
+                                stream=False,
+                                conversation_id=batch_key,
+                            )
+                        finally:
+                            scheduler.release(ticket)
+                            ticket = None
+                        if cache_key:
+                            completion_cache.put(cache_key, response)
+                except Exception as e:
+                    totals["failed"] += 1
+                    yield json.dumps({"index": index, "error": str(e)}) + "\n"
+                    continue
+
+                totals["completed"] += 1
+                if cached is not None:
+                    totals["cached"] += 1
+                else:
+                    # Throughput only counts tokens the model actually processed
+                    totals["prompt_tokens"] += response.get("prompt_tokens", 0)
+                    totals["completion_tokens"] += response.get("completion_tokens", 0)
+                yield json.dumps({
+                    "index": index,
+                    "message": {"role": "assistant", "content": response["text"]},
+                    "tokens_used": response.get("tokens_used", 0),
+                    "prompt_tokens": response.get("prompt_tokens", 0),
+                    "completion_tokens": response.get("completion_tokens", 0),
+                    "shared_prefix_messages": shared_prefix[index],
+                    "cached": cached is not None,
+                    "elapsed_ms": round((time.monotonic() - item_started) * 1000, 1),
+                }) + "\n"
+        finally:
+            if ticket is not None:
+                scheduler.release(ticket)
+            lease.release()
+
+        elapsed = max(time.monotonic() - started, 1e-9)
+        yield json.dumps({
+            "summary": {
+                "items": len(items),
+                "model": model,
+                "completed": totals["completed"],
+                "failed": totals["failed"],
+                "cached": totals["cached"],
+                "shared_prefix_messages": sum(shared_prefix.values()),
+                "prompt_tokens": totals["prompt_tokens"],
+                "completion_tokens": totals["completion_tokens"],
+                "elapsed_ms": round(elapsed * 1000, 1),
+                "prompt_tokens_per_s": round(totals["prompt_tokens"] / elapsed, 2),
+                "eval_tokens_per_s": round(totals["completion_tokens"] / elapsed, 2),
+            }
+        }) + "\n"
+
+    response = Response(
+        stream_with_context(generate()),
+        mimetype="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    response.call_on_close(lambda: _finish_request(first_ticket, None, lease))
+    return response
+
+
+def _common_prefix_length(first, second):
+    """Number of leading elements two sequences share"""
+    length = 0
+    for a, b in zip(first, second):
+        if a != b:
+            break
+        length += 1
+    return length
 
 
 @chat_bp.route("/chat/models", methods=["GET"])
 def list_models():
-    """List available models (for future expansion)"""
-    # For now, just return info about the loaded model
+    """
+    List the .gguf models in MODEL_DIR
+
+    Each entry has the header metadata (architecture, context length,
+    quantization, size), the estimated memory when loaded and the load
+    status. Pass a model's name as "model" in a chat request to use it.
+    """
+    if model_registry is None:
+        return jsonify({"models": [], "default": None})
     return jsonify(
         {
-            "models": [
-                {
-                    "name": "default",
-                    "path": str(llm_service.model_path) if llm_service else None,
-                    "loaded": llm_service is not None,
-                }
-            ]
+            "models": model_registry.list_models(),
+            "default": model_registry.default_model,
+            "memory": model_registry.stats(),
         }
     )
 
@@ -210,9 +936,52 @@ def list_models():
 @chat_bp.route("/health", methods=["GET"])
 def health():
     """Health check endpoint"""
+    # Details of the default model, when it is loaded
+    llm_service = model_registry.peek() if model_registry else None
     return jsonify(
         {
             "status": "healthy",
             "model_loaded": llm_service is not None and llm_service.llm is not None,
+            "model": model_registry.progress() if model_registry else None,
+            "models": model_registry.stats() if model_registry else None,
+            "kv_cache": llm_service.kv_pool.stats() if llm_service and llm_service.kv_pool else None,
+            "token_cache": llm_service.token_cache.stats() if llm_service and llm_service.token_cache else None,
+            "prompt_snapshots": llm_service.snapshots.stats() if llm_service and llm_service.snapshots else None,
+            "scheduler": scheduler.stats() if scheduler else None,
+            "inference_pool": llm_service.stats() if isinstance(llm_service, InferencePool) else None,
+            "completion_cache": completion_cache.stats() if completion_cache else None,
+            "history_cache": history_cache.stats() if history_cache else None,
+            "message_writer": message_writer.stats() if message_writer else None,
+            "resumable_streams": len(stream_registry),
         }
-    )
\ No newline at end of file
+    )
+
+@chat_bp.route("/health/live", methods=["GET"])
+def liveness():
+    """Liveness probe: the process is up and serving requests, model or not"""
+    return jsonify({"status": "alive", "uptime_s": round(time.monotonic() - _started_at, 1)})
+
+
+@chat_bp.route("/health/ready", methods=["GET"])
+def readiness():
+    """
+    Readiness probe: 200 once the default model is loaded and warmed up
+
+    While the model loads this answers 503 with Retry-After and the load
+    phase ("queued", "loading", "warming") and the time spent so far.
+    """
+    if model_registry is None:
+        return jsonify({"ready": False, "status": "not initialized"}), 503, {"Retry-After": str(READY_RETRY_AFTER)}
+
+    progress = model_registry.progress()
+    if progress["ready"]:
+        return jsonify(progress)
+    return jsonify(progress), 503, {"Retry-After": str(READY_RETRY_AFTER)}
+
+
+@chat_bp.route("/metrics", methods=["GET"])
+def metrics():
+    """Inference metrics in Prometheus text format"""
+    if inference_metrics is None:
+        return jsonify({"error": "Metrics are not enabled"}), 404
+    return Response(inference_metrics.render(), content_type=METRICS_CONTENT_TYPE)
@@ -1,27 +1,275 @@
-from flask import Blueprint, request, jsonify
-from ..database import db, Conversation, Message
+from flask import Blueprint, request, jsonify, Response, stream_with_context
+from datetime import datetime, timezone
+from sqlalchemy import and_, or_, select, text
+from ..database import db, Conversation, Message, message_to_dict
+import base64
 import logging
 import json
+import re
 
 logger = logging.getLogger(__name__)
 
 conversations_bp = Blueprint("conversations", __name__)
 
+# Conversations per page of the listing
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Messages per page of a conversation
+DEFAULT_MESSAGE_PAGE_SIZE = 100
+MAX_MESSAGE_PAGE_SIZE = 500
+
+# Rows fetched from the database at a time when streaming messages
+STREAM_BATCH_SIZE = 500
+
+# Search results per page, and how deep results can be paged
+DEFAULT_SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 100
+MAX_SEARCH_OFFSET = 1000
+
+# Messages are ranked among at most this many of the newest matches, so a
+# word that appears in most messages costs no more than a rare one
+MAX_RANKED_MATCHES = 5000
+
+# Marks around matched terms in search snippets
+SNIPPET_OPEN = "<mark>"
+SNIPPET_CLOSE = "</mark>"
+
+# Best-ranked message and title matches, merged. A title match counts twice.
+_SEARCH_RANKED = text("""
+    SELECT kind, id, score FROM (
+        SELECT 'message' AS kind, rowid AS id, rank AS score
+        FROM messages_fts WHERE messages_fts MATCH :query AND rowid >= coalesce((
+            SELECT rowid FROM messages_fts WHERE messages_fts MATCH :query
+            ORDER BY rowid DESC LIMIT 1 OFFSET :window
+        ), 0)
+        ORDER BY rank LIMIT :depth
+    )
+    UNION ALL
+    SELECT kind, id, score FROM (
+        SELECT 'conversation' AS kind, rowid AS id, rank * 2 AS score
+        FROM conversations_fts WHERE conversations_fts MATCH :query
+        ORDER BY rank LIMIT :depth
+    )
+    ORDER BY score LIMIT :limit OFFSET :offset
+""")
+
+# Details and snippet of one result. Looked up by rowid one at a time: FTS5
+# seeks directly to a single rowid but scans every match for an IN list.
+_SEARCH_MESSAGE = text("""
+    SELECT m.id, m.conversation_id, m.role, m.created_at, c.title,
+           snippet(messages_fts, 0, :open, :close, '…', 16) AS snippet
+    FROM messages_fts
+    JOIN messages m ON m.id = messages_fts.rowid
+    JOIN conversations c ON c.id = m.conversation_id
+    WHERE messages_fts MATCH :query AND messages_fts.rowid = :id
+""").columns(created_at=db.DateTime)
+
+_SEARCH_CONVERSATION = text("""
+    SELECT c.id, c.title, c.updated_at,
+           highlight(conversations_fts, 0, :open, :close) AS snippet
+    FROM conversations_fts
+    JOIN conversations c ON c.id = conversations_fts.rowid
+    WHERE conversations_fts MATCH :query AND conversations_fts.rowid = :id
+""").columns(updated_at=db.DateTime)
+
+# Columns needed to serialize a message, selected without building ORM objects
+_MESSAGE_COLUMNS = (
+    Message.id,
+    Message.conversation_id,
+    Message.role,
+    Message.content,
+    Message.created_at,
+    Message.message_metadata,
+)
+
+# Shared with the chat routes, which read histories through it
+history_cache = None
+
+# Background writer of chat turns, shared with the chat routes
+message_writer = None
+
+
+def init_conversation_routes(histories=None, writer=None):
+    """Initialize the conversation routes with the conversation history cache and message writer"""
+    global history_cache, message_writer
+    history_cache = histories
+    message_writer = writer
+
+
+def _wait_for_writes(conversation_id):
+    """Let queued chat turns land before a conversation's messages are read or changed"""
+    if message_writer is not None:
+        message_writer.wait_for(conversation_id)
+
+
+def _invalidate_history(conversation_id):
+    """Drop a conversation's cached history after its messages changed"""
+    if history_cache is not None:
+        history_cache.invalidate(conversation_id)
+
+
+def _encode_cursor(timestamp, row_id):
+    """Opaque cursor pointing just past a row in (timestamp, id) order"""
+    raw = json.dumps([timestamp.isoformat(), row_id])
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def _decode_cursor(cursor):
+    """Inverse of _encode_cursor. Raises ValueError on a malformed cursor."""
+    try:
+        updated_at, conversation_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return datetime.fromisoformat(updated_at), int(conversation_id)
+    except Exception as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def _message_counts(conversation_ids):
+    """Message count per conversation, in one aggregate query"""
+    if not conversation_ids:
+        return {}
+    rows = (
+        db.session.query(Message.conversation_id, db.func.count(Message.id))
+        .filter(Message.conversation_id.in_(conversation_ids))
+        .group_by(Message.conversation_id)
+        .all()
+    )
+    return dict(rows)
+
 
 @conversations_bp.route("/conversations", methods=["GET"])
 def list_conversations():
-    """List all conversations, order by most recently updated"""
+    """
+    List conversations, most recently updated first
+
+    Query parameters:
+        limit: Conversations per page (default 50, at most 200)
+        cursor: next_cursor of the previous page
+
+    Pages are found by seeking on (updated_at, id) rather than with an
+    offset, so each page costs the same however long the history is.
+    """
     try: 
-        conversations = Conversation.query.order_by(
-            Conversation.updated_at.desc()
-        ).all()
+        limit = request.args.get("limit", DEFAULT_PAGE_SIZE, type=int)
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+        query = Conversation.query.order_by(
+            Conversation.updated_at.desc(), Conversation.id.desc()
+        )
+
+        cursor = request.args.get("cursor")
+        if cursor:
+            try:
+                updated_at, conversation_id = _decode_cursor(cursor)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            query = query.filter(or_(
+                Conversation.updated_at < updated_at,
+                and_(Conversation.updated_at == updated_at, Conversation.id < conversation_id),
+            ))
+
+        # One extra row tells whether there is a next page
+        conversations = query.limit(limit + 1).all()
+        has_more = len(conversations) > limit
+        conversations = conversations[:limit]
+
+        counts = _message_counts([conv.id for conv in conversations])
         return jsonify({
-            "conversations":[conv.to_dict() for conv in conversations]
+            "conversations": [conv.to_dict(counts.get(conv.id, 0)) for conv in conversations],
+            "next_cursor": (
+                _encode_cursor(conversations[-1].updated_at, conversations[-1].id) if has_more else None
+            ),
         })
     except Exception as e:
         logger.error(f"Error listing conversations: {e}")
         return jsonify({"error": str(e)}), 500
     
+def _fts_query(q):
+    """
+    Turn free text into an FTS5 query in which every word must match. A
+    trailing * makes the last word a prefix. Returns None if q has no words.
+    """
+    words = re.findall(r"\w+", q)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    if q.rstrip().endswith("*"):
+        terms[-1] += "*"
+    return " ".join(terms)
+
+
+@conversations_bp.route("/conversations/search", methods=["GET"])
+def search_conversations():
+    """
+    Full-text search over message contents and conversation titles
+
+    Query parameters:
+        q: Words to search for, "word*" to match a prefix of the last one
+        limit: Results per page (default 20, at most 100)
+        offset: next_offset of the previous page
+
+    Results are ranked by BM25, messages among the newest 5000 that match
+    (MAX_RANKED_MATCHES). Snippets mark matched terms with <mark>
+    tags and are not HTML-escaped.
+    """
+    try:
+        query = _fts_query(request.args.get("q", ""))
+        if query is None:
+            return jsonify({"error": "Missing search text: q"}), 400
+
+        limit = request.args.get("limit", DEFAULT_SEARCH_PAGE_SIZE, type=int)
+        limit = max(1, min(limit, MAX_SEARCH_PAGE_SIZE))
+        offset = max(0, min(request.args.get("offset", 0, type=int), MAX_SEARCH_OFFSET))
+
+        # One extra row tells whether there is a next page
+        ranked = db.session.execute(_SEARCH_RANKED, {
+            "query": query,
+            "depth": offset + limit + 1,
+            "window": MAX_RANKED_MATCHES - 1,
+            "limit": limit + 1,
+            "offset": offset,
+        }).all()
+        has_more = len(ranked) > limit
+        ranked = ranked[:limit]
+
+        markers = {"query": query, "open": SNIPPET_OPEN, "close": SNIPPET_CLOSE}
+        results = []
+        for ranked_row in ranked:
+            if ranked_row.kind == "message":
+                row = db.session.execute(_SEARCH_MESSAGE, {**markers, "id": ranked_row.id}).first()
+                if row is None:
+                    continue
+                result = {
+                    "type": "message",
+                    "conversation_id": row.conversation_id,
+                    "conversation_title": row.title,
+                    "message_id": row.id,
+                    "role": row.role,
+                    "created_at": row.created_at.isoformat(),
+                    "snippet": row.snippet,
+                }
+            else:
+                row = db.session.execute(_SEARCH_CONVERSATION, {**markers, "id": ranked_row.id}).first()
+                if row is None:
+                    continue
+                result = {
+                    "type": "conversation",
+                    "conversation_id": row.id,
+                    "conversation_title": row.title,
+                    "updated_at": row.updated_at.isoformat(),
+                    "snippet": row.snippet,
+                }
+            # bm25() is lower for better matches
+            result["score"] = round(-ranked_row.score, 4)
+            results.append(result)
+
+        next_offset = offset + limit if has_more and offset + limit <= MAX_SEARCH_OFFSET else None
+        return jsonify({"results": results, "next_offset": next_offset})
+    except Exception as e:
+        logger.error(f"Error searching conversations: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
 @conversations_bp.route("/conversations", methods=["POST"])
 def create_conversation():
     """
@@ -49,24 +297,120 @@ def create_conversation():
 @conversations_bp.route("/conversations/<int:conversation_id>", methods=["GET"])
 def get_conversation(conversation_id):
     """
-    Get a specific conversation with all its messages
+    Get a conversation with its messages
+
+    Without limit or cursor all messages are returned, oldest first. With
+    either, one page is returned along with a next_cursor.
+
+    Query parameters:
+        limit: Messages per page (default 100, at most 500)
+        order: "asc" pages forward from the first message, "latest" starts
+            at the newest messages and pages back through older ones
+        cursor: next_cursor of the previous page
+
+    Messages within a page are always oldest first. For long conversations
+    /conversations/<id>/messages/stream reads all messages in constant memory.
     """
 
     try: 
-        conversation = Conversation.query.get_or_404(conversation_id)
+        _wait_for_writes(conversation_id)
+        conversation = Conversation.query.get(conversation_id)
+        if not conversation:
+            return jsonify({"error": "Conversation not found"}), 404
+
+        if "limit" not in request.args and "cursor" not in request.args:
+            rows = db.session.execute(
+                select(*_MESSAGE_COLUMNS)
+                .where(Message.conversation_id == conversation_id)
+                .order_by(Message.created_at.asc(), Message.id.asc())
+            ).all()
+            return jsonify({
+                "conversation": conversation.to_dict(),
+                "messages": [message_to_dict(row) for row in rows],
+            })
+
+        limit = request.args.get("limit", DEFAULT_MESSAGE_PAGE_SIZE, type=int)
+        limit = max(1, min(limit, MAX_MESSAGE_PAGE_SIZE))
+        order = request.args.get("order", "asc")
+        if order not in ("asc", "latest"):
+            return jsonify({"error": "order must be 'asc' or 'latest'"}), 400
+        latest = order == "latest"
+
+        query = select(*_MESSAGE_COLUMNS).where(Message.conversation_id == conversation_id)
 
-        messages = Message.query.filter_by(
-            conversation_id=conversation_id
-        ).order_by(Message.created_at.asc()).all()
+        cursor = request.args.get("cursor")
+        if cursor:
+            try:
+                created_at, message_id = _decode_cursor(cursor)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            if latest:
+                query = query.where(or_(
+                    Message.created_at < created_at,
+                    and_(Message.created_at == created_at, Message.id < message_id),
+                ))
+            else:
+                query = query.where(or_(
+                    Message.created_at > created_at,
+                    and_(Message.created_at == created_at, Message.id > message_id),
+                ))
+
+        if latest:
+            query = query.order_by(Message.created_at.desc(), Message.id.desc())
+        else:
+            query = query.order_by(Message.created_at.asc(), Message.id.asc())
+
+        # One extra row tells whether there is a next page
+        rows = db.session.execute(query.limit(limit + 1)).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        next_cursor = _encode_cursor(rows[-1].created_at, rows[-1].id) if has_more else None
+        if latest:
+            rows.reverse()
 
         return jsonify({
             "conversation": conversation.to_dict(),
-            "messages": [msg.to_dict() for msg in messages]
+            "messages": [message_to_dict(row) for row in rows],
+            "next_cursor": next_cursor,
         })
     except Exception as e:
         logger.error(f"Error gettign conversation: {e}")
         return jsonify({"error": str(e)}), 500
-    
+
+
+@conversations_bp.route("/conversations/<int:conversation_id>/messages/stream", methods=["GET"])
+def stream_messages(conversation_id):
+    """
+    Stream all messages of a conversation as NDJSON, oldest first
+
+    Rows are read from the database in batches while the response is
+    written, so memory use does not grow with the conversation's length.
+    """
+    _wait_for_writes(conversation_id)
+    if not Conversation.query.get(conversation_id):
+        return jsonify({"error": "Conversation not found"}), 404
+
+    query = (
+        select(*_MESSAGE_COLUMNS)
+        .where(Message.conversation_id == conversation_id)
+        .order_by(Message.created_at.asc(), Message.id.asc())
+        .execution_options(yield_per=STREAM_BATCH_SIZE)
+    )
+
+    def generate():
+        try:
+            result = db.session.execute(query)
+            for rows in result.partitions():
+                yield "".join(json.dumps(message_to_dict(row)) + "\n" for row in rows)
+        except Exception as e:
+            logger.error(f"Error streaming messages: {e}")
+            yield json.dumps({"error": str(e)}) + "\n"
+        finally:
+            # Ends the read transaction held open while streaming
+            db.session.rollback()
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
 @conversations_bp.route("/conversation/<int:conversation_id>", methods=["PUT"])
 def update_conversatoin(conversation_id):
     """
@@ -100,13 +444,15 @@ def delete_conversation(conversation_id):
     """
 
     try: 
+        _wait_for_writes(conversation_id)
         conversation = Conversation.query.get_or_404(conversation_id)
         db.session.delete(conversation)
         db.session.commit()
+        _invalidate_history(conversation_id)
         
         return jsonify({"message": "Conversation deleted successfully"})
     except Exception as e:
-        db.sessoin.rollback()
+        db.session.rollback()
         logger.error(f"Error deleting conversation: {e}")
         return jsonify({"error": str(e)}), 500
     
@@ -124,6 +470,7 @@ def add_message(conversation_id):
     """
 
     try: 
+        _wait_for_writes(conversation_id)
         conversation = Conversation.query.get_or_404(conversation_id)
         data = request.get_json()
 
@@ -140,12 +487,13 @@ def add_message(conversation_id):
             message_metadata=message_metadata_str,
         )
 
-        db.sessoin.add(message)
+        db.session.add(message)
 
         #Update conversation's updated_at timestamp
-        conversation.update_at = db.funcc.now()
+        conversation.updated_at = datetime.now(timezone.utc)
 
         db.session.commit()
+        _invalidate_history(conversation_id)
 
         return jsonify(message.to_dict()), 201
     
@@ -161,6 +509,7 @@ def delete_message(conversation_id, message_id):
     """
 
     try:
+        _wait_for_writes(conversation_id)
         message = Message.query.filter_by(
             id=message_id,
             conversation_id=conversation_id,        
@@ -168,6 +517,7 @@ def delete_message(conversation_id, message_id):
 
         db.session.delete(message)
         db.session.commit()
+        _invalidate_history(conversation_id)
 
         return jsonify({"message": "Message deleted successfully"})
     
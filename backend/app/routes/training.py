@@ -0,0 +1,279 @@
+from flask import Blueprint, request, jsonify, Response, stream_with_context
+from datetime import datetime
+from ..services.model_registry import ModelUnavailableError
+from ..services.training_service import CONTENT_TYPES, FILE_EXTENSIONS, ExportInProgressError, read_export
+import logging
+
+logger = logging.getLogger(__name__)
+
+training_bp = Blueprint("training", __name__)
+
+# Seconds an export waits for queued chat turns to be written
+WRITE_FLUSH_TIMEOUT = 10.0
+
+# Initialized by init_training_routes
+training_exporter = None
+message_writer = None
+dataset_jobs = None
+model_registry = None
+
+
+def init_training_routes(exporter, writer=None, jobs=None, registry=None):
+    """Initialize the training routes with the exporter, message writer, dataset jobs and model registry"""
+    global training_exporter, message_writer, dataset_jobs, model_registry
+    training_exporter = exporter
+    message_writer = writer
+    dataset_jobs = jobs
+    model_registry = registry
+
+
+def _flag(value, default=False) -> bool:
+    if value is None:
+        return default
+    if isinstance(value, bool):
+        return value
+    return str(value).lower() in ("1", "true", "yes", "on")
+
+
+def _export_options(source) -> dict:
+    """
+    Export arguments from a JSON body or query string
+
+    Raises:
+        ValueError: An option has an invalid value
+    """
+    options = {
+        "format": source.get("format", "messages"),
+        "compression": source.get("compression") or None,
+        "include_cancelled": _flag(source.get("include_cancelled")),
+    }
+
+    conversation_ids = source.get("conversation_ids")
+    if conversation_ids is not None:
+        if isinstance(conversation_ids, str):
+            conversation_ids = [part for part in conversation_ids.split(",") if part.strip()]
+        try:
+            options["conversation_ids"] = [int(cid) for cid in conversation_ids]
+        except (TypeError, ValueError):
+            raise ValueError("conversation_ids must be a list of integers")
+
+    updated_since = source.get("updated_since")
+    if updated_since:
+        try:
+            options["updated_since"] = datetime.fromisoformat(updated_since)
+        except (TypeError, ValueError):
+            raise ValueError("updated_since must be an ISO 8601 timestamp")
+
+    return options
+
+
+def _valid_name(name: str) -> bool:
+    return name.replace("-", "").replace("_", "").isalnum()
+
+
+def _flush_writes():
+    """Let queued chat turns land so the export includes them"""
+    if message_writer is not None and not message_writer.flush(WRITE_FLUSH_TIMEOUT):
+        logger.warning("Exporting before all queued chat turns were written")
+
+
+@training_bp.route("/training/exports", methods=["POST"])
+def create_export():
+    """
+    Write conversations to JSONL files under EXPORT_DIR
+
+    Body (all optional):
+        name: Export name, also the watermark's name (default "default")
+        incremental: Only messages since the last export of this name
+            (default true)
+        format: "messages" or "chatml"
+        compression: "none", "gzip" or "zstd" (default EXPORT_COMPRESSION)
+        conversation_ids, updated_since, include_cancelled: Filters
+
+    Returns the export's manifest.
+    """
+    if training_exporter is None:
+        return jsonify({"error": "Training export is not available"}), 503
+
+    data = request.get_json(silent=True) or {}
+    name = str(data.get("name") or "default")
+    if not _valid_name(name):
+        return jsonify({"error": "name may only contain letters, digits, - and _"}), 400
+
+    try:
+        options = _export_options(data)
+        _flush_writes()
+        manifest = training_exporter.export(name=name, incremental=_flag(data.get("incremental"), True), **options)
+        return jsonify(manifest), 201
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except ExportInProgressError as e:
+        return jsonify({"error": str(e)}), e.status_code
+    except Exception as e:
+        logger.error(f"Error exporting training data: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@training_bp.route("/training/export", methods=["GET"])
+def stream_export():
+    """
+    Stream conversations as one JSONL download
+
+    Query parameters are the options of POST /training/exports, with
+    incremental off by default. An incremental download moves the
+    watermark only if it is read to the end.
+    """
+    if training_exporter is None:
+        return jsonify({"error": "Training export is not available"}), 503
+
+    name = request.args.get("name")
+    incremental = _flag(request.args.get("incremental"))
+    try:
+        options = _export_options(request.args)
+        compression = options["compression"] or training_exporter.compression
+        options["compression"] = compression
+        if compression not in CONTENT_TYPES:
+            raise ValueError(f"Unknown compression: {compression}")
+        if incremental and not name:
+            raise ValueError("An incremental export needs a name")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    _flush_writes()
+    body = training_exporter.stream(name=name, incremental=incremental, **options)
+    try:
+        # Start the export here, so an invalid option or a running export
+        # gets a proper error response instead of a broken download
+        first = next(body)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except ExportInProgressError as e:
+        return jsonify({"error": str(e)}), e.status_code
+
+    def generate():
+        yield first
+        yield from body
+
+    filename = f"{name or 'conversations'}{FILE_EXTENSIONS[compression]}"
+    return Response(
+        stream_with_context(generate()),
+        mimetype=CONTENT_TYPES[compression],
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
+
+
+@training_bp.route("/training/datasets", methods=["POST"])
+def create_dataset():
+    """
+    Tokenize and pack conversations into a dataset under DATASET_DIR
+
+    Body (all optional):
+        name: Dataset name (default "default")
+        exports: Export directories or files under EXPORT_DIR to read,
+            e.g. ["nightly/20261017-020000-000000"]. Without them all
+            conversations are read from the database, narrowed by the
+            filters of POST /training/exports.
+        model: Model whose tokenizer is used (default DEFAULT_MODEL)
+        n_ctx: Tokens per packed sequence (default N_CTX)
+
+    Packing runs in the background. Returns 202 with the job, whose
+    status URL is in the Location header; once its status is "done" the
+    job holds the dataset's index.
+    """
+    if dataset_jobs is None or training_exporter is None:
+        return jsonify({"error": "Dataset packing is not available"}), 503
+    if model_registry is None:
+        return jsonify({"error": "Models are not available"}), 503
+
+    data = request.get_json(silent=True) or {}
+    name = str(data.get("name") or "default")
+    if not _valid_name(name):
+        return jsonify({"error": "name may only contain letters, digits, - and _"}), 400
+
+    try:
+        model_path = model_registry.path_of(data.get("model"))
+        n_ctx = data.get("n_ctx")
+        if n_ctx is not None and (not isinstance(n_ctx, int) or isinstance(n_ctx, bool) or n_ctx < 2):
+            raise ValueError("n_ctx must be an integer of at least 2")
+
+        exports = data.get("exports")
+        if exports:
+            if not isinstance(exports, list):
+                raise ValueError("exports must be a list of paths")
+            root = training_exporter.output_dir.resolve()
+            paths = []
+            for export in exports:
+                path = (root / str(export)).resolve()
+                if root not in path.parents or not path.exists():
+                    raise ValueError(f"No export at {export}")
+                paths.append(path)
+            records = (record for path in paths for record in read_export(path))
+            sources = [str(path.relative_to(root)) for path in paths]
+        else:
+            options = _export_options(data)
+            if options.pop("compression") or options["format"] != "messages":
+                raise ValueError("Only the filters of an export apply to datasets")
+            del options["format"]
+            _flush_writes()
+            records = training_exporter.records(**options)
+            sources = ["database"]
+
+        job = dataset_jobs.submit(records, model_path, name=name, n_ctx=n_ctx, sources=sources)
+        return jsonify(job), 202, {"Location": f"/api/training/datasets/jobs/{job['id']}"}
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except ModelUnavailableError as e:
+        return jsonify({"error": str(e)}), e.status_code
+    except Exception as e:
+        logger.error(f"Error building training dataset: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@training_bp.route("/training/datasets/jobs", methods=["GET"])
+def list_dataset_jobs():
+    """Dataset jobs, newest first"""
+    if dataset_jobs is None:
+        return jsonify({"error": "Dataset packing is not available"}), 503
+    return jsonify({"jobs": dataset_jobs.list()})
+
+
+@training_bp.route("/training/datasets/jobs/<job_id>", methods=["GET"])
+def get_dataset_job(job_id):
+    """
+    A dataset job's status and progress
+
+    progress counts the conversations tokenized so far and the sequences
+    written; a finished job has the dataset's index or the error.
+    """
+    if dataset_jobs is None:
+        return jsonify({"error": "Dataset packing is not available"}), 503
+    job = dataset_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
+
+
+@training_bp.route("/training/watermarks", methods=["GET"])
+def list_watermarks():
+    """Incremental exports and how far each has got"""
+    if training_exporter is None:
+        return jsonify({"error": "Training export is not available"}), 503
+    try:
+        return jsonify({"watermarks": training_exporter.list_watermarks()})
+    except Exception as e:
+        logger.error(f"Error listing export watermarks: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@training_bp.route("/training/watermarks/<name>", methods=["DELETE"])
+def reset_watermark(name):
+    """Start the next export of this name from the beginning"""
+    if training_exporter is None:
+        return jsonify({"error": "Training export is not available"}), 503
+    try:
+        if not training_exporter.reset_watermark(name):
+            return jsonify({"error": "Watermark not found"}), 404
+        return jsonify({"message": "Watermark reset"})
+    except Exception as e:
+        logger.error(f"Error resetting export watermark {name}: {e}")
+        return jsonify({"error": str(e)}), 500
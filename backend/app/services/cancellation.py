@@ -0,0 +1,49 @@
+from typing import Dict, Optional
+import threading
+
+
+class CancellationRegistry:
+    """
+    Cancel events of in-flight generation requests, keyed by request id
+
+    The request thread registers an event and hands it to the LLM service,
+    which stops generating as soon as the event is set. Any other thread (an
+    explicit cancel call, or the stream noticing its client is gone) can set
+    it by request id.
+    """
+
+    def __init__(self):
+        self._events: Dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+
+    def register(self, request_id: str) -> Optional[threading.Event]:
+        """
+        Start tracking a request
+
+        Returns:
+            The request's cancel event, or None if the id is already in use
+        """
+        with self._lock:
+            if request_id in self._events:
+                return None
+            event = threading.Event()
+            self._events[request_id] = event
+            return event
+
+    def cancel(self, request_id: str) -> bool:
+        """Signal a request to stop. Returns False if it is not in flight."""
+        with self._lock:
+            event = self._events.get(request_id)
+        if event is None:
+            return False
+        event.set()
+        return True
+
+    def unregister(self, request_id: str):
+        """Stop tracking a finished request"""
+        with self._lock:
+            self._events.pop(request_id, None)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._events)
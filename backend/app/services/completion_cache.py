@@ -0,0 +1,174 @@
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional
+from sqlalchemy import delete, func, select
+import hashlib
+import json
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Prune the disk tier once every this many writes
+_PRUNE_EVERY = 100
+
+
+def model_fingerprint(model_path) -> str:
+    """Identify a model file by name, size and modification time"""
+    path = Path(model_path)
+    try:
+        stat = path.stat()
+        return f"{path.name}:{stat.st_size}:{int(stat.st_mtime)}"
+    except OSError:
+        return path.name
+
+
+class CompletionCache:
+    """
+    Two-tier cache of deterministic completions
+
+    Entries are keyed on the formatted prompt, the model file and the sampling
+    parameters. Only greedy (temperature 0) requests are cached since any
+    other setting may legitimately return a different answer each time.
+    The memory tier is an LRU; the disk tier is a table in the application's
+    SQLite database, so entries survive restarts.
+    """
+
+    def __init__(
+        self,
+        engine=None,
+        table=None,
+        max_entries: int = 1024,
+        max_disk_entries: int = 10000,
+        ttl: float = 86400,
+    ):
+        """
+        Args:
+            engine: SQLAlchemy engine for the disk tier (None = memory only)
+            table: Table holding the disk tier (CompletionCacheEntry.__table__)
+            max_entries: Entries kept in memory
+            max_disk_entries: Entries kept on disk
+            ttl: Seconds an entry stays valid (0 = no expiry)
+        """
+        self.engine = engine
+        self.table = table
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl = ttl
+
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    @staticmethod
+    def is_deterministic(temperature: float) -> bool:
+        """Whether a request with these sampling settings is cacheable"""
+        return temperature is not None and float(temperature) <= 0
+
+    @staticmethod
+    def make_key(prompt: str, model: str, params: Dict[str, Any]) -> str:
+        """Hash of everything that determines a greedy completion"""
+        payload = json.dumps(
+            {"prompt": prompt, "model": model, "params": params},
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _expired(self, created_at: float) -> bool:
+        return self.ttl > 0 and time.time() - created_at > self.ttl
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Look up a completion, promoting disk hits to memory"""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created_at, value = entry
+                if not self._expired(created_at):
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return value
+                del self._memory[key]
+
+        if self.engine is not None:
+            try:
+                with self.engine.connect() as conn:
+                    row = conn.execute(
+                        select(self.table.c.response, self.table.c.created_at)
+                        .where(self.table.c.key == key)
+                    ).first()
+            except Exception as e:
+                logger.warning(f"Completion cache read failed: {e}")
+                row = None
+
+            if row is not None and not self._expired(row.created_at):
+                value = json.loads(row.response)
+                with self._lock:
+                    self.disk_hits += 1
+                    self._remember(key, row.created_at, value)
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, value: Dict[str, Any]):
+        """Store a completion in both tiers"""
+        created_at = time.time()
+        with self._lock:
+            self.stores += 1
+            self._remember(key, created_at, value)
+            self._writes += 1
+            prune = self._writes % _PRUNE_EVERY == 0
+
+        if self.engine is None:
+            return
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(delete(self.table).where(self.table.c.key == key))
+                conn.execute(
+                    self.table.insert().values(
+                        key=key, response=json.dumps(value), created_at=created_at
+                    )
+                )
+                if prune:
+                    self._prune(conn)
+        except Exception as e:
+            logger.warning(f"Completion cache write failed: {e}")
+
+    def _remember(self, key: str, created_at: float, value: Dict[str, Any]):
+        """Insert into the memory tier (lock held)"""
+        self._memory[key] = (created_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _prune(self, conn):
+        """Drop expired entries and the oldest ones over the disk limit"""
+        if self.ttl > 0:
+            conn.execute(delete(self.table).where(self.table.c.created_at < time.time() - self.ttl))
+
+        count = conn.execute(select(func.count()).select_from(self.table)).scalar()
+        excess = count - self.max_disk_entries
+        if excess > 0:
+            oldest = select(self.table.c.key).order_by(self.table.c.created_at.asc()).limit(excess)
+            conn.execute(delete(self.table).where(self.table.c.key.in_(oldest)))
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters"""
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_entries": len(self._memory),
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 3) if lookups else 0.0,
+            }
@@ -0,0 +1,165 @@
+from typing import Generator, Dict, Any, List
+from .llm_service import LLMService, ASSISTANT_HEADER, PREFILL_CHUNK_TOKENS
+import hashlib
+import time
+import zlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+_REPLY_WORDS = [
+    "Sure", "here", "is", "a", "deterministic", "reply", "from", "the",
+    "fake", "backend", "that", "stands", "in", "for", "a", "real", "model",
+]
+
+
+class FakeLLMService(LLMService):
+    """
+    Deterministic stand-in for LLMService that never loads a model
+
+    The reply depends only on the prompt and max_tokens, so identical requests
+    always get identical answers. Latency is simulated per prompt token and per
+    generated token, which lets the serving stack be exercised on machines
+    without a GGUF model or GPU. Like llama.cpp, prompt tokens shared with the
+    previous request's prompt are not evaluated again.
+    """
+
+    def __init__(
+        self,
+        model_path: str = "fake.gguf",
+        n_ctx: int = 2048,
+        n_gpu_layers: int = 0,
+        n_threads: int = 1,
+        kv_cache_max_bytes: int = 0,
+        context_reserve_tokens: int = 0,
+        token_cache_max_tokens: int = 2_000_000,
+        prompt_ms_per_token: float = 0.0,
+        token_ms: float = 0.0,
+        snapshot_dir: str | None = None,
+        snapshot_prompts: tuple = (),
+        speculative: str = "",
+        draft_tokens: int = 10,
+        lookup_ngram_size: int = 2,
+        draft_model_path: str | None = None,
+    ):
+        """
+        Args:
+            model_path: Reported model path, nothing is read from it
+            n_ctx: Context window size
+            n_gpu_layers: Ignored
+            n_threads: Ignored
+            kv_cache_max_bytes: Ignored, there is no KV state to save
+            context_reserve_tokens: See LLMService
+            token_cache_max_tokens: See LLMService
+            prompt_ms_per_token: Simulated prompt evaluation time per token
+            token_ms: Simulated generation time per token
+            snapshot_dir: Ignored, there is no KV state to snapshot
+            snapshot_prompts: Ignored
+            speculative: Ignored, generation is simulated
+            draft_tokens: Ignored
+            lookup_ngram_size: Ignored
+            draft_model_path: Ignored
+        """
+        self.prompt_ms_per_token = prompt_ms_per_token
+        self.token_ms = token_ms
+        # Stands in for the token ids in llama.cpp's context
+        self._context: List[int] = []
+        super().__init__(
+            model_path=model_path,
+            n_ctx=n_ctx,
+            n_gpu_layers=n_gpu_layers,
+            n_threads=n_threads,
+            context_reserve_tokens=context_reserve_tokens,
+            token_cache_max_tokens=token_cache_max_tokens,
+        )
+
+    def _load_model(self):
+        """Nothing to load"""
+        # Placeholder so "model loaded" checks pass
+        self.llm = object()
+        self._header_tokens = self._tokenize(ASSISTANT_HEADER)
+        logger.info("Fake model loaded")
+
+    def _tokenize(self, text: str) -> List[int]:
+        """Whitespace-separated words stand in for tokens"""
+        return [zlib.crc32(word.encode("utf-8")) & 0x7FFFFFFF for word in text.split()]
+
+    def _reply_tokens(self, prompt: str | List[int], max_tokens: int) -> list:
+        """Deterministic list of reply tokens for a prompt"""
+        digest = hashlib.sha256(str(prompt).encode("utf-8")).digest()
+        length = min(max_tokens, 16 + digest[0] % 48)
+        offset = digest[1]
+        return [
+            _REPLY_WORDS[(offset + i) % len(_REPLY_WORDS)] + " " for i in range(length)
+        ]
+
+    def generate(
+        self,
+        prompt: str | List[int],
+        max_tokens: int = 512,
+        temperature: float = 0.7,
+        top_p: float = 0.9,
+        top_k: int = 40,
+        stop: list = None,
+        stream: bool = False,
+        cancel_event=None,
+        perf: Dict[str, Any] = None,
+    ) -> Dict[str, Any] | Generator:
+        """Generate a deterministic reply, see LLMService.generate"""
+        if self.llm is None:
+            raise RuntimeError("Model not loaded")
+
+        prompt_tokens = len(prompt) if isinstance(prompt, list) else self._count_tokens(prompt)
+        prefix_tokens = self._prefix_match(prompt)
+        # The reply is not tracked, so the next prompt matches up to here
+        self._context = list(prompt) if isinstance(prompt, list) else []
+        tokens = self._reply_tokens(prompt, max_tokens)
+
+        # Timed the same way as a real llama.cpp stream
+        stream_tokens = self._stream_generator(
+            self._fake_stream(prompt_tokens - prefix_tokens, tokens, cancel_event),
+            perf,
+            prompt_tokens,
+            prefix_tokens,
+        )
+        if stream:
+            return stream_tokens
+
+        generated = list(stream_tokens)
+        return {
+            "text": "".join(generated),
+            "tokens_used": prompt_tokens + len(generated),
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(generated),
+        }
+
+    def _prefix_match(self, prompt: str | List[int]) -> int:
+        """Leading prompt tokens shared with the simulated context"""
+        if not isinstance(prompt, list):
+            return 0
+        matched = 0
+        for cached, token in zip(self._context, prompt):
+            if cached != token:
+                break
+            matched += 1
+        return matched
+
+    def _eval_prompt(self, prompt: List[int], start: int, cancel_event=None) -> int:
+        """Simulate evaluating prompt[start:] in chunks, see LLMService._eval_prompt"""
+        self._context = self._context[:start]
+        for i in range(start, len(prompt), PREFILL_CHUNK_TOKENS):
+            if cancel_event is not None and cancel_event.is_set():
+                break
+            chunk = prompt[i:i + PREFILL_CHUNK_TOKENS]
+            time.sleep(len(chunk) * self.prompt_ms_per_token / 1000)
+            self._context.extend(chunk)
+        return len(self._context) - start
+
+    def _fake_stream(self, prompt_tokens: int, tokens: list, cancel_event=None) -> Generator:
+        """Yield reply tokens as llama.cpp stream chunks, with simulated timing"""
+        time.sleep(prompt_tokens * self.prompt_ms_per_token / 1000)
+        for token in tokens:
+            if cancel_event is not None and cancel_event.is_set():
+                return
+            time.sleep(self.token_ms / 1000)
+            yield {"choices": [{"text": token}]}
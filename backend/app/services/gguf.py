@@ -0,0 +1,149 @@
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Optional
+import struct
+
+GGUF_MAGIC = b"GGUF"
+
+# Metadata value types of the GGUF format
+_UINT8, _INT8, _UINT16, _INT16, _UINT32, _INT32, _FLOAT32, _BOOL, _STRING, _ARRAY, _UINT64, _INT64, _FLOAT64 = range(13)
+
+_SCALARS = {
+    _UINT8: "<B",
+    _INT8: "<b",
+    _UINT16: "<H",
+    _INT16: "<h",
+    _UINT32: "<I",
+    _INT32: "<i",
+    _FLOAT32: "<f",
+    _BOOL: "<?",
+    _UINT64: "<Q",
+    _INT64: "<q",
+    _FLOAT64: "<d",
+}
+
+# llama.cpp file types (general.file_type), for display
+FILE_TYPES = {
+    0: "F32", 1: "F16", 2: "Q4_0", 3: "Q4_1", 7: "Q8_0", 8: "Q5_0", 9: "Q5_1",
+    10: "Q2_K", 11: "Q3_K_S", 12: "Q3_K_M", 13: "Q3_K_L", 14: "Q4_K_S", 15: "Q4_K_M",
+    16: "Q5_K_S", 17: "Q5_K_M", 18: "Q6_K", 19: "IQ2_XXS", 20: "IQ2_XS", 21: "Q2_K_S",
+    22: "IQ3_XS", 23: "IQ3_XXS", 24: "IQ1_S", 25: "IQ4_NL", 26: "IQ3_S", 27: "IQ3_M",
+    28: "IQ2_S", 29: "IQ2_M", 30: "IQ4_XS", 31: "IQ1_M", 32: "BF16",
+}
+
+
+class GGUFError(ValueError):
+    """The file is not a GGUF model this reader understands"""
+
+
+def _read(f: BinaryIO, fmt: str):
+    size = struct.calcsize(fmt)
+    data = f.read(size)
+    if len(data) != size:
+        raise GGUFError("Unexpected end of file in GGUF header")
+    return struct.unpack(fmt, data)[0]
+
+
+def _read_string(f: BinaryIO, length_fmt: str) -> str:
+    length = _read(f, length_fmt)
+    data = f.read(length)
+    if len(data) != length:
+        raise GGUFError("Unexpected end of file in GGUF header")
+    return data.decode("utf-8", errors="replace")
+
+
+def _read_value(f: BinaryIO, value_type: int, length_fmt: str):
+    """Read one metadata value. Arrays are skipped and reported by length."""
+    if value_type in _SCALARS:
+        return _read(f, _SCALARS[value_type])
+    if value_type == _STRING:
+        return _read_string(f, length_fmt)
+    if value_type == _ARRAY:
+        item_type = _read(f, "<I")
+        count = _read(f, length_fmt)
+        # Arrays are the tokenizer vocab and merges; nothing we display, so
+        # skip them without decoding
+        if item_type in _SCALARS:
+            f.seek(count * struct.calcsize(_SCALARS[item_type]), 1)
+        else:
+            for _ in range(count):
+                _read_value(f, item_type, length_fmt)
+        return {"array_length": count}
+    raise GGUFError(f"Unknown GGUF metadata type {value_type}")
+
+
+def read_gguf_metadata(path: str | Path) -> Dict[str, Any]:
+    """
+    Read the key/value metadata of a GGUF file without loading its weights
+
+    Only the header is read; tensor data is never touched, so this is cheap
+    even for multi-gigabyte models.
+
+    Args:
+        path: Path to a .gguf file
+
+    Returns:
+        Dict of metadata keys to values, plus "gguf.version" and
+        "gguf.tensor_count"
+
+    Raises:
+        GGUFError: If the file is not a supported GGUF file
+    """
+    with open(path, "rb") as f:
+        if f.read(4) != GGUF_MAGIC:
+            raise GGUFError(f"{path} is not a GGUF file")
+        version = _read(f, "<I")
+        if version not in (1, 2, 3):
+            raise GGUFError(f"Unsupported GGUF version {version}")
+        # Version 1 used 32-bit counts and string lengths
+        length_fmt = "<I" if version == 1 else "<Q"
+        tensor_count = _read(f, length_fmt)
+        kv_count = _read(f, length_fmt)
+
+        metadata: Dict[str, Any] = {"gguf.version": version, "gguf.tensor_count": tensor_count}
+        for _ in range(kv_count):
+            key = _read_string(f, length_fmt)
+            value_type = _read(f, "<I")
+            metadata[key] = _read_value(f, value_type, length_fmt)
+    return metadata
+
+
+def read_vocab_size(path: str | Path) -> Optional[int]:
+    """
+    Number of tokens in a GGUF model's vocabulary, from its header
+
+    Returns:
+        The length of tokenizer.ggml.tokens, None if the file has none
+    """
+    tokens = read_gguf_metadata(path).get("tokenizer.ggml.tokens")
+    return tokens["array_length"] if isinstance(tokens, dict) else None
+
+
+def describe_model(path: str | Path) -> Dict[str, Any]:
+    """
+    Summarize a GGUF model for listing and memory estimates
+
+    Returns:
+        Dict with name, architecture, context_length, file_type, size_bytes
+        and the dimensions needed to size the KV cache (block_count,
+        embedding_length, head_count, head_count_kv; None when absent)
+    """
+    path = Path(path)
+    metadata = read_gguf_metadata(path)
+    arch = metadata.get("general.architecture")
+
+    def arch_value(key):
+        return metadata.get(f"{arch}.{key}") if arch else None
+
+    file_type = metadata.get("general.file_type")
+    return {
+        "name": metadata.get("general.name") or path.stem,
+        "architecture": arch,
+        "context_length": arch_value("context_length"),
+        "file_type": FILE_TYPES.get(file_type, file_type),
+        "size_label": metadata.get("general.size_label"),
+        "size_bytes": path.stat().st_size,
+        "block_count": arch_value("block_count"),
+        "embedding_length": arch_value("embedding_length"),
+        "head_count": arch_value("attention.head_count"),
+        "head_count_kv": arch_value("attention.head_count_kv") or arch_value("attention.head_count"),
+    }
@@ -0,0 +1,76 @@
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List
+import threading
+
+
+class ConversationHistoryCache:
+    """
+    LRU of recently active conversations' message histories
+
+    Lets clients send only the new turn: the server rebuilds the prompt from
+    the stored history, and for conversations in active use that history is
+    served from memory instead of being re-read from the messages table on
+    every turn. Cached lists are never mutated in place, so a list handed out
+    by get() stays valid while it is used to build a prompt.
+    """
+
+    def __init__(self, max_conversations: int = 256):
+        """
+        Args:
+            max_conversations: Number of conversation histories kept in memory
+        """
+        self.max_conversations = max_conversations
+        self._histories: "OrderedDict[Hashable, List[Dict[str, str]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, conversation_id: Hashable, loader: Callable[[], List[Dict[str, str]]]) -> List[Dict[str, str]]:
+        """
+        Return the history of a conversation, loading it on a miss
+
+        Args:
+            conversation_id: Conversation to look up
+            loader: Reads the history from the database
+        """
+        with self._lock:
+            history = self._histories.get(conversation_id)
+            if history is not None:
+                self._histories.move_to_end(conversation_id)
+                self.hits += 1
+                return history
+            self.misses += 1
+
+        history = loader()
+        with self._lock:
+            self._store(conversation_id, history)
+        return history
+
+    def append(self, conversation_id: Hashable, messages: List[Dict[str, str]]):
+        """Add newly saved messages to a cached history (no-op if not cached)"""
+        with self._lock:
+            history = self._histories.get(conversation_id)
+            if history is not None:
+                self._store(conversation_id, history + messages)
+
+    def invalidate(self, conversation_id: Hashable):
+        """Forget a conversation, e.g. after its messages were edited"""
+        with self._lock:
+            self._histories.pop(conversation_id, None)
+
+    def _store(self, conversation_id: Hashable, history: List[Dict[str, str]]):
+        """Insert a history (lock held)"""
+        self._histories[conversation_id] = history
+        self._histories.move_to_end(conversation_id)
+        while len(self._histories) > self.max_conversations:
+            self._histories.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "conversations": len(self._histories),
+                "max_conversations": self.max_conversations,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
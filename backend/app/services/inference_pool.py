@@ -0,0 +1,526 @@
+from collections import OrderedDict
+from typing import Generator, Dict, Any, Hashable, List, Optional
+import multiprocessing
+import os
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Conversation -> worker assignments remembered for affinity routing
+MAX_AFFINITY_ENTRIES = 4096
+
+# Seconds between checks for a cancel while waiting on a worker
+CANCEL_POLL_INTERVAL = 0.05
+
+
+def create_llm_service(backend: str = "llama", **service_kwargs):
+    """
+    Build an LLM service for the configured backend
+
+    Args:
+        backend: "llama" for llama.cpp, "fake" for the deterministic test backend
+        **service_kwargs: Passed to the service constructor
+    """
+    if backend == "fake":
+        from .fake_llm_service import FakeLLMService
+
+        return FakeLLMService(**service_kwargs)
+    if backend == "llama":
+        from .llm_service import LLMService
+
+        return LLMService(**service_kwargs)
+    raise ValueError(f"Unknown LLM backend: {backend}")
+
+
+def _worker_main(conn, cancel_event, backend: str, service_kwargs: Dict[str, Any]):
+    """
+    Entry point of a worker process
+
+    Protocol (parent -> worker): ("chat", kwargs), ("prefill", kwargs),
+    ("warmup", prompt), ("ping", None), ("stop", None)
+    Protocol (worker -> parent): ("ready", info), ("chunk", text),
+    ("done", perf), ("result", (dict, perf)), ("prefilled", dict),
+    ("warm", ms), ("pong", None), ("error", message)
+    """
+    try:
+        service = create_llm_service(backend, **service_kwargs)
+    except Exception as e:
+        conn.send(("error", f"Failed to load model: {e}"))
+        return
+    conn.send(("ready", {"pid": os.getpid()}))
+
+    while True:
+        try:
+            kind, payload = conn.recv()
+        except (EOFError, OSError):
+            break
+
+        if kind == "stop":
+            break
+        if kind == "ping":
+            conn.send(("pong", None))
+            continue
+        if kind == "warmup":
+            try:
+                conn.send(("warm", service.warmup(payload)))
+            except Exception as e:
+                conn.send(("error", str(e)))
+            continue
+        if kind == "prefill":
+            try:
+                payload["cancel_event"] = cancel_event
+                conn.send(("prefilled", service.prefill(**payload)))
+            except Exception as e:
+                conn.send(("error", str(e)))
+            continue
+        if kind != "chat":
+            conn.send(("error", f"Unknown request: {kind}"))
+            continue
+
+        try:
+            # The shared event lets the parent stop generation mid-request
+            payload["cancel_event"] = cancel_event
+            perf = {}
+            payload["perf"] = perf
+            if payload.get("stream"):
+                stream = service.chat(**payload)
+                for chunk in stream:
+                    if cancel_event.is_set():
+                        stream.close()
+                        break
+                    conn.send(("chunk", chunk))
+                conn.send(("done", perf))
+            else:
+                result = service.chat(**payload)
+                conn.send(("result", (result, perf)))
+        except Exception as e:
+            conn.send(("error", str(e)))
+
+
+class WorkerCrashedError(RuntimeError):
+    """A worker process died while serving a request"""
+
+
+class _Worker:
+    """Parent-side handle of one worker process"""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.process = None
+        self.conn = None
+        self.cancel_event = None
+        self.healthy = False
+        self.busy = False
+        self.served = 0
+        self.restarts = 0
+        self.last_error: Optional[str] = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "index": self.index,
+            "pid": self.process.pid if self.process else None,
+            "healthy": self.healthy,
+            "busy": self.busy,
+            "served": self.served,
+            "restarts": self.restarts,
+            "last_error": self.last_error,
+        }
+
+
+class InferencePool:
+    """
+    Pool of LLM workers running in separate processes
+
+    Each worker owns its own model instance and a share of the CPU threads,
+    so several generations can run at once. Requests for a conversation are
+    routed to the worker that served it last, where its KV cache still holds
+    the history, and otherwise to the least loaded worker. Crashed workers
+    are restarted by a monitor thread.
+
+    The pool exposes the same chat() interface as LLMService, so the routes
+    don't need to know which one they are talking to.
+    """
+
+    def __init__(
+        self,
+        num_workers: int,
+        backend: str = "llama",
+        service_kwargs: Optional[Dict[str, Any]] = None,
+        health_interval: float = 5.0,
+        start_timeout: float = 600.0,
+    ):
+        """
+        Args:
+            num_workers: Number of worker processes
+            backend: Backend passed to create_llm_service in each worker
+            service_kwargs: Constructor arguments for each worker's service
+            health_interval: Seconds between worker health checks
+            start_timeout: Seconds to wait for a worker to load its model
+        """
+        self.num_workers = num_workers
+        self.backend = backend
+        self.service_kwargs = dict(service_kwargs or {})
+        self.model_path = self.service_kwargs.get("model_path")
+        self.health_interval = health_interval
+        self.start_timeout = start_timeout
+        # Replayed on workers that are restarted after warmup()
+        self.warmup_prompt: Optional[str] = None
+
+        # Each worker keeps its own KV pool, token cache and prompt snapshots;
+        # there are none on the parent side
+        self.kv_pool = None
+        self.token_cache = None
+        self.snapshots = None
+
+        # Spawn so workers don't inherit the parent's threads or GPU context
+        self._mp = multiprocessing.get_context("spawn")
+        self._workers: List[_Worker] = [_Worker(i) for i in range(num_workers)]
+        self._affinity: "OrderedDict[Hashable, int]" = OrderedDict()
+        # Worker holding the last prefill of a chat without a conversation id
+        self._prefilled: Optional[int] = None
+        # Idle workers are handed out round-robin, starting here
+        self._next_worker = 0
+        self._cond = threading.Condition()
+        self._closed = False
+
+        for worker in self._workers:
+            self._start_worker(worker)
+        if not any(w.healthy for w in self._workers):
+            self.shutdown()
+            raise RuntimeError("No inference worker could be started")
+
+        self._monitor = threading.Thread(target=self._monitor_loop, name="inference-pool-monitor", daemon=True)
+        self._monitor.start()
+
+    @property
+    def llm(self):
+        """Truthy while at least one worker is up, mirrors LLMService.llm"""
+        return True if any(w.healthy for w in self._workers) else None
+
+    def _start_worker(self, worker: _Worker):
+        """(Re)start a worker process and wait for its model to load"""
+        parent_conn, child_conn = self._mp.Pipe()
+        worker.cancel_event = self._mp.Event()
+        worker.process = self._mp.Process(
+            target=_worker_main,
+            args=(child_conn, worker.cancel_event, self.backend, self.service_kwargs),
+            name=f"inference-worker-{worker.index}",
+            daemon=True,
+        )
+        worker.process.start()
+        child_conn.close()
+        worker.conn = parent_conn
+
+        if parent_conn.poll(self.start_timeout):
+            try:
+                kind, payload = parent_conn.recv()
+            except (EOFError, OSError):
+                kind, payload = "error", "worker exited during startup"
+        else:
+            kind, payload = "error", "timed out loading model"
+
+        if kind == "ready":
+            worker.healthy = True
+            worker.last_error = None
+            logger.info(f"Inference worker {worker.index} ready (pid {payload['pid']})")
+            if self.warmup_prompt:
+                self._warm_worker(worker)
+        else:
+            worker.healthy = False
+            worker.last_error = payload
+            logger.error(f"Inference worker {worker.index} failed to start: {payload}")
+            self._stop_process(worker)
+
+    def _stop_process(self, worker: _Worker):
+        if worker.process is not None and worker.process.is_alive():
+            worker.process.terminate()
+            worker.process.join(timeout=5)
+        if worker.conn is not None:
+            worker.conn.close()
+
+    def _monitor_loop(self):
+        """Restart dead workers and ping idle ones"""
+        while not self._closed:
+            time.sleep(self.health_interval)
+            for worker in self._workers:
+                with self._cond:
+                    if worker.busy or self._closed:
+                        continue
+                    # Hold the worker while checking it so no request is routed to it
+                    worker.busy = True
+
+                try:
+                    if worker.healthy and not self._ping(worker):
+                        worker.healthy = False
+                        logger.error(f"Inference worker {worker.index} is unresponsive")
+                    if not worker.healthy:
+                        self._stop_process(worker)
+                        worker.restarts += 1
+                        logger.info(f"Restarting inference worker {worker.index}")
+                        self._start_worker(worker)
+                finally:
+                    with self._cond:
+                        worker.busy = False
+                        self._cond.notify_all()
+
+    def _warm_worker(self, worker: _Worker) -> Optional[float]:
+        """Run the warmup prompt on a worker. Failures are logged, not raised."""
+        try:
+            worker.conn.send(("warmup", self.warmup_prompt))
+            if worker.conn.poll(self.start_timeout):
+                kind, payload = worker.conn.recv()
+                if kind == "warm":
+                    return payload
+                logger.warning(f"Warmup failed on inference worker {worker.index}: {payload}")
+            else:
+                logger.warning(f"Warmup timed out on inference worker {worker.index}")
+        except (EOFError, OSError) as e:
+            logger.warning(f"Warmup failed on inference worker {worker.index}: {e}")
+        return None
+
+    def warmup(self, system_prompt: str) -> float:
+        """
+        Warm every worker with a system prompt, see LLMService.warmup
+
+        Returns:
+            Time taken in milliseconds (workers are warmed one at a time)
+        """
+        started = time.perf_counter()
+        self.warmup_prompt = system_prompt
+        for worker in self._workers:
+            with self._cond:
+                self._cond.wait_for(lambda: not worker.busy or self._closed)
+                if self._closed or not worker.healthy:
+                    continue
+                worker.busy = True
+            try:
+                self._warm_worker(worker)
+            finally:
+                with self._cond:
+                    worker.busy = False
+                    self._cond.notify_all()
+        return (time.perf_counter() - started) * 1000
+
+    def _ping(self, worker: _Worker, timeout: float = 10.0) -> bool:
+        try:
+            if not worker.process.is_alive():
+                return False
+            worker.conn.send(("ping", None))
+            if not worker.conn.poll(timeout):
+                return False
+            kind, _ = worker.conn.recv()
+            return kind == "pong"
+        except (EOFError, OSError):
+            return False
+
+    def _checkout(self, conversation_id: Optional[Hashable]) -> _Worker:
+        """Reserve a worker, preferring the one that last served the conversation"""
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError("Inference pool is shut down")
+
+                for w in self._workers:
+                    if w.healthy and not w.busy and not w.process.is_alive():
+                        # Died while idle; the monitor thread will restart it
+                        w.healthy = False
+                        w.last_error = "worker process exited"
+                idle = [w for w in self._workers if w.healthy and not w.busy]
+                if idle:
+                    worker = None
+                    if conversation_id is not None and conversation_id in self._affinity:
+                        preferred = self._workers[self._affinity[conversation_id]]
+                        if preferred in idle:
+                            worker = preferred
+                    elif self._prefilled is not None:
+                        # A new chat, or a conversation created just before
+                        # its first turn, continues the prompt prefilled
+                        # without an id; checkin records the affinity
+                        preferred = self._workers[self._prefilled]
+                        self._prefilled = None
+                        if preferred in idle:
+                            worker = preferred
+                    if worker is None:
+                        # Every idle worker has the same load (none), so
+                        # rotate; a lifetime count would starve old workers
+                        # and flood restarted ones
+                        worker = min(idle, key=lambda w: (w.index - self._next_worker) % len(self._workers))
+                    self._next_worker = (worker.index + 1) % len(self._workers)
+                    worker.busy = True
+                    return worker
+
+                if not any(w.healthy for w in self._workers):
+                    raise RuntimeError("No healthy inference workers")
+                self._cond.wait()
+
+    def _checkin(self, worker: _Worker, conversation_id: Optional[Hashable], crashed: bool = False):
+        """Return a worker to the pool after a request"""
+        with self._cond:
+            worker.busy = False
+            worker.served += 1
+            if crashed:
+                worker.healthy = False
+            elif conversation_id is not None:
+                self._affinity[conversation_id] = worker.index
+                self._affinity.move_to_end(conversation_id)
+                while len(self._affinity) > MAX_AFFINITY_ENTRIES:
+                    self._affinity.popitem(last=False)
+            self._cond.notify_all()
+
+    def chat(
+        self,
+        messages: list,
+        max_tokens: int = 512,
+        temperature: float = 0.7,
+        stream: bool = False,
+        conversation_id: Optional[Hashable] = None,
+        cancel_event=None,
+        perf: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any] | Generator:
+        """Run a chat completion on a worker, see LLMService.chat"""
+        request = {
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "stream": stream,
+            "conversation_id": conversation_id,
+        }
+        if stream:
+            # The stream reserves its worker when it starts, so one that is
+            # never iterated does not keep a worker busy
+            return self._stream(request, cancel_event, perf)
+
+        worker = self._checkout(conversation_id)
+        crashed = False
+        try:
+            worker.conn.send(("chat", request))
+            # Relay a cancel from this process to the worker while waiting
+            while not worker.conn.poll(CANCEL_POLL_INTERVAL):
+                if cancel_event is not None and cancel_event.is_set():
+                    worker.cancel_event.set()
+            kind, payload = worker.conn.recv()
+        except (EOFError, OSError) as e:
+            crashed = True
+            raise WorkerCrashedError(f"Inference worker {worker.index} crashed") from e
+        finally:
+            worker.cancel_event.clear()
+            self._checkin(worker, conversation_id, crashed)
+
+        if kind == "error":
+            raise RuntimeError(payload)
+        result, worker_perf = payload
+        if perf is not None:
+            perf.update(worker_perf)
+        return result
+
+    def prefill(
+        self,
+        messages: list,
+        max_tokens: int = 512,
+        conversation_id: Optional[Hashable] = None,
+        cancel_event=None,
+    ) -> Dict[str, Any]:
+        """Prefill the KV cache of a worker, see LLMService.prefill"""
+        request = {
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "conversation_id": conversation_id,
+        }
+        # The conversation's next chat goes to the same worker
+        worker = self._checkout(conversation_id)
+        crashed = False
+        try:
+            worker.conn.send(("prefill", request))
+            while not worker.conn.poll(0.01):
+                if cancel_event is not None and cancel_event.is_set():
+                    worker.cancel_event.set()
+            kind, payload = worker.conn.recv()
+        except (EOFError, OSError) as e:
+            crashed = True
+            raise WorkerCrashedError(f"Inference worker {worker.index} crashed") from e
+        finally:
+            worker.cancel_event.clear()
+            self._checkin(worker, conversation_id, crashed)
+            if conversation_id is None and not crashed:
+                with self._cond:
+                    self._prefilled = worker.index
+
+        if kind == "error":
+            raise RuntimeError(payload)
+        return payload
+
+    def _stream(
+        self,
+        request: Dict[str, Any],
+        cancel_event=None,
+        perf: Optional[Dict[str, Any]] = None,
+    ) -> Generator:
+        """Relay streamed chunks from a worker"""
+        conversation_id = request["conversation_id"]
+        worker = self._checkout(conversation_id)
+        finished = False
+        crashed = False
+        try:
+            worker.conn.send(("chat", request))
+            while True:
+                # Wait with a timeout, so a cancel also reaches the worker
+                # while it evaluates the prompt and sends nothing
+                while not worker.conn.poll(CANCEL_POLL_INTERVAL):
+                    if cancel_event is not None and cancel_event.is_set():
+                        worker.cancel_event.set()
+                if cancel_event is not None and cancel_event.is_set():
+                    worker.cancel_event.set()
+                kind, payload = worker.conn.recv()
+                if kind == "chunk":
+                    yield payload
+                elif kind == "done":
+                    finished = True
+                    if perf is not None:
+                        perf.update(payload)
+                    return
+                else:
+                    finished = True
+                    raise RuntimeError(payload)
+        except (EOFError, OSError) as e:
+            crashed = True
+            raise WorkerCrashedError(f"Inference worker {worker.index} crashed") from e
+        finally:
+            if not finished and not crashed:
+                # Consumer went away mid-stream: stop the worker and drain
+                # what it already sent so the pipe is clean for the next request
+                worker.cancel_event.set()
+                try:
+                    while worker.conn.recv()[0] == "chunk":
+                        pass
+                except (EOFError, OSError):
+                    crashed = True
+            worker.cancel_event.clear()
+            self._checkin(worker, conversation_id, crashed)
+
+    def stats(self) -> Dict[str, Any]:
+        """Per-worker health and load"""
+        with self._cond:
+            return {
+                "workers": [w.stats() for w in self._workers],
+                "affinity_entries": len(self._affinity),
+            }
+
+    def unload_model(self):
+        """Stop all workers, mirrors LLMService.unload_model"""
+        self.shutdown()
+
+    def shutdown(self):
+        """Stop all workers"""
+        self._closed = True
+        with self._cond:
+            self._cond.notify_all()
+        for worker in self._workers:
+            try:
+                if worker.conn is not None and worker.process.is_alive():
+                    worker.conn.send(("stop", None))
+                    worker.process.join(timeout=5)
+            except (EOFError, OSError):
+                pass
+            self._stop_process(worker)
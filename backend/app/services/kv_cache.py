@@ -0,0 +1,123 @@
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class KVStatePool:
+    """
+    Bounded LRU pool of saved llama.cpp states keyed by conversation
+
+    A single Llama context only gets prefix-match hits against the prompt it
+    evaluated last. Saving the state of the conversation we switch away from
+    (and restoring it when that conversation comes back) lets every recently
+    active conversation keep its evaluated history.
+    """
+
+    def __init__(self, max_bytes: int):
+        """
+        Args:
+            max_bytes: Memory budget for all saved states combined
+        """
+        self.max_bytes = max_bytes
+        self._states: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._sizes: Dict[Hashable, int] = {}
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def state_size(state) -> int:
+        """Approximate memory held by a LlamaState"""
+        size = int(getattr(state, "llama_state_size", 0))
+        for attr in ("scores", "input_ids"):
+            array = getattr(state, attr, None)
+            if array is not None and hasattr(array, "nbytes"):
+                size += int(array.nbytes)
+        return size
+
+    def put(self, key: Hashable, state) -> bool:
+        """
+        Store a state, evicting least recently used entries to fit the budget
+
+        Returns:
+            False if the state alone is larger than the budget and was dropped
+        """
+        size = self.state_size(state)
+        with self._lock:
+            self._remove(key)
+            if size > self.max_bytes:
+                logger.info(
+                    f"KV state for {key} ({size} bytes) exceeds pool budget, not cached"
+                )
+                return False
+
+            while self._states and self._total_bytes + size > self.max_bytes:
+                evicted_key, _ = self._states.popitem(last=False)
+                self._total_bytes -= self._sizes.pop(evicted_key)
+                self.evictions += 1
+                logger.debug(f"Evicted KV state for {evicted_key}")
+
+            self._states[key] = state
+            self._sizes[key] = size
+            self._total_bytes += size
+            return True
+
+    def take(self, key: Hashable) -> Optional[Any]:
+        """
+        Remove and return the state for a key
+
+        The state is taken out of the pool because once it is loaded the
+        context itself holds it; it is saved again when the context switches
+        to another conversation.
+        """
+        with self._lock:
+            state = self._states.get(key)
+            if state is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._remove(key)
+            return state
+
+    def discard(self, key: Hashable):
+        """Drop the state for a key if present"""
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        """Drop all saved states"""
+        with self._lock:
+            self._states.clear()
+            self._sizes.clear()
+            self._total_bytes = 0
+
+    def _remove(self, key: Hashable):
+        if key in self._states:
+            del self._states[key]
+            self._total_bytes -= self._sizes.pop(key)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._states
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._states)
+
+    def stats(self) -> Dict[str, Any]:
+        """Pool usage and hit/miss counters"""
+        with self._lock:
+            return {
+                "slots": len(self._states),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
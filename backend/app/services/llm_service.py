@@ -1,9 +1,48 @@
-from llama_cpp import Llama
-from typing import Generator, Dict, Any
+from typing import Generator, Dict, Any, Hashable, List, Optional, Sequence
+from .gguf import GGUFError, read_vocab_size
+from .kv_cache import KVStatePool
+from .prompt_snapshots import PromptSnapshotStore
+from .token_cache import TokenCache
+import numpy as np
 import logging
+import math
+import time
 
 logger = logging.getLogger(__name__)
 
+# Opens the assistant turn the model is asked to complete
+ASSISTANT_HEADER = "<|im_start|>assistant\n"
+
+# Prompt tokens evaluated by prefill between checks for cancellation
+PREFILL_CHUNK_TOKENS = 32
+
+
+class ContextOverflowError(ValueError):
+    """The prompt cannot be made to fit the context window"""
+
+
+def format_chat_message(role: str, content: str) -> str:
+    """Format one message in ChatML: <|im_start|>role\\ncontent<|im_end|>"""
+    return f"<|im_start|>{role}\n{content}<|im_end|>"
+
+
+def format_chat_prompt(messages: list) -> str:
+    """
+    Format chat messages into a ChatML prompt string
+
+    Module level so callers without a loaded model (e.g. the completion
+    cache) build exactly the prompt the model would see.
+    """
+    prompt_parts = [
+        format_chat_message(msg.get("role", "user"), msg.get("content", ""))
+        for msg in messages
+    ]
+
+    # Add the assistant start token to prompt generation
+    prompt_parts.append(ASSISTANT_HEADER)
+
+    return "\n".join(prompt_parts)
+
 
 class LLMService:
     """Service for managing LLM inference using llama.cpp"""
@@ -14,6 +53,15 @@ class LLMService:
         n_ctx: int = 2048,
         n_gpu_layers: int = -1,
         n_threads: int = 4,
+        kv_cache_max_bytes: int = 0,
+        context_reserve_tokens: int = 0,
+        token_cache_max_tokens: int = 2_000_000,
+        snapshot_dir: Optional[str] = None,
+        snapshot_prompts: Sequence[str] = (),
+        speculative: str = "",
+        draft_tokens: int = 10,
+        lookup_ngram_size: int = 2,
+        draft_model_path: Optional[str] = None,
     ):
         """
         Initialize the LLM service
@@ -23,52 +71,140 @@ class LLMService:
             n_ctx: Context window size (default: 2048)
             n_gpu_layers: Number of layers to offload to GPU (0 = CPU only, -1 = all)
             n_threads: Number of CPU threads to use
+            kv_cache_max_bytes: Memory budget for saved per-conversation KV
+                states (0 disables the pool)
+            context_reserve_tokens: Tokens always left free for generation
+                when history has to be trimmed (0 = a quarter of n_ctx)
+            token_cache_max_tokens: Token ids kept in the per-message
+                tokenization cache
+            snapshot_dir: Directory for on-disk KV snapshots of system
+                prompts (None disables snapshots)
+            snapshot_prompts: System prompts to snapshot
+            speculative: Speculative decoding mode, "" (off), "prompt_lookup"
+                or "draft"
+            draft_tokens: Tokens drafted per speculative step
+            lookup_ngram_size: Longest n-gram matched by prompt lookup
+            draft_model_path: Small .gguf model used by the "draft" mode
         """
         self.model_path = model_path
         self.llm = None
         self.n_ctx = n_ctx
         self.n_gpu_layers = n_gpu_layers
         self.n_threads = n_threads
+        self.context_reserve_tokens = context_reserve_tokens or n_ctx // 4
+        self.speculative = speculative
+        self.draft_tokens = draft_tokens
+        self.lookup_ngram_size = lookup_ngram_size
+        self.draft_model_path = draft_model_path
+        self.draft_model = None
+
+        # Saved KV states of conversations that are not currently in the context
+        self.kv_pool = KVStatePool(kv_cache_max_bytes) if kv_cache_max_bytes > 0 else None
+        self._active_conversation: Optional[Hashable] = None
+
+        # Token ids of formatted messages, so each turn only tokenizes what is new
+        self.token_cache = TokenCache(token_cache_max_tokens)
+        self._bos_tokens: List[int] = []
+        self._header_tokens: List[int] = []
+
+        # Evaluated system prompts saved to disk, longest prefix first
+        self.snapshots: Optional[PromptSnapshotStore] = None
+        self._snapshot_prefixes: List[List[int]] = []
 
         logger.info(f"Initializing LLM service with model: {model_path}")
         self._load_model()
+        if snapshot_dir and snapshot_prompts:
+            self._init_snapshots(snapshot_dir, snapshot_prompts)
 
     def _load_model(self):
         """Load the model into memory"""
+        # llama-cpp-python is imported here, not with the module, so the fake
+        # backend (which only inherits the prompt handling) runs without it
+        from llama_cpp import Llama
+        from .speculative import create_draft_model
+
         try:
+            speculative = self.speculative
+            if speculative == "draft" and not self._draft_vocab_matches():
+                # Drafts would be token ids of another vocabulary; serve
+                # this model without speculation rather than not at all.
+                # Decided before Llama is built, which with a draft model
+                # keeps logits for the whole context.
+                speculative = ""
+            self.draft_model = create_draft_model(
+                speculative,
+                num_pred_tokens=self.draft_tokens,
+                max_ngram_size=self.lookup_ngram_size,
+                draft_model_path=self.draft_model_path,
+                n_ctx=self.n_ctx,
+                n_threads=self.n_threads,
+            )
             self.llm = Llama(
                 model_path=str(self.model_path),
                 n_ctx=self.n_ctx,
                 n_gpu_layers=self.n_gpu_layers,
                 n_threads=self.n_threads,
+                # llama-cpp-python then keeps logits for the whole context to
+                # verify drafts (n_ctx x vocab floats)
+                draft_model=self.draft_model,
                 verbose=True,
             )
+            # Empty unless the model's vocab asks for a BOS token
+            self._bos_tokens = self.llm.tokenize(b"", add_bos=True, special=True)
+            self._header_tokens = self._tokenize(ASSISTANT_HEADER)
             logger.info("Model loaded successfully")
         except Exception as e:
             logger.error(f"Failed to load model: {e}")
             raise
 
+    def _draft_vocab_matches(self) -> bool:
+        """Whether the draft model shares the model's vocabulary, read from the GGUF headers"""
+        if not self.draft_model_path:
+            # create_draft_model reports the missing path
+            return True
+        try:
+            target = read_vocab_size(self.model_path)
+            draft = read_vocab_size(self.draft_model_path)
+        except (GGUFError, OSError) as e:
+            logger.warning(f"Could not compare draft model vocabulary: {e}")
+            return True
+        if target is not None and draft is not None and target != draft:
+            logger.warning(
+                f"Draft model vocabulary ({draft}) does not match "
+                f"{self.model_path} ({target}), speculative decoding disabled"
+            )
+            return False
+        return True
+
     def generate(
         self,
-        prompt: str,
+        prompt: str | List[int],
         max_tokens: int = 512,
         temperature: float = 0.7,
         top_p: float = 0.9,
         top_k: int = 40,
         stop: list = None,
         stream: bool = False,
+        cancel_event=None,
+        perf: Optional[Dict[str, Any]] = None,
     ) -> Dict[str, Any] | Generator:
         """
         Generate a response from the model
 
         Args:
-            prompt: The input text prompt
+            prompt: The input text prompt, or its token ids
             max_tokens: Maximum tokens to generate
             temperature: Sampling temperature (0.0 to 1.0)
             top_p: Nucleus sampling parameter
             top_k: Top-k sampling parameter
             stop: List of stop sequences
             stream: Whether to stream the response
+            cancel_event: Event that stops generation at the next token when set
+            perf: Dict filled in with this request's timings once generation
+                ends (prompt_tokens, prefix_match_tokens, prompt_eval_tokens,
+                prompt_eval_ms, completion_tokens, eval_ms, eval_tokens_per_s,
+                generation_ms, and with speculative decoding draft_tokens,
+                draft_accepted_tokens and draft_acceptance_rate)
 
         Returns:
             Dict with 'text' key containing the response, or a generator if streaming
@@ -79,7 +215,22 @@ class LLMService:
         if stop is None:
             stop = []
 
+        stopping_criteria = None
+        if cancel_event is not None:
+            from llama_cpp import StoppingCriteriaList
+
+            stopping_criteria = StoppingCriteriaList(
+                [lambda input_ids, logits: cancel_event.is_set()]
+            )
+
+        prompt_tokens = len(prompt) if isinstance(prompt, list) else self._count_tokens(prompt)
+        prefix_tokens = self._prefix_match(prompt)
+        self._reset_perf_counters()
+        if self.draft_model is not None:
+            self.draft_model.reset()
+
         try:
+            started = time.perf_counter()
             response = self.llm(
                 prompt,
                 max_tokens=max_tokens,
@@ -89,26 +240,149 @@ class LLMService:
                 stop=stop,
                 stream=stream,
                 echo=False,
+                stopping_criteria=stopping_criteria,
             )
 
             if stream:
-                return self._stream_generator(response)
+                return self._stream_generator(response, perf, prompt_tokens, prefix_tokens)
             else:
+                if perf is not None:
+                    perf.update(self._perf_summary(
+                        started,
+                        None,
+                        prompt_tokens,
+                        prefix_tokens,
+                        response["usage"]["completion_tokens"],
+                    ))
                 return {
                     "text": response["choices"][0]["text"],
                     "tokens_used": response["usage"]["total_tokens"],
+                    "prompt_tokens": response["usage"]["prompt_tokens"],
+                    "completion_tokens": response["usage"]["completion_tokens"],
                 }
         except Exception as e:
             logger.error(f"Generation failed: {e}")
             raise
 
-    def _stream_generator(self, response_stream) -> Generator:
-        """Convert llama.cpp stream to a cleaner generator"""
-        for chunk in response_stream:
-            if "choices" in chunk and len(chunk["choices"]) > 0:
-                delta = chunk["choices"][0].get("text", "")
-                if delta:
-                    yield delta
+    def _stream_generator(
+        self,
+        response_stream,
+        perf: Optional[Dict[str, Any]] = None,
+        prompt_tokens: int = 0,
+        prefix_tokens: int = 0,
+    ) -> Generator:
+        """Convert llama.cpp stream to a cleaner generator, timing it into perf"""
+        # llama.cpp only starts evaluating when the stream is first read
+        started = time.perf_counter()
+        first_token_at = None
+        completion_tokens = 0
+        try:
+            for chunk in response_stream:
+                if "choices" in chunk and len(chunk["choices"]) > 0:
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                    completion_tokens += 1
+                    delta = chunk["choices"][0].get("text", "")
+                    if delta:
+                        yield delta
+        finally:
+            # Also runs when the consumer stops early, e.g. on cancel
+            if perf is not None:
+                perf.update(self._perf_summary(
+                    started, first_token_at, prompt_tokens, prefix_tokens, completion_tokens
+                ))
+
+    def _prefix_match(self, prompt: str | List[int]) -> int:
+        """Number of leading prompt tokens already in the context, which llama.cpp reuses"""
+        context = getattr(self.llm, "input_ids", None)
+        if context is None or not isinstance(prompt, list):
+            return 0
+        # input_ids is allocated for the whole context; only the first
+        # n_tokens entries were evaluated
+        n_tokens = getattr(self.llm, "n_tokens", len(context))
+        matched = 0
+        for cached, token in zip(context[:n_tokens].tolist(), prompt):
+            if cached != token:
+                break
+            matched += 1
+        return matched
+
+    def _reset_perf_counters(self):
+        """Zero llama.cpp's own timing counters before a request"""
+        ctx = getattr(getattr(self.llm, "_ctx", None), "ctx", None)
+        if ctx is None:
+            return
+        import llama_cpp
+
+        reset = getattr(llama_cpp, "llama_perf_context_reset", None)
+        if reset is not None:
+            try:
+                reset(ctx)
+            except Exception:
+                pass
+
+    def _read_perf_counters(self) -> Optional[Dict[str, Any]]:
+        """llama.cpp's timings of the last request (what llama_perf_context_print reports)"""
+        ctx = getattr(getattr(self.llm, "_ctx", None), "ctx", None)
+        if ctx is None:
+            return None
+        import llama_cpp
+
+        read = getattr(llama_cpp, "llama_perf_context", None)
+        if read is None:
+            return None
+        try:
+            data = read(ctx)
+            return {
+                "prompt_eval_tokens": int(data.n_p_eval),
+                "prompt_eval_ms": round(float(data.t_p_eval_ms), 2),
+                "eval_tokens": int(data.n_eval),
+                "eval_ms": round(float(data.t_eval_ms), 2),
+            }
+        except Exception:
+            return None
+
+    def _perf_summary(
+        self,
+        started: float,
+        first_token_at: Optional[float],
+        prompt_tokens: int,
+        prefix_tokens: int,
+        completion_tokens: int,
+    ) -> Dict[str, Any]:
+        """
+        Timings of one generation
+
+        Wall-clock time to the first token stands in for prompt evaluation;
+        llama.cpp's own counters replace the estimates when available.
+        """
+        finished = time.perf_counter()
+        summary = {
+            "prompt_tokens": prompt_tokens,
+            "prefix_match_tokens": prefix_tokens,
+            "prompt_eval_tokens": max(prompt_tokens - prefix_tokens, 0),
+            "completion_tokens": completion_tokens,
+            "generation_ms": round((finished - started) * 1000, 2),
+        }
+        if first_token_at is not None:
+            summary["prompt_eval_ms"] = round((first_token_at - started) * 1000, 2)
+            summary["eval_ms"] = round((finished - first_token_at) * 1000, 2)
+            # The first token is sampled at the end of prompt evaluation
+            summary["eval_tokens"] = max(completion_tokens - 1, 0)
+
+        counters = self._read_perf_counters()
+        if counters is not None:
+            summary.update(counters)
+
+        if self.draft_model is not None:
+            summary.update(self.draft_model.summary(completion_tokens))
+            # llama.cpp also counts rejected draft tokens as evaluated;
+            # the rate should be of tokens the client received
+            summary["eval_tokens"] = max(completion_tokens - 1, 0)
+
+        if summary.get("eval_ms") and summary.get("eval_tokens"):
+            summary["eval_tokens_per_s"] = round(summary["eval_tokens"] / summary["eval_ms"] * 1000, 2)
+        return summary
 
     def chat(
         self,
@@ -116,6 +390,9 @@ class LLMService:
         max_tokens: int = 512,
         temperature: float = 0.7,
         stream: bool = False,
+        conversation_id: Optional[Hashable] = None,
+        cancel_event=None,
+        perf: Optional[Dict[str, Any]] = None,
     ) -> Dict[str, Any] | Generator:
         """
         Chat completion format (converts messages to prompt)
@@ -125,39 +402,321 @@ class LLMService:
             max_tokens: Maximum tokens to generate
             temperature: Sampling temperature
             stream: Whether to stream the response
+            conversation_id: Conversation the messages belong to, used to
+                restore its saved KV state
+            cancel_event: Event that stops generation at the next token when set
+            perf: Dict filled in with timings, see generate
 
         Returns:
             Dict with 'text' key or generator if streaming
         """
-        # Convert chat messages to a single prompt
-        # This is a simple format - you can customize based on your model's training
-        prompt = self._format_chat_prompt(messages)
+        messages, max_tokens = self._fit_messages(messages, max_tokens)
+
+        # Convert chat messages to a single prompt, as token ids so llama.cpp
+        # doesn't re-tokenize the whole history on every turn
+        prompt = self._build_prompt_tokens(messages)
+
+        self._activate_conversation(conversation_id)
+        self._restore_prompt_snapshot(prompt)
 
         return self.generate(
-            prompt=prompt, max_tokens=max_tokens, temperature=temperature, stream=stream
+            prompt=prompt,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stream=stream,
+            cancel_event=cancel_event,
+            perf=perf,
         )
 
-    def _format_chat_prompt(self, messages: list) -> str:
+    def warmup(self, system_prompt: str) -> float:
         """
-        Format chat messages into a prompt string
-        Uses ChatML format (works with Qwen3, Mistral, etc.)
+        Evaluate a system prompt once so the first real request is fast
+
+        Runs llama.cpp's compute graphs for the first time and leaves the
+        prompt in the KV cache, where prefix matching reuses it for chats
+        that start with the same system prompt.
+
+        Returns:
+            Time taken in milliseconds
+        """
+        started = time.perf_counter()
+        self.chat([{"role": "system", "content": system_prompt}], max_tokens=1, temperature=0.0)
+        return (time.perf_counter() - started) * 1000
+
+    def prefill(
+        self,
+        messages: list,
+        max_tokens: int = 512,
+        conversation_id: Optional[Hashable] = None,
+        cancel_event=None,
+    ) -> Dict[str, Any]:
         """
-        # ChatML format: <|im_start|>role\ncontent<|im_end|>
-        prompt_parts = []
+        Evaluate a chat's messages into the KV cache without generating
+
+        Run before the user sends a turn, with the history so far and
+        possibly a draft of the message being typed. The next chat() with
+        the same messages (plus any new ones) then finds them in the context
+        and only evaluates what changed. The assistant header is left out,
+        since more messages may follow.
 
+        Args:
+            messages: Messages of the chat so far
+            max_tokens: The max_tokens the chat will be sent with, so
+                history is trimmed the same way
+            conversation_id: Conversation whose KV state to extend
+            cancel_event: Stops evaluation at the next chunk when set
+
+        Returns:
+            Dict with prompt_tokens, prefix_match_tokens (already in the
+            context), prefill_tokens (evaluated now), prefill_ms and cancelled
+        """
+        if self.llm is None:
+            raise RuntimeError("Model not loaded")
+
+        messages, _ = self._fit_messages(messages, max_tokens)
+        prompt = list(self._bos_tokens)
         for msg in messages:
-            role = msg.get("role", "user")
-            content = msg.get("content", "")
-            prompt_parts.append(f"<|im_start|>{role}\n{content}<|im_end|>")
+            prompt.extend(self._message_token_ids(msg))
+
+        self._activate_conversation(conversation_id)
+        self._restore_prompt_snapshot(prompt)
+
+        started = time.perf_counter()
+        matched = self._prefix_match(prompt)
+        evaluated = self._eval_prompt(prompt, matched, cancel_event)
+        return {
+            "prompt_tokens": len(prompt),
+            "prefix_match_tokens": matched,
+            "prefill_tokens": evaluated,
+            "prefill_ms": round((time.perf_counter() - started) * 1000, 2),
+            "cancelled": matched + evaluated < len(prompt),
+        }
+
+    def _eval_prompt(self, prompt: List[int], start: int, cancel_event=None) -> int:
+        """
+        Evaluate prompt[start:] after the first `start` tokens of the context
+
+        Works in small chunks so a cancel takes effect quickly; whatever was
+        evaluated before it stays in the context.
+
+        Returns:
+            Number of tokens evaluated
+        """
+        # Drops whatever followed the matched prefix
+        self.llm.n_tokens = start
+        for i in range(start, len(prompt), PREFILL_CHUNK_TOKENS):
+            if cancel_event is not None and cancel_event.is_set():
+                break
+            self.llm.eval(prompt[i:i + PREFILL_CHUNK_TOKENS])
+        return self.llm.n_tokens - start
+
+    def _system_prefix_tokens(self, system_prompt: str) -> List[int]:
+        """Leading prompt tokens of any chat that starts with this system prompt"""
+        return list(self._bos_tokens) + list(
+            self._message_token_ids({"role": "system", "content": system_prompt})
+        )
+
+    def _init_snapshots(self, directory: str, prompts: Sequence[str]):
+        """Open the snapshot store and snapshot the prompts that are not on disk yet"""
+        try:
+            self.snapshots = PromptSnapshotStore(directory, self.model_path, self.n_ctx)
+        except OSError as e:
+            logger.warning(f"KV snapshots disabled: {e}")
+            return
+
+        for prompt in dict.fromkeys(p for p in prompts if p):
+            tokens = self._system_prefix_tokens(prompt)
+            self._snapshot_prefixes.append(tokens)
+            if self.snapshots.has(tokens):
+                continue
+            try:
+                self.llm.reset()
+                self.llm.eval(tokens)
+                state = self.llm.save_state()
+                self.snapshots.save(tokens, state.llama_state, state.seed)
+            except Exception as e:
+                logger.warning(f"Failed to snapshot system prompt ({len(tokens)} tokens): {e}")
+        self._snapshot_prefixes.sort(key=len, reverse=True)
+
+    def _restore_prompt_snapshot(self, prompt: List[int]):
+        """
+        Load the snapshot of the prompt's system prefix into the context
+
+        Only done when the context does not already share at least that
+        prefix with the prompt, e.g. after a restart or when the previous
+        request came from a chat with a different history. llama.cpp's
+        prefix matching then evaluates only what follows the system prompt.
+        """
+        if not self._snapshot_prefixes or self.llm is None:
+            return
+        prefix = next(
+            (p for p in self._snapshot_prefixes if len(p) < len(prompt) and prompt[: len(p)] == p),
+            None,
+        )
+        if prefix is None or self._prefix_match(prompt) >= len(prefix):
+            return
+
+        with self.snapshots.open(prefix) as snapshot:
+            if snapshot is None:
+                return
+            # llama-cpp-python keeps input_ids sized for the whole context
+            input_ids = np.zeros(self.n_ctx, dtype=np.intc)
+            input_ids[: len(prefix)] = snapshot["input_ids"]
+            from llama_cpp import LlamaState
+
+            state = LlamaState(
+                input_ids=input_ids,
+                # Logits of prefix tokens are never sampled from, the last
+                # prompt token is always re-evaluated
+                scores=np.zeros((1, self.llm.n_vocab()), dtype=np.single),
+                n_tokens=len(prefix),
+                llama_state=snapshot["state"],
+                llama_state_size=snapshot["state_size"],
+                seed=snapshot["seed"],
+            )
+            try:
+                self.llm.load_state(state)
+                logger.debug(f"Restored KV snapshot of {len(prefix)} system prompt tokens")
+            except Exception as e:
+                logger.warning(f"Failed to restore KV snapshot: {e}")
+                self.llm.reset()
+            del state
+
+    def _activate_conversation(self, conversation_id: Optional[Hashable]):
+        """
+        Make the context hold the KV state of the given conversation
+
+        The state of the conversation currently in the context is saved to the
+        pool before switching, and the requested conversation's state is
+        restored if it was saved earlier. llama.cpp's own prefix matching then
+        skips re-evaluating the restored history.
+        """
+        if self.kv_pool is None or self.llm is None:
+            return
+        if conversation_id is not None and conversation_id == self._active_conversation:
+            return
 
-        # Add the assistant start token to prompt generation
-        prompt_parts.append("<|im_start|>assistant\n")
+        if self._active_conversation is not None and self.llm.n_tokens > 0:
+            try:
+                self.kv_pool.put(self._active_conversation, self.llm.save_state())
+            except Exception as e:
+                logger.warning(f"Failed to save KV state for {self._active_conversation}: {e}")
 
-        return "\n".join(prompt_parts)
+        self._active_conversation = conversation_id
+        if conversation_id is None:
+            return
+
+        state = self.kv_pool.take(conversation_id)
+        if state is not None:
+            try:
+                self.llm.load_state(state)
+                logger.info(
+                    f"Restored KV state for conversation {conversation_id} ({state.n_tokens} tokens)"
+                )
+            except Exception as e:
+                logger.warning(f"Failed to restore KV state for {conversation_id}: {e}")
+                self.llm.reset()
+
+    def _tokenize(self, text: str) -> List[int]:
+        """Tokenize text with the model's tokenizer, special tokens parsed"""
+        return self.llm.tokenize(text.encode("utf-8"), add_bos=False, special=True)
+
+    def _count_tokens(self, text: str) -> int:
+        """Number of tokens the model's tokenizer produces for text"""
+        return len(self._tokenize(text))
+
+    def _message_token_ids(self, msg: dict):
+        """Token ids of one formatted message plus its separator, from the cache"""
+        role = msg.get("role", "user")
+        content = msg.get("content", "")
+        # Each message starts with a special token, so tokenizing messages
+        # separately gives the same ids as tokenizing the joined prompt
+        return self.token_cache.get_or_tokenize(
+            role, content, lambda: self._tokenize(format_chat_message(role, content) + "\n")
+        )
+
+    def _message_tokens(self, msg: dict) -> int:
+        """Tokens one formatted message takes in the prompt, separator included"""
+        return len(self._message_token_ids(msg))
+
+    def _build_prompt_tokens(self, messages: list) -> List[int]:
+        """Token ids of the ChatML prompt for messages, see format_chat_prompt"""
+        tokens = list(self._bos_tokens)
+        for msg in messages:
+            tokens.extend(self._message_token_ids(msg))
+        tokens.extend(self._header_tokens)
+        return tokens
+
+    def _fit_messages(self, messages: list, max_tokens: int) -> tuple:
+        """
+        Fit the chat history into the context window
+
+        Leading system messages and the latest message are always kept. If
+        the prompt is too long to leave `context_reserve_tokens` free for
+        generation, the oldest turns in between are dropped at message
+        boundaries. Drops happen in whole pages of a quarter of the prompt
+        budget, so the cut point stays put for several turns and the retained
+        prefix (and with it the KV prefix cache) remains stable.
+
+        Returns:
+            (messages, max_tokens) with max_tokens capped to the room left
+        """
+        # Every token is at least one byte, so short prompts need no counting
+        if len(self._format_chat_prompt(messages).encode("utf-8")) + max_tokens <= self.n_ctx:
+            return messages, max_tokens
+
+        header_tokens = len(self._bos_tokens) + len(self._header_tokens)
+        counts = [self._message_tokens(msg) for msg in messages]
+        prompt_tokens = sum(counts) + header_tokens
+        budget = self.n_ctx - min(max_tokens, self.context_reserve_tokens)
+
+        if prompt_tokens > budget:
+            n_system = 0
+            while n_system < len(messages) - 1 and messages[n_system].get("role") == "system":
+                n_system += 1
+            history_end = len(messages) - 1
+
+            page = max(1, budget // 4)
+            target = math.ceil((prompt_tokens - budget) / page) * page
+
+            cut = n_system
+            dropped = 0
+            while cut < history_end and dropped < target:
+                dropped += counts[cut]
+                cut += 1
+            # Don't start the retained history with an orphaned assistant reply
+            while cut < history_end and messages[cut].get("role") == "assistant":
+                dropped += counts[cut]
+                cut += 1
+
+            if prompt_tokens - dropped > budget:
+                # Page rounding was not enough only if everything droppable is gone
+                raise ContextOverflowError(
+                    f"Prompt needs {prompt_tokens - dropped} tokens, context allows {budget}"
+                )
+
+            logger.info(
+                f"Dropped {cut - n_system} oldest messages ({dropped} tokens) to fit the context window"
+            )
+            messages = messages[:n_system] + messages[cut:]
+            prompt_tokens -= dropped
+
+        return messages, min(max_tokens, self.n_ctx - prompt_tokens)
+
+    def _format_chat_prompt(self, messages: list) -> str:
+        """
+        Format chat messages into a prompt string
+        Uses ChatML format (works with Qwen3, Mistral, etc.)
+        """
+        return format_chat_prompt(messages)
 
     def unload_model(self):
         """Unload the model from memory"""
         if self.llm is not None:
             del self.llm
             self.llm = None
+            if self.kv_pool is not None:
+                self.kv_pool.clear()
+            self.token_cache.clear()
+            self._active_conversation = None
             logger.info("Model unloaded")
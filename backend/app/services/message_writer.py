@@ -0,0 +1,190 @@
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Hashable, List, Optional
+from sqlalchemy import bindparam, update
+import queue
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Queue marker that tells the writer thread to exit
+_STOP = object()
+
+
+class MessageWriter:
+    """
+    Write-behind persistence of chat messages
+
+    The chat routes hand finished turns to submit() and return without
+    waiting for SQLite. A background thread drains the queue and writes
+    everything that is waiting in one transaction, so a burst of turns
+    costs one commit. Readers that need a conversation's latest messages
+    call wait_for() first.
+    """
+
+    def __init__(
+        self,
+        engine,
+        messages_table,
+        conversations_table,
+        max_queue: int = 1024,
+        batch_size: int = 64,
+        max_delay: float = 0.02,
+        on_failure: Optional[Callable[[Hashable], None]] = None,
+    ):
+        """
+        Args:
+            engine: SQLAlchemy engine to write with
+            messages_table: Message.__table__
+            conversations_table: Conversation.__table__, whose updated_at is bumped
+            max_queue: Turns waiting to be written before submit() refuses more
+            batch_size: Turns written per transaction at most
+            max_delay: Seconds to wait for more turns before writing a batch
+            on_failure: Called with the conversation id of a turn that could
+                not be written
+        """
+        self.engine = engine
+        self.messages = messages_table
+        self.conversations = conversations_table
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.on_failure = on_failure
+
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_queue)
+        self._pending: Dict[Hashable, int] = defaultdict(int)
+        self._cond = threading.Condition()
+        self._closed = False
+
+        self.written = 0
+        self.batches = 0
+        self.failures = 0
+        self.rejected = 0
+
+        self._thread = threading.Thread(target=self._run, name="message-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, conversation_id: Hashable, messages: List[Dict[str, Any]]) -> bool:
+        """
+        Queue messages for a conversation
+
+        Args:
+            conversation_id: Conversation the messages belong to (must be committed)
+            messages: Dicts with role, content and message_metadata
+
+        Returns:
+            False if the queue is full or closed; the caller should write
+            the messages itself
+        """
+        now = datetime.now(timezone.utc)
+        item = (conversation_id, [dict(m, created_at=now) for m in messages])
+        with self._cond:
+            if self._closed:
+                return False
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                self.rejected += 1
+                return False
+            self._pending[conversation_id] += 1
+        return True
+
+    def wait_for(self, conversation_id: Hashable, timeout: float = 10.0) -> bool:
+        """Block until a conversation's queued messages are written. False on timeout."""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending.get(conversation_id), timeout)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Block until everything queued so far is written. False on timeout."""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending, timeout)
+
+    def shutdown(self, timeout: float = 30.0):
+        """Write what is queued, then stop the writer thread"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning("Message writer did not finish before shutdown")
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+
+            # Group whatever arrives within max_delay into the same transaction
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self._write(batch)
+
+    def _write(self, batch: list):
+        """Write a batch in one transaction, falling back to one per turn"""
+        try:
+            self._commit(batch)
+            written = batch
+        except Exception as e:
+            logger.warning(f"Batched message write failed, retrying turns one by one: {e}")
+            written = []
+            for item in batch:
+                try:
+                    self._commit([item])
+                    written.append(item)
+                except Exception as e:
+                    logger.error(f"Failed to save messages for conversation {item[0]}: {e}")
+                    with self._cond:
+                        self.failures += 1
+                    if self.on_failure is not None:
+                        self.on_failure(item[0])
+
+        with self._cond:
+            self.batches += 1
+            self.written += sum(len(messages) for _, messages in written)
+            for conversation_id, _ in batch:
+                self._pending[conversation_id] -= 1
+                if self._pending[conversation_id] <= 0:
+                    del self._pending[conversation_id]
+            self._cond.notify_all()
+
+    def _commit(self, batch: list):
+        rows = []
+        updated_at = {}
+        for conversation_id, messages in batch:
+            for message in messages:
+                rows.append(dict(message, conversation_id=conversation_id))
+                updated_at[conversation_id] = message["created_at"]
+
+        with self.engine.begin() as conn:
+            conn.execute(self.messages.insert(), rows)
+            conn.execute(
+                update(self.conversations)
+                .where(self.conversations.c.id == bindparam("conversation_id"))
+                .values(updated_at=bindparam("timestamp")),
+                [{"conversation_id": cid, "timestamp": ts} for cid, ts in updated_at.items()],
+            )
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "queued": self._queue.qsize(),
+                "pending_conversations": len(self._pending),
+                "written": self.written,
+                "batches": self.batches,
+                "failures": self.failures,
+                "rejected": self.rejected,
+            }
@@ -0,0 +1,248 @@
+from bisect import bisect_left
+from typing import Any, Dict, Optional, Sequence, Tuple
+import math
+import threading
+
+# Exposition format version served at /api/metrics
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Bucket upper bounds in seconds, for latencies from a cache hit to a long generation
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TOKEN_BUCKETS = (1, 8, 32, 128, 256, 512, 1024, 2048, 4096, 8192)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 250)
+RATIO_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    """A named family of samples, one per combination of label values"""
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+            lines.extend(self._render_samples(items))
+        return "\n".join(lines)
+
+    def _render_samples(self, items) -> list:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Monotonically increasing count"""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _render_samples(self, items) -> list:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in items
+        ]
+
+
+class Histogram(_Metric):
+    """Distribution of observations over fixed buckets, plus their sum and count"""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        buckets: Sequence[float],
+        labelnames: Sequence[str] = (),
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket counts (last one is +Inf), sum
+                state = [[0] * (len(self.buckets) + 1), 0.0]
+                self._values[key] = state
+            state[0][bisect_left(self.buckets, value)] += 1
+            state[1] += value
+
+    def _render_samples(self, items) -> list:
+        lines = []
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """Collection of metrics rendered together in Prometheus text format"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        buckets: Sequence[float],
+        labelnames: Sequence[str] = (),
+    ) -> Histogram:
+        return self._register(Histogram(name, documentation, buckets, labelnames))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+class InferenceMetrics:
+    """
+    Per-request inference metrics
+
+    The chat routes build one summary dict per request (see
+    LLMService.generate for the timing fields) and hand it to record(). The
+    same summary is returned to the client, so a single response can be
+    compared against the aggregated histograms.
+    """
+
+    def __init__(self, registry: Optional[MetricsRegistry] = None):
+        self.registry = registry or MetricsRegistry()
+        r = self.registry
+
+        self.requests = r.counter(
+            "llm_requests_total", "Chat requests by outcome", ("status", "cached")
+        )
+        self.prompt_tokens = r.counter("llm_prompt_tokens_total", "Prompt tokens submitted")
+        self.prefix_match_tokens = r.counter(
+            "llm_prefix_match_tokens_total", "Prompt tokens reused from the KV cache"
+        )
+        self.prompt_eval_tokens = r.counter(
+            "llm_prompt_eval_tokens_total", "Prompt tokens evaluated by the model"
+        )
+        self.completion_tokens = r.counter("llm_completion_tokens_total", "Tokens generated")
+        self.draft_tokens = r.counter(
+            "llm_draft_tokens_total", "Tokens proposed by speculative decoding"
+        )
+        self.draft_accepted_tokens = r.counter(
+            "llm_draft_accepted_tokens_total", "Proposed tokens the model accepted"
+        )
+
+        self.queue_wait = r.histogram(
+            "llm_queue_wait_seconds", "Time spent waiting for a model slot", LATENCY_BUCKETS
+        )
+        self.ttft = r.histogram(
+            "llm_time_to_first_token_seconds",
+            "Time from request arrival to the first generated token",
+            LATENCY_BUCKETS,
+        )
+        self.prompt_eval = r.histogram(
+            "llm_prompt_eval_seconds", "Time spent evaluating the prompt", LATENCY_BUCKETS
+        )
+        self.prompt_eval_size = r.histogram(
+            "llm_prompt_eval_tokens", "Prompt tokens evaluated per request", TOKEN_BUCKETS
+        )
+        self.prefix_match = r.histogram(
+            "llm_prefix_match_tokens", "Prompt tokens reused from the KV cache per request", TOKEN_BUCKETS
+        )
+        self.eval_rate = r.histogram(
+            "llm_eval_tokens_per_second", "Generation speed after the first token", RATE_BUCKETS
+        )
+        self.latency = r.histogram(
+            "llm_request_duration_seconds", "Total request latency", LATENCY_BUCKETS
+        )
+        self.draft_acceptance = r.histogram(
+            "llm_draft_acceptance_ratio",
+            "Share of speculatively drafted tokens accepted per request",
+            RATIO_BUCKETS,
+        )
+
+    def record(self, summary: Dict[str, Any], status: str = "completed"):
+        """Add one request's summary to the counters and histograms"""
+        cached = summary.get("cached", False)
+        self.requests.inc(status=status, cached=str(bool(cached)).lower())
+
+        if summary.get("queue_wait_ms") is not None:
+            self.queue_wait.observe(summary["queue_wait_ms"] / 1000)
+        if summary.get("total_ms") is not None:
+            self.latency.observe(summary["total_ms"] / 1000)
+        if summary.get("ttft_ms") is not None:
+            self.ttft.observe(summary["ttft_ms"] / 1000)
+        if cached:
+            # Nothing was evaluated, keep the model histograms about the model
+            return
+
+        self.prompt_tokens.inc(summary.get("prompt_tokens", 0))
+        self.prefix_match_tokens.inc(summary.get("prefix_match_tokens", 0))
+        self.prompt_eval_tokens.inc(summary.get("prompt_eval_tokens", 0))
+        self.completion_tokens.inc(summary.get("completion_tokens", 0))
+
+        if "prompt_eval_tokens" in summary:
+            self.prompt_eval_size.observe(summary["prompt_eval_tokens"])
+        if "prefix_match_tokens" in summary:
+            self.prefix_match.observe(summary["prefix_match_tokens"])
+        if summary.get("prompt_eval_ms") is not None:
+            self.prompt_eval.observe(summary["prompt_eval_ms"] / 1000)
+        if summary.get("eval_tokens_per_s") is not None:
+            self.eval_rate.observe(summary["eval_tokens_per_s"])
+        if "draft_tokens" in summary:
+            self.draft_tokens.inc(summary["draft_tokens"])
+            self.draft_accepted_tokens.inc(summary.get("draft_accepted_tokens", 0))
+        if summary.get("draft_acceptance_rate") is not None:
+            self.draft_acceptance.observe(summary["draft_acceptance_rate"])
+
+    def render(self) -> str:
+        return self.registry.render()
@@ -0,0 +1,511 @@
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+from .gguf import GGUFError, describe_model
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Bytes per KV cache element, llama.cpp keeps K and V in f16 by default
+KV_BYTES_PER_ELEMENT = 2
+
+# Statuses of a model that holds (or is about to hold) memory
+_RESIDENT = ("loading", "warming", "ready")
+
+
+class ModelUnavailableError(Exception):
+    """A requested model cannot serve the request right now"""
+
+    status_code = 503
+
+    def __init__(self, message: str, retry_after: Optional[int] = 5):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class ModelNotFoundError(ModelUnavailableError):
+    """No model with that name in MODEL_DIR"""
+
+    status_code = 404
+
+    def __init__(self, message: str):
+        super().__init__(message, retry_after=None)
+
+
+class _Entry:
+    """A model file and, while it is loaded, its service"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.info: Optional[Dict[str, Any]] = None
+        self.info_error: Optional[str] = None
+        self.stat_key = None
+        self.service = None
+        # unloaded, queued (waiting for memory), loading, warming, ready or failed
+        self.status = "unloaded"
+        self.error: Optional[str] = None
+        # Timings of the latest load
+        self.queued_at: Optional[float] = None
+        self.load_ms: Optional[float] = None
+        self.warmup_ms: Optional[float] = None
+        self.memory_bytes = 0
+        self.in_use = 0
+        self.last_used = 0.0
+        # Incremented per load attempt, so a waiter can tell its own load's
+        # failure from an earlier one
+        self.generation = 0
+
+
+class ModelLease:
+    """A model checked out for one request; eviction waits until it is released"""
+
+    def __init__(self, registry: "ModelRegistry", name: str, service):
+        self.registry = registry
+        self.name = name
+        self.service = service
+        self._released = False
+
+    def release(self):
+        """Give the model back. Safe to call twice."""
+        if not self._released:
+            self._released = True
+            self.registry._release(self.name)
+
+
+class ModelRegistry:
+    """
+    The .gguf models in MODEL_DIR and an LRU of the ones that are loaded
+
+    Files are described from their GGUF header (architecture, context length,
+    quantization, size) without loading weights. Requests check a model out
+    with acquire(); a model that is not loaded is loaded on a background
+    thread while the request waits, then warmed up with warmup_prompt before
+    it takes requests. Loaded models are kept until the memory
+    budget is needed for another one, then the least recently used idle model
+    is evicted with unload_model(). A model in use is never evicted.
+
+    Memory per model is estimated as the file size (the weights) plus the KV
+    cache for n_ctx tokens and the saved KV state pool, times the number of
+    copies (inference workers) that load it.
+    """
+
+    def __init__(
+        self,
+        model_dir: str | Path,
+        default_model: str,
+        service_factory: Callable[[Path], Any],
+        memory_budget_bytes: int = 0,
+        n_ctx: int = 2048,
+        kv_cache_max_bytes: int = 0,
+        copies: int = 1,
+        load_timeout: float = 600.0,
+        warmup_prompt: str = "",
+    ):
+        """
+        Args:
+            model_dir: Directory scanned for .gguf files
+            default_model: File name used when a request names no model
+            service_factory: Builds a service (LLMService or InferencePool)
+                for a model path; called on a background thread
+            memory_budget_bytes: RAM the loaded models may use together,
+                0 = keep a single model loaded
+            n_ctx: Context size the services are built with
+            kv_cache_max_bytes: Saved KV state pool of each service
+            copies: Model instances per service (inference workers)
+            load_timeout: Seconds a load waits for in-use models to be
+                released before giving up
+            warmup_prompt: System prompt evaluated once after each load,
+                empty to skip warmup
+        """
+        self.model_dir = Path(model_dir)
+        self.default_model = default_model
+        self.service_factory = service_factory
+        self.memory_budget_bytes = memory_budget_bytes
+        self.n_ctx = n_ctx
+        self.kv_cache_max_bytes = kv_cache_max_bytes
+        self.copies = max(1, copies)
+        self.load_timeout = load_timeout
+        self.warmup_prompt = warmup_prompt
+
+        self._entries: Dict[str, _Entry] = {}
+        self._cond = threading.Condition()
+        self._closed = False
+
+        self.loads = 0
+        self.evictions = 0
+
+        self.scan()
+
+    def scan(self) -> List[str]:
+        """
+        Refresh the list of model files
+
+        Headers are only re-read for files that changed since the last scan.
+        Loaded models whose file disappeared stay until they are evicted.
+
+        Returns:
+            Names of the known models
+        """
+        paths = {p.name: p for p in sorted(self.model_dir.glob("*.gguf")) if p.is_file()}
+        # The default model is always listed so a missing file shows up as
+        # a failed load rather than an unknown model
+        paths.setdefault(self.default_model, self.model_dir / self.default_model)
+
+        described = {}
+        for name, path in paths.items():
+            try:
+                stat = path.stat()
+                stat_key = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                stat_key = None
+            with self._cond:
+                entry = self._entries.get(name)
+                if entry is not None and entry.stat_key == stat_key:
+                    continue
+            info, error = None, None
+            if stat_key is not None:
+                try:
+                    info = describe_model(path)
+                except (GGUFError, OSError) as e:
+                    error = str(e)
+                    logger.warning(f"Could not read model header of {path}: {e}")
+            described[name] = (path, stat_key, info, error)
+
+        with self._cond:
+            for name, (path, stat_key, info, error) in described.items():
+                entry = self._entries.get(name)
+                if entry is None:
+                    entry = _Entry(path)
+                    self._entries[name] = entry
+                entry.stat_key, entry.info, entry.info_error = stat_key, info, error
+            for name in list(self._entries):
+                if name not in paths and self._entries[name].status == "unloaded":
+                    del self._entries[name]
+            return list(self._entries)
+
+    def resolve(self, name: Optional[str] = None) -> str:
+        """
+        Map a requested model name to a registry name
+
+        Accepts the file name with or without the .gguf extension; None or
+        "default" means the default model.
+
+        Raises:
+            ModelNotFoundError: If no such model exists
+        """
+        if not name or name == "default":
+            return self.default_model
+        if not isinstance(name, str):
+            raise ModelNotFoundError("model must be a string")
+        with self._cond:
+            if name in self._entries:
+                return name
+            if f"{name}.gguf" in self._entries:
+                return f"{name}.gguf"
+        # The file may have been added since the last scan
+        known = self.scan()
+        for candidate in (name, f"{name}.gguf"):
+            if candidate in known:
+                return candidate
+        raise ModelNotFoundError(f"Unknown model: {name}")
+
+    def path_of(self, name: Optional[str] = None) -> Path:
+        """File path of a model, without loading it"""
+        name = self.resolve(name)
+        with self._cond:
+            return self._entries[name].path
+
+    def estimate_memory(self, entry: _Entry) -> int:
+        """Bytes a loaded copy set of the model is expected to take"""
+        info = entry.info or {}
+        size = info.get("size_bytes") or 0
+
+        kv = 0
+        dims = [info.get(k) for k in ("block_count", "embedding_length", "head_count", "head_count_kv")]
+        # Some architectures give per-layer head counts as arrays; those
+        # fall back to full-width attention
+        if all(isinstance(d, int) and d > 0 for d in dims[:2]):
+            layers, width, heads, kv_heads = dims
+            if isinstance(heads, int) and isinstance(kv_heads, int) and heads > 0:
+                width = width * kv_heads // heads
+            kv = 2 * layers * self.n_ctx * width * KV_BYTES_PER_ELEMENT
+
+        return (size + kv + self.kv_cache_max_bytes) * self.copies
+
+    def acquire(
+        self,
+        name: Optional[str] = None,
+        timeout: Optional[float] = None,
+        load: bool = True,
+    ) -> ModelLease:
+        """
+        Check out a model for a request, loading it if needed
+
+        Args:
+            name: Requested model, None for the default
+            timeout: Seconds to wait for a load; None waits until it finishes
+            load: Whether to load the model; when False a model that is not
+                ready raises ModelUnavailableError at once
+
+        Returns:
+            A lease whose service serves the request; release it when done
+
+        Raises:
+            ModelNotFoundError: If the model does not exist
+            ModelUnavailableError: If it failed to load or did not finish
+                loading within the timeout
+        """
+        name = self.resolve(name)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        waited_for = None
+        with self._cond:
+            entry = self._entries[name]
+            while True:
+                if self._closed:
+                    raise ModelUnavailableError("Model registry is shut down", retry_after=None)
+                if entry.status == "ready":
+                    entry.in_use += 1
+                    entry.last_used = time.monotonic()
+                    return ModelLease(self, name, entry.service)
+                if not load:
+                    raise ModelUnavailableError(f"Model {name} is not loaded")
+                if entry.status == "failed" and waited_for == entry.generation:
+                    raise ModelUnavailableError(f"Model {name} failed to load: {entry.error}", retry_after=None)
+                if entry.status in ("unloaded", "failed"):
+                    # A failure seen by a new request is retried, the file
+                    # may have been fixed since
+                    self._start_load(name, entry)
+                waited_for = entry.generation
+
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise ModelUnavailableError(f"Model {name} is still loading", retry_after=10)
+                self._cond.wait(remaining)
+
+    def preload(self, name: Optional[str] = None):
+        """Start loading a model in the background if it is not loaded"""
+        name = self.resolve(name)
+        with self._cond:
+            entry = self._entries[name]
+            if entry.status in ("unloaded", "failed") and not self._closed:
+                self._start_load(name, entry)
+
+    def load(self, name: Optional[str] = None, timeout: Optional[float] = None):
+        """Load a model (if needed) and return its service without holding it"""
+        lease = self.acquire(name, timeout)
+        lease.release()
+        return lease.service
+
+    def peek(self, name: Optional[str] = None):
+        """The loaded service of a model, or None. Does not load or check out."""
+        try:
+            name = self.resolve(name)
+        except ModelNotFoundError:
+            return None
+        with self._cond:
+            entry = self._entries[name]
+            return entry.service if entry.status == "ready" else None
+
+    def _release(self, name: str):
+        with self._cond:
+            entry = self._entries.get(name)
+            if entry is not None:
+                entry.in_use -= 1
+                entry.last_used = time.monotonic()
+            self._cond.notify_all()
+
+    def _start_load(self, name: str, entry: _Entry):
+        """Queue a model for loading on its own thread. Caller holds the lock."""
+        entry.status = "queued"
+        entry.error = None
+        entry.queued_at = time.monotonic()
+        entry.load_ms = entry.warmup_ms = None
+        entry.generation += 1
+        entry.memory_bytes = self.estimate_memory(entry)
+        thread = threading.Thread(target=self._load, args=(name, entry), name=f"model-load-{name}", daemon=True)
+        thread.start()
+
+    def _fits(self, entry: _Entry) -> bool:
+        """Whether the entry can load next to what is loaded. Caller holds the lock."""
+        others = [e for e in self._entries.values() if e is not entry and e.status in _RESIDENT]
+        if not others:
+            # A model bigger than the whole budget still loads on its own
+            return True
+        used = sum(e.memory_bytes for e in others)
+        return self.memory_budget_bytes > 0 and used + entry.memory_bytes <= self.memory_budget_bytes
+
+    def _make_room(self, entry: _Entry) -> bool:
+        """
+        Evict idle models until the entry fits the budget, then mark it loading
+
+        Waits for in-use models to be released, up to load_timeout. With a
+        zero budget every other model is evicted.
+
+        Returns:
+            False if room could not be made in time
+        """
+        deadline = time.monotonic() + self.load_timeout
+        victims = []
+        with self._cond:
+            while not self._fits(entry):
+                # Least recently used idle model first
+                idle = [e for e in self._entries.values() if e is not entry and e.status == "ready" and e.in_use == 0]
+                if idle:
+                    victim = min(idle, key=lambda e: e.last_used)
+                    victims.append(victim.service)
+                    victim.service, victim.status, victim.memory_bytes = None, "unloaded", 0
+                    self.evictions += 1
+                    continue
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._closed:
+                    break
+                self._cond.wait(remaining)
+            fits = self._fits(entry)
+            if fits:
+                entry.status = "loading"
+
+        for service in victims:
+            logger.info(f"Evicting model {service.model_path} to make room")
+            self._unload(service)
+        return fits
+
+    def _load(self, name: str, entry: _Entry):
+        """Loader thread: make room, build and warm the service, then wake the waiters"""
+        service, error = None, None
+        try:
+            if entry.info_error:
+                raise RuntimeError(entry.info_error)
+            if not self._make_room(entry):
+                raise RuntimeError("not enough memory while other models are in use")
+            logger.info(f"Loading model {name} (~{entry.memory_bytes / 2**20:.0f} MB)")
+            started = time.monotonic()
+            service = self.service_factory(entry.path)
+            entry.load_ms = (time.monotonic() - started) * 1000
+        except Exception as e:
+            error = str(e)
+            logger.error(f"Failed to load model {name}: {e}")
+
+        if service is not None and self.warmup_prompt:
+            with self._cond:
+                entry.status = "warming"
+                self._cond.notify_all()
+            try:
+                entry.warmup_ms = service.warmup(self.warmup_prompt)
+            except Exception as e:
+                # A cold model still works, only the first request is slower
+                logger.warning(f"Warmup of model {name} failed: {e}")
+
+        with self._cond:
+            if service is not None and not self._closed:
+                entry.service = service
+                entry.status = "ready"
+                entry.last_used = time.monotonic()
+                self.loads += 1
+                service = None
+                warmup = f", warmup {entry.warmup_ms:.0f} ms" if entry.warmup_ms is not None else ""
+                logger.info(f"Model {name} ready (load {entry.load_ms:.0f} ms{warmup})")
+            else:
+                entry.status = "failed"
+                entry.error = error or "registry shut down"
+                entry.memory_bytes = 0
+            self._cond.notify_all()
+        if service is not None:
+            self._unload(service)
+
+    @staticmethod
+    def _unload(service):
+        try:
+            service.unload_model()
+        except Exception as e:
+            logger.error(f"Error unloading model: {e}")
+
+    def unload(self, name: Optional[str] = None) -> bool:
+        """Unload a model now if it is idle. Returns False if it is in use."""
+        name = self.resolve(name)
+        with self._cond:
+            entry = self._entries[name]
+            if entry.status != "ready":
+                return True
+            if entry.in_use:
+                return False
+            service = entry.service
+            entry.service, entry.status, entry.memory_bytes = None, "unloaded", 0
+            self.evictions += 1
+            self._cond.notify_all()
+        self._unload(service)
+        return True
+
+    def progress(self, name: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Load state of a model, for readiness checks
+
+        Returns:
+            Dict with model, status, ready, error, elapsed_ms (since the
+            latest load was queued), load_ms and warmup_ms
+        """
+        name = self.resolve(name)
+        with self._cond:
+            entry = self._entries[name]
+            elapsed = None
+            if entry.queued_at is not None:
+                elapsed = round((time.monotonic() - entry.queued_at) * 1000, 1)
+            return {
+                "model": name,
+                "status": entry.status,
+                "ready": entry.status == "ready",
+                "error": entry.error,
+                "elapsed_ms": elapsed,
+                "load_ms": round(entry.load_ms, 1) if entry.load_ms is not None else None,
+                "warmup_ms": round(entry.warmup_ms, 1) if entry.warmup_ms is not None else None,
+            }
+
+    def list_models(self) -> List[Dict[str, Any]]:
+        """Every known model with its header info and load state"""
+        self.scan()
+        with self._cond:
+            models = []
+            for name, entry in self._entries.items():
+                info = entry.info or {}
+                models.append({
+                    "name": name,
+                    "display_name": info.get("name"),
+                    "path": str(entry.path),
+                    "default": name == self.default_model,
+                    "architecture": info.get("architecture"),
+                    "context_length": info.get("context_length"),
+                    "quantization": info.get("file_type"),
+                    "size_label": info.get("size_label"),
+                    "size_bytes": info.get("size_bytes"),
+                    "estimated_memory_bytes": self.estimate_memory(entry),
+                    "status": entry.status,
+                    "loaded": entry.status == "ready",
+                    "in_use": entry.in_use,
+                    "load_ms": round(entry.load_ms, 1) if entry.load_ms is not None else None,
+                    "warmup_ms": round(entry.warmup_ms, 1) if entry.warmup_ms is not None else None,
+                    "error": entry.error or entry.info_error,
+                })
+            return models
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "memory_budget_bytes": self.memory_budget_bytes,
+                "memory_used_bytes": sum(e.memory_bytes for e in self._entries.values() if e.status in _RESIDENT),
+                "loaded": [n for n, e in self._entries.items() if e.status == "ready"],
+                "loading": [n for n, e in self._entries.items() if e.status in ("queued", "loading", "warming")],
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
+
+    def shutdown(self):
+        """Unload every model"""
+        with self._cond:
+            self._closed = True
+            services = [e.service for e in self._entries.values() if e.service is not None]
+            for entry in self._entries.values():
+                entry.service, entry.status = None, "unloaded"
+            self._cond.notify_all()
+        for service in services:
+            self._unload(service)
@@ -0,0 +1,236 @@
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import struct
+import threading
+import time
+import uuid
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_MAGIC = b"LKVS"
+SNAPSHOT_VERSION = 1
+# Magic, format version, length of the JSON header that follows
+_PREAMBLE = struct.Struct("<4sII")
+# Token ids and state data start on this boundary
+_ALIGNMENT = 64
+
+# Bytes read from each end of a model file to identify it
+MODEL_HASH_SAMPLE_BYTES = 1 << 20
+
+
+def model_hash(model_path) -> str:
+    """
+    Identify the contents of a model file without reading all of it
+
+    Hashes the file size with the first and last MiB, which cover the GGUF
+    header and metadata and the final tensor. A re-quantized or replaced
+    model changes the hash; touching the file does not.
+    """
+    path = Path(model_path)
+    size = path.stat().st_size
+    digest = hashlib.sha256(str(size).encode("ascii"))
+    with open(path, "rb") as f:
+        digest.update(f.read(MODEL_HASH_SAMPLE_BYTES))
+        if size > MODEL_HASH_SAMPLE_BYTES:
+            f.seek(max(MODEL_HASH_SAMPLE_BYTES, size - MODEL_HASH_SAMPLE_BYTES))
+            digest.update(f.read(MODEL_HASH_SAMPLE_BYTES))
+    return digest.hexdigest()
+
+
+def _align(offset: int) -> int:
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+class PromptSnapshotStore:
+    """
+    On-disk llama.cpp states of evaluated system-prompt prefixes for one model
+
+    Snapshots live in <directory>/<model name>/<model hash>/, one file per
+    prompt prefix and context size, named by the hash of the prefix's token
+    ids. When the model file changes its hash changes too, and the
+    snapshots of the old file are deleted when the store is opened.
+
+    A file holds a small JSON header, the prefix's token ids and the raw
+    state data, and is read through a memory map so restoring a snapshot
+    pages in only what llama.cpp copies into its context.
+    """
+
+    def __init__(self, directory, model_path, n_ctx: int):
+        """
+        Args:
+            directory: Root directory for snapshots of all models
+            model_path: Model file the states belong to
+            n_ctx: Context size of the service; states are not portable
+                between context sizes
+        """
+        self.model_path = Path(model_path)
+        self.n_ctx = n_ctx
+        model_dir = Path(directory) / self.model_path.stem
+        self.directory = model_dir / model_hash(self.model_path)[:16]
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._prune_stale(model_dir)
+        self._lock = threading.Lock()
+
+        self.saved = 0
+        self.restored = 0
+        self.failures = 0
+
+    def _prune_stale(self, model_dir: Path):
+        """Delete snapshots taken with an earlier version of the model file"""
+        for entry in model_dir.iterdir():
+            if entry.is_dir() and entry != self.directory:
+                logger.info(f"Removing stale KV snapshots in {entry}")
+                shutil.rmtree(entry, ignore_errors=True)
+
+    def path_for(self, tokens: List[int]) -> Path:
+        """Snapshot file of a token prefix"""
+        digest = hashlib.sha256(np.asarray(tokens, dtype=np.int32).tobytes()).hexdigest()[:32]
+        return self.directory / f"{digest}-{self.n_ctx}.kv"
+
+    def has(self, tokens: List[int]) -> bool:
+        return self.path_for(tokens).exists()
+
+    def save(self, tokens: List[int], state_data, seed: int = 0) -> Path:
+        """
+        Write the state of a context that holds exactly `tokens`
+
+        The file is written under a temporary name and renamed into place,
+        so concurrent writers (e.g. inference workers) never expose a
+        partial snapshot.
+
+        Args:
+            tokens: Token ids evaluated into the context
+            state_data: Bytes-like llama.cpp state (LlamaState.llama_state)
+            seed: RNG seed stored with the state
+
+        Returns:
+            Path of the snapshot
+        """
+        path = self.path_for(tokens)
+        ids = np.asarray(tokens, dtype=np.int32)
+        state_size = len(state_data)
+        header = json.dumps({
+            "model": self.model_path.name,
+            "n_ctx": self.n_ctx,
+            "n_tokens": len(ids),
+            "state_size": state_size,
+            "seed": seed,
+            "created_at": time.time(),
+        }).encode("utf-8")
+
+        ids_offset = _align(_PREAMBLE.size + len(header))
+        state_offset = _align(ids_offset + ids.nbytes)
+        tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            with open(tmp, "wb") as f:
+                f.write(_PREAMBLE.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(header)))
+                f.write(header)
+                f.seek(ids_offset)
+                f.write(ids.tobytes())
+                f.seek(state_offset)
+                f.write(state_data)
+            os.replace(tmp, path)
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+
+        with self._lock:
+            self.saved += 1
+        logger.info(f"Saved KV snapshot of {len(ids)} prompt tokens ({state_size / 2**20:.1f} MB) to {path.name}")
+        return path
+
+    @contextmanager
+    def open(self, tokens: List[int]) -> Iterator[Optional[Dict[str, Any]]]:
+        """
+        Map a snapshot for reading
+
+        Yields:
+            None if there is no usable snapshot, otherwise a dict with the
+            header fields plus "input_ids" (int32 array) and "state"
+            (memoryview of the state data). Both are views of the mapped
+            file and are only valid inside the with block.
+        """
+        path = self.path_for(tokens)
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            yield None
+            return
+
+        with f:
+            try:
+                # Copy-on-write so the views are writable buffers, which
+                # ctypes and numpy accept without copying
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Could not map KV snapshot {path.name}: {e}")
+                with self._lock:
+                    self.failures += 1
+                yield None
+                return
+
+        view = memoryview(mapped)
+        snapshot = self._parse(view, tokens)
+        with self._lock:
+            if snapshot is None:
+                logger.warning(f"Ignoring unusable KV snapshot {path.name}")
+                self.failures += 1
+            else:
+                self.restored += 1
+        try:
+            yield snapshot
+        finally:
+            try:
+                if snapshot is not None:
+                    snapshot["state"].release()
+                    snapshot["input_ids"] = snapshot["state"] = None
+                view.release()
+                mapped.close()
+            except BufferError:
+                # A caller kept a view; the mapping is closed when it is freed
+                pass
+
+    def _parse(self, view: memoryview, tokens: List[int]) -> Optional[Dict[str, Any]]:
+        """Validate a mapped snapshot against the expected prefix"""
+        if len(view) < _PREAMBLE.size:
+            return None
+        magic, version, header_size = _PREAMBLE.unpack_from(view)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            return None
+        try:
+            header = json.loads(bytes(view[_PREAMBLE.size:_PREAMBLE.size + header_size]))
+        except ValueError:
+            return None
+
+        n_tokens, state_size = header["n_tokens"], header["state_size"]
+        ids_offset = _align(_PREAMBLE.size + header_size)
+        state_offset = _align(ids_offset + n_tokens * 4)
+        if header["n_ctx"] != self.n_ctx or n_tokens != len(tokens) or state_offset + state_size > len(view):
+            return None
+
+        input_ids = np.frombuffer(view, dtype=np.int32, count=n_tokens, offset=ids_offset)
+        # The hash in the file name could collide, the ids cannot
+        if not np.array_equal(input_ids, np.asarray(tokens, dtype=np.int32)):
+            return None
+        header["input_ids"] = input_ids
+        header["state"] = view[state_offset:state_offset + state_size]
+        return header
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "directory": str(self.directory),
+                "snapshots": sum(1 for _ in self.directory.glob("*.kv")),
+                "saved": self.saved,
+                "restored": self.restored,
+                "failures": self.failures,
+            }
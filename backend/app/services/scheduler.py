@@ -0,0 +1,235 @@
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+import heapq
+import itertools
+import math
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Lower value is served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 10
+# Speculative work such as prefill, preempted by any real request
+PRIORITY_PREFILL = 20
+
+PRIORITIES = {
+    "interactive": PRIORITY_INTERACTIVE,
+    "bulk": PRIORITY_BULK,
+}
+
+
+class SchedulerError(Exception):
+    """Base class for requests the scheduler refused to run"""
+
+    status_code = 503
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class QueueFullError(SchedulerError):
+    """The wait queue is at its maximum depth"""
+
+    status_code = 429
+
+
+class QueueTimeoutError(SchedulerError):
+    """The request waited longer than the queue timeout"""
+
+    status_code = 503
+
+
+class Ticket:
+    """A request's place in the scheduler queue and, once granted, its slot"""
+
+    def __init__(self, priority: int, seq: int):
+        self.priority = priority
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.started_at: Optional[float] = None
+        self.released = False
+        # Set on a preemptible ticket when another request wants a slot
+        self.preempted: Optional[threading.Event] = None
+
+    @property
+    def queue_wait_ms(self) -> float:
+        """Time spent waiting for a slot"""
+        end = self.started_at if self.started_at is not None else time.monotonic()
+        return (end - self.enqueued_at) * 1000
+
+    def __lt__(self, other: "Ticket") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class RequestScheduler:
+    """
+    Admission control and ordering for requests sharing the LLM
+
+    llama.cpp contexts are not thread safe, so at most `concurrency` requests
+    hold a slot at once. Waiting requests are served by priority, then FIFO.
+    When the queue is full new requests are rejected straight away instead of
+    piling up on Flask's request threads.
+
+    Speculative work takes a slot with try_acquire() only when the scheduler
+    is idle, and its ticket's `preempted` event is set as soon as a real
+    request arrives, so it can stop and give the slot up.
+    """
+
+    def __init__(
+        self,
+        max_queue_depth: int = 16,
+        concurrency: int = 1,
+        queue_timeout: float = 120.0,
+    ):
+        """
+        Args:
+            max_queue_depth: Maximum number of requests waiting for a slot
+            concurrency: Number of requests allowed to run at once
+            queue_timeout: Seconds a request may wait before it is rejected
+        """
+        self.max_queue_depth = max_queue_depth
+        self.concurrency = concurrency
+        self.queue_timeout = queue_timeout
+
+        self._cond = threading.Condition()
+        self._queue: List[Ticket] = []
+        self._seq = itertools.count()
+        self._active = 0
+        self._preemptible: List[Ticket] = []
+
+        # Moving average of how long a request holds a slot, for Retry-After
+        self._avg_service_s = 5.0
+
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.preempted = 0
+
+    def acquire(self, priority: int = PRIORITY_INTERACTIVE, timeout: Optional[float] = None) -> Ticket:
+        """
+        Wait for a slot
+
+        Args:
+            priority: Request priority (lower is served first)
+            timeout: Seconds to wait, defaults to the scheduler's queue timeout
+
+        Returns:
+            The granted Ticket, to be passed to release()
+
+        Raises:
+            QueueFullError: The queue is at maximum depth
+            QueueTimeoutError: No slot became free in time
+        """
+        timeout = self.queue_timeout if timeout is None else timeout
+
+        with self._cond:
+            if len(self._queue) >= self.max_queue_depth:
+                self.rejected += 1
+                raise QueueFullError("Server is busy, request queue is full", self._retry_after())
+
+            ticket = Ticket(priority, next(self._seq))
+            heapq.heappush(self._queue, ticket)
+            deadline = ticket.enqueued_at + timeout
+            self._preempt()
+
+            while not (self._active < self.concurrency and self._queue[0] is ticket):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._queue.remove(ticket)
+                    heapq.heapify(self._queue)
+                    self.timed_out += 1
+                    # Our leaving may let the next waiter through
+                    self._cond.notify_all()
+                    raise QueueTimeoutError("Timed out waiting for the model", self._retry_after())
+                self._cond.wait(remaining)
+
+            heapq.heappop(self._queue)
+            self._active += 1
+            ticket.started_at = time.monotonic()
+            # The next waiter may also fit if concurrency > 1
+            self._cond.notify_all()
+
+        if ticket.queue_wait_ms > 1000:
+            logger.info(f"Request waited {ticket.queue_wait_ms:.0f} ms for a slot")
+        return ticket
+
+    def try_acquire(self, priority: int = PRIORITY_PREFILL) -> Optional[Ticket]:
+        """
+        Take a preemptible slot if the scheduler is idle, without waiting
+
+        Returns:
+            A Ticket whose `preempted` event is set when another request
+            arrives, or None if a slot is busy or requests are waiting
+        """
+        with self._cond:
+            if self._active > 0 or self._queue:
+                return None
+            ticket = Ticket(priority, next(self._seq))
+            ticket.preempted = threading.Event()
+            ticket.started_at = ticket.enqueued_at
+            self._active += 1
+            self._preemptible.append(ticket)
+            return ticket
+
+    def _preempt(self):
+        """Ask running preemptible work to stop (lock held)"""
+        for ticket in self._preemptible:
+            if not ticket.preempted.is_set():
+                ticket.preempted.set()
+                self.preempted += 1
+
+    def release(self, ticket: Ticket):
+        """Give a slot back. Safe to call more than once for the same ticket."""
+        with self._cond:
+            if ticket.released or ticket.started_at is None:
+                return
+            ticket.released = True
+            self._active -= 1
+            if ticket.preempted is not None:
+                # Speculative work does not count towards service times
+                self._preemptible.remove(ticket)
+                self._cond.notify_all()
+                return
+            self.completed += 1
+
+            service_s = time.monotonic() - ticket.started_at
+            self._avg_service_s = 0.8 * self._avg_service_s + 0.2 * service_s
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, priority: int = PRIORITY_INTERACTIVE, timeout: Optional[float] = None):
+        """Context manager holding a slot for the duration of the block"""
+        ticket = self.acquire(priority, timeout)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def _retry_after(self) -> int:
+        """Estimated seconds until a new request could be admitted (lock held)"""
+        backlog = len(self._queue) + self._active
+        return max(1, math.ceil(backlog * self._avg_service_s / max(1, self.concurrency)))
+
+    def retry_after(self) -> int:
+        """Estimated seconds until a new request could be admitted"""
+        with self._cond:
+            return self._retry_after()
+
+    def stats(self) -> Dict[str, Any]:
+        """Queue depth and counters"""
+        with self._cond:
+            return {
+                "queued": len(self._queue),
+                "active": self._active,
+                "concurrency": self.concurrency,
+                "max_queue_depth": self.max_queue_depth,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+                "preempted": self.preempted,
+                "avg_service_ms": round(self._avg_service_s * 1000, 1),
+            }
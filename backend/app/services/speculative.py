@@ -0,0 +1,131 @@
+from typing import Any, Dict, Optional
+from llama_cpp import Llama
+from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Values of Config.SPECULATIVE_DECODING
+SPECULATIVE_MODES = ("", "prompt_lookup", "draft")
+
+
+class GGUFDraftModel(LlamaDraftModel):
+    """
+    Drafts tokens greedily with a small GGUF model
+
+    The draft model must share the target model's vocabulary (e.g. a 0.5B
+    model of the same family). Its context keeps the previous call's tokens,
+    so each call only evaluates what the target accepted since.
+    """
+
+    def __init__(
+        self,
+        model_path: str,
+        num_pred_tokens: int = 10,
+        n_ctx: int = 2048,
+        n_threads: int = 4,
+        n_gpu_layers: int = 0,
+    ):
+        """
+        Args:
+            model_path: Path to the draft .gguf file
+            num_pred_tokens: Tokens drafted per step
+            n_ctx: Context size, the same as the target's
+            n_threads: CPU threads for the draft model
+            n_gpu_layers: Layers of the draft model offloaded to the GPU
+        """
+        self.num_pred_tokens = num_pred_tokens
+        self.llm = Llama(
+            model_path=str(model_path),
+            n_ctx=n_ctx,
+            n_gpu_layers=n_gpu_layers,
+            n_threads=n_threads,
+            verbose=False,
+        )
+
+    def __call__(self, input_ids: np.ndarray, /, **kwargs: Any) -> np.ndarray:
+        tokens = input_ids.tolist()
+        room = self.llm.n_ctx() - len(tokens)
+        if room <= 0:
+            return np.array([], dtype=np.intc)
+
+        draft = []
+        # generate() reuses the longest common prefix with the context
+        for token in self.llm.generate(tokens, top_k=1, temp=0.0, reset=True):
+            if token == self.llm.token_eos() or len(draft) >= min(self.num_pred_tokens, room):
+                break
+            draft.append(token)
+        return np.array(draft, dtype=np.intc)
+
+
+class CountingDraftModel(LlamaDraftModel):
+    """
+    Wraps a draft model to count proposed tokens per request
+
+    llama-cpp-python calls the draft model once before every batch it
+    evaluates, and each batch yields one token of the target's own plus the
+    drafted tokens it accepted, so accepted = completion tokens - calls.
+    """
+
+    def __init__(self, draft_model: LlamaDraftModel):
+        self.draft_model = draft_model
+        self.calls = 0
+        self.proposed = 0
+
+    def __call__(self, input_ids: np.ndarray, /, **kwargs: Any) -> np.ndarray:
+        draft = self.draft_model(input_ids, **kwargs)
+        self.calls += 1
+        self.proposed += len(draft)
+        return draft
+
+    def reset(self):
+        self.calls = 0
+        self.proposed = 0
+
+    def summary(self, completion_tokens: int) -> Dict[str, Any]:
+        """Draft statistics of the request since reset()"""
+        accepted = min(max(completion_tokens - self.calls, 0), self.proposed)
+        return {
+            "draft_tokens": self.proposed,
+            "draft_accepted_tokens": accepted,
+            "draft_acceptance_rate": round(accepted / self.proposed, 3) if self.proposed else None,
+        }
+
+
+def create_draft_model(
+    mode: str,
+    num_pred_tokens: int = 10,
+    max_ngram_size: int = 2,
+    draft_model_path: Optional[str] = None,
+    n_ctx: int = 2048,
+    n_threads: int = 4,
+) -> Optional[CountingDraftModel]:
+    """
+    Build the draft model for a speculative decoding mode
+
+    Args:
+        mode: "" (off), "prompt_lookup" (drafts by matching the latest
+            n-gram against earlier context, no extra model) or "draft"
+            (a small GGUF model)
+        num_pred_tokens: Tokens drafted per step
+        max_ngram_size: Longest n-gram prompt lookup matches
+        draft_model_path: Draft .gguf file, required for "draft"
+        n_ctx: Context size of the target model
+        n_threads: CPU threads for a draft GGUF model
+
+    Returns:
+        A counting wrapper around the draft model, None when mode is off
+    """
+    if mode not in SPECULATIVE_MODES:
+        raise ValueError(f"Unknown speculative decoding mode: {mode}")
+    if not mode:
+        return None
+    if mode == "prompt_lookup":
+        draft = LlamaPromptLookupDecoding(max_ngram_size=max_ngram_size, num_pred_tokens=num_pred_tokens)
+    else:
+        if not draft_model_path:
+            raise ValueError("Speculative mode 'draft' needs a draft model path")
+        draft = GGUFDraftModel(draft_model_path, num_pred_tokens=num_pred_tokens, n_ctx=n_ctx, n_threads=n_threads)
+    logger.info(f"Speculative decoding: {mode}, {num_pred_tokens} tokens per draft")
+    return CountingDraftModel(draft)
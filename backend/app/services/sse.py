@@ -0,0 +1,87 @@
+from typing import List, Optional
+import json
+import time
+
+# Compact JSON: frames are small and sent often
+_dumps = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False).encode
+
+
+class SSEEncoder:
+    """
+    Encodes a token stream as server-sent events
+
+    Every frame is one JSON object with a sequence number and a type, sent as
+
+        id: <seq>
+        data: {"seq": <seq>, "type": "token", "text": "..."}
+
+    JSON escapes newlines, so a token that contains one cannot break the
+    framing. Tokens are coalesced: the first token is sent at once (time to
+    first token is unchanged), later tokens are buffered until `window_ms`
+    has passed since the last frame or `max_chars` characters are waiting.
+    A frame is only written when a token arrives, so text is held back for
+    at most one token interval beyond the window.
+
+    The full response is accumulated as a list of pieces and joined once.
+    """
+
+    def __init__(self, window_ms: float = 30.0, max_chars: int = 1024):
+        """
+        Args:
+            window_ms: Time tokens are collected into one frame, 0 = one
+                frame per token
+            max_chars: Buffered characters that force a frame
+        """
+        self.window = window_ms / 1000
+        self.max_chars = max_chars
+        self.seq = 0
+        self.frames = 0
+        self.tokens = 0
+        self._parts: List[str] = []
+        self._pending: List[str] = []
+        self._pending_chars = 0
+        self._last_frame_at: Optional[float] = None
+
+    @property
+    def text(self) -> str:
+        """Everything passed to token() so far, sent or not"""
+        return "".join(self._parts)
+
+    def event(self, type: str, **fields) -> str:
+        """Encode one frame"""
+        self.seq += 1
+        self.frames += 1
+        payload = {"seq": self.seq, "type": type}
+        payload.update(fields)
+        return f"id: {self.seq}\ndata: {_dumps(payload)}\n\n"
+
+    def token(self, text: str) -> Optional[str]:
+        """
+        Add a token
+
+        Returns:
+            A frame with the buffered tokens when one is due, otherwise None
+        """
+        self.tokens += 1
+        self._parts.append(text)
+        self._pending.append(text)
+        self._pending_chars += len(text)
+
+        now = time.perf_counter()
+        if (
+            self._last_frame_at is None
+            or now - self._last_frame_at >= self.window
+            or self._pending_chars >= self.max_chars
+        ):
+            self._last_frame_at = now
+            return self.flush()
+        return None
+
+    def flush(self) -> Optional[str]:
+        """Frame of the buffered tokens, None if there are none"""
+        if not self._pending:
+            return None
+        text = "".join(self._pending)
+        self._pending.clear()
+        self._pending_chars = 0
+        return self.event("token", text=text)
@@ -0,0 +1,161 @@
+from collections import deque
+from itertools import islice
+from typing import Dict, Iterator, Optional
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class StreamGapError(Exception):
+    """The events a client asked for are no longer buffered"""
+
+    status_code = 410
+
+
+class StreamBuffer:
+    """
+    Bounded buffer of the SSE frames of one streaming generation
+
+    The generation appends frames from its own thread; HTTP connections read
+    them from any position, so a client that lost its connection can
+    reconnect, get the frames it missed and continue with the live tail.
+    Frames carry consecutive sequence numbers starting at 1. Only the last
+    `max_frames` are kept.
+    """
+
+    def __init__(self, request_id: str, max_frames: int = 4096):
+        self.request_id = request_id
+        self._frames = deque(maxlen=max_frames)
+        self._cond = threading.Condition()
+        self._next_seq = 1
+        self.finished = False
+        self.finished_at: Optional[float] = None
+        self.attached = 0
+        self.detached_at: Optional[float] = None
+
+    def append(self, seq: int, frame: str):
+        """Add the frame with sequence number `seq`, the one after the last"""
+        with self._cond:
+            self._frames.append(frame)
+            self._next_seq = seq + 1
+            self._cond.notify_all()
+
+    def finish(self):
+        """Mark the generation as done; readers stop after the last frame"""
+        with self._cond:
+            self.finished = True
+            self.finished_at = time.monotonic()
+            self._cond.notify_all()
+
+    def attach(self):
+        """A connection started reading"""
+        with self._cond:
+            self.attached += 1
+
+    def detach(self):
+        """A connection closed, normally or because the client went away"""
+        with self._cond:
+            self.attached = max(0, self.attached - 1)
+            if self.attached == 0:
+                self.detached_at = time.monotonic()
+
+    def abandoned(self, grace: float) -> bool:
+        """Whether every client has been gone for more than `grace` seconds"""
+        with self._cond:
+            return (
+                self.attached == 0
+                and self.detached_at is not None
+                and time.monotonic() - self.detached_at > grace
+            )
+
+    def check(self, after: int):
+        """Raise StreamGapError if the frames following `after` were dropped"""
+        with self._cond:
+            oldest = self._next_seq - len(self._frames)
+            if after + 1 < oldest:
+                raise StreamGapError(
+                    f"Events before {oldest} of request {self.request_id} are no longer buffered"
+                )
+
+    def read(self, after: int = 0, poll: float = 1.0) -> Iterator[str]:
+        """
+        Yield the frames after sequence number `after`, then the live tail
+
+        Args:
+            after: Last sequence number the client has (Last-Event-ID)
+            poll: Seconds between checks while waiting for a frame
+
+        Raises:
+            StreamGapError: The reader fell behind the buffer
+        """
+        next_seq = after + 1
+        while True:
+            with self._cond:
+                while self._next_seq <= next_seq and not self.finished:
+                    self._cond.wait(poll)
+                oldest = self._next_seq - len(self._frames)
+                if next_seq < oldest:
+                    raise StreamGapError(
+                        f"Events before {oldest} of request {self.request_id} are no longer buffered"
+                    )
+                pending = list(islice(self._frames, next_seq - oldest, None))
+                done = self.finished
+            for frame in pending:
+                yield frame
+            next_seq += len(pending)
+            if done:
+                return
+
+
+class StreamRegistry:
+    """
+    Stream buffers by request id
+
+    A buffer lives for the whole generation and `ttl` seconds after it,
+    so a client whose connection dropped near the end can still fetch the
+    rest of the answer.
+    """
+
+    def __init__(self, ttl: float = 60.0, grace: float = 30.0, max_frames: int = 4096):
+        """
+        Args:
+            ttl: Seconds a finished stream stays available
+            grace: Seconds a generation continues without a connected
+                client before it is cancelled
+            max_frames: Frames kept per stream
+        """
+        self.ttl = ttl
+        self.grace = grace
+        self.max_frames = max_frames
+        self._buffers: Dict[str, StreamBuffer] = {}
+        self._lock = threading.Lock()
+
+    def create(self, request_id: str) -> StreamBuffer:
+        """Start buffering a request, replacing an expired stream with the same id"""
+        buffer = StreamBuffer(request_id, self.max_frames)
+        with self._lock:
+            self._prune()
+            self._buffers[request_id] = buffer
+        return buffer
+
+    def get(self, request_id: str) -> Optional[StreamBuffer]:
+        with self._lock:
+            self._prune()
+            return self._buffers.get(request_id)
+
+    def _prune(self):
+        now = time.monotonic()
+        expired = [
+            request_id
+            for request_id, buffer in self._buffers.items()
+            if buffer.finished and now - buffer.finished_at > self.ttl
+        ]
+        for request_id in expired:
+            del self._buffers[request_id]
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._prune()
+            return len(self._buffers)
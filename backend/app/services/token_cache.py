@@ -0,0 +1,83 @@
+from array import array
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List
+import hashlib
+import threading
+
+
+class TokenCache:
+    """
+    LRU cache of token ids for formatted chat messages
+
+    Chat history is re-sent on every turn, so almost every message of a prompt
+    has been tokenized before. Entries are keyed by a hash of the message's
+    role and content and the cache is bounded by the total number of token
+    ids it holds.
+    """
+
+    def __init__(self, max_tokens: int = 2_000_000):
+        """
+        Args:
+            max_tokens: Total token ids kept across all entries
+        """
+        self.max_tokens = max_tokens
+        self._entries: "OrderedDict[bytes, array]" = OrderedDict()
+        self._total_tokens = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(role: str, content: str) -> bytes:
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(role.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(content.encode("utf-8"))
+        return digest.digest()
+
+    def get_or_tokenize(self, role: str, content: str, tokenize: Callable[[], List[int]]) -> array:
+        """
+        Return the cached token ids for a message, tokenizing it on a miss
+
+        Args:
+            role: Message role
+            content: Message content
+            tokenize: Produces the token ids of the formatted message
+        """
+        key = self.make_key(role, content)
+        with self._lock:
+            tokens = self._entries.get(key)
+            if tokens is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return tokens
+            self.misses += 1
+
+        tokens = array("i", tokenize())
+        with self._lock:
+            if key not in self._entries and len(tokens) <= self.max_tokens:
+                self._entries[key] = tokens
+                self._total_tokens += len(tokens)
+                while self._total_tokens > self.max_tokens:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._total_tokens -= len(evicted)
+        return tokens
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_tokens = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Size and hit-rate counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "tokens": self._total_tokens,
+                "max_tokens": self.max_tokens,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
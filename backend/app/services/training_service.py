@@ -0,0 +1,927 @@
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+from numpy.lib.format import open_memmap
+from sqlalchemy import delete, insert, select, update
+from .llm_service import ASSISTANT_HEADER, format_chat_message
+import numpy as np
+import gzip
+import io
+import json
+import multiprocessing
+import os
+import queue
+import shutil
+import threading
+import time
+import uuid
+import zlib
+import logging
+
+try:
+    import zstandard
+except ImportError:  # Optional, only needed for zstd exports
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# Record layouts: chat messages, or the ChatML text the model is trained on
+EXPORT_FORMATS = ("messages", "chatml")
+COMPRESSIONS = ("none", "gzip", "zstd")
+FILE_EXTENSIONS = {"none": ".jsonl", "gzip": ".jsonl.gz", "zstd": ".jsonl.zst"}
+CONTENT_TYPES = {"none": "application/x-ndjson", "gzip": "application/gzip", "zstd": "application/zstd"}
+
+# Conversations sent to a tokenizer process per task
+TOKENIZE_BATCH = 64
+
+# Packed sequences being filled at once; more of them leave less padding
+OPEN_SEQUENCES = 16
+
+# Arrays of a packed dataset shard, all (sequences, n_ctx)
+SHARD_ARRAYS = {"tokens": np.int32, "loss_mask": np.uint8, "segments": np.int32}
+
+# Finished dataset jobs kept for status queries
+MAX_FINISHED_JOBS = 100
+
+
+class ExportInProgressError(RuntimeError):
+    """Another export with the same name is running"""
+
+    status_code = 409
+
+
+class _Identity:
+    """Compressor interface for uncompressed output"""
+
+    def compress(self, data: bytes) -> bytes:
+        return data
+
+    def flush(self) -> bytes:
+        return b""
+
+
+def create_compressor(compression: str):
+    """
+    Incremental compressor for a stream of bytes
+
+    Returns:
+        Object with compress(bytes) and flush(), like zlib's compressobj
+    """
+    if compression == "none":
+        return _Identity()
+    if compression == "gzip":
+        # wbits 31 writes a gzip header and trailer
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+    if compression == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd compression needs the zstandard package")
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    raise ValueError(f"Unknown compression: {compression}")
+
+
+class TrainingExporter:
+    """
+    Exports stored conversations as JSONL datasets for fine-tuning
+
+    Messages are read through a streaming cursor in batches, grouped into
+    one record per conversation and encoded, compressed and written as they
+    arrive, so memory use depends on the longest conversation rather than on
+    the size of the database.
+
+    Incremental exports remember the newest message id they wrote under an
+    export name (the watermark) and next time only read messages after it.
+    A record then holds a conversation's new messages only; records of the
+    same conversation across exports share its conversation_id.
+    """
+
+    def __init__(
+        self,
+        engine,
+        messages_table,
+        conversations_table,
+        watermarks_table,
+        output_dir,
+        chunk_records: int = 10000,
+        batch_size: int = 500,
+        compression: str = "gzip",
+    ):
+        """
+        Args:
+            engine: SQLAlchemy engine to read with
+            messages_table: Message.__table__
+            conversations_table: Conversation.__table__
+            watermarks_table: ExportWatermark.__table__
+            output_dir: Directory export files are written to
+            chunk_records: Records per file of an export
+            batch_size: Rows fetched from the database at a time
+            compression: Default compression, "none", "gzip" or "zstd"
+        """
+        self.engine = engine
+        self.messages = messages_table
+        self.conversations = conversations_table
+        self.watermarks = watermarks_table
+        self.output_dir = Path(output_dir)
+        self.chunk_records = chunk_records
+        self.batch_size = batch_size
+        self.compression = compression
+
+        self._running: set = set()
+        self._lock = threading.Lock()
+
+    def records(
+        self,
+        format: str = "messages",
+        since_message_id: int = 0,
+        conversation_ids: Optional[Sequence[int]] = None,
+        updated_since: Optional[datetime] = None,
+        include_cancelled: bool = False,
+        scan: Optional[Dict[str, Any]] = None,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Yield one training record per conversation
+
+        Args:
+            format: "messages" (role/content list) or "chatml" (one text)
+            since_message_id: Only messages with a higher id
+            conversation_ids: Only these conversations
+            updated_since: Only conversations updated at or after this time
+            include_cancelled: Keep assistant replies whose generation was
+                cancelled, which are usually cut off mid-sentence
+            scan: Dict updated with "messages" read and "last_message_id",
+                the highest id read, whether or not it was exported
+
+        Yields:
+            Dicts with conversation_id, title, first_message_id,
+            last_message_id and "messages" or "text". Conversations without
+            an assistant reply are skipped, there is nothing to train on.
+        """
+        if format not in EXPORT_FORMATS:
+            raise ValueError(f"Unknown export format: {format}")
+        if scan is None:
+            scan = {}
+        scan.setdefault("messages", 0)
+        scan.setdefault("last_message_id", since_message_id)
+
+        m, c = self.messages, self.conversations
+        query = (
+            select(m.c.id, m.c.conversation_id, m.c.role, m.c.content, m.c.message_metadata, c.c.title)
+            .join(c, c.c.id == m.c.conversation_id)
+            .order_by(m.c.conversation_id, m.c.created_at, m.c.id)
+        )
+        if since_message_id:
+            # Conversations with new messages are found through the primary
+            # key, so an incremental run does not read the whole table
+            changed = select(m.c.conversation_id).where(m.c.id > since_message_id).distinct()
+            query = query.where(m.c.id > since_message_id, m.c.conversation_id.in_(changed))
+        if conversation_ids is not None:
+            query = query.where(m.c.conversation_id.in_(list(conversation_ids)))
+        if updated_since is not None:
+            query = query.where(c.c.updated_at >= _naive_utc(updated_since))
+
+        with self.engine.connect() as conn:
+            result = conn.execution_options(stream_results=True, yield_per=self.batch_size).execute(query)
+            group: List[Any] = []
+            for rows in result.partitions():
+                for row in rows:
+                    scan["messages"] += 1
+                    scan["last_message_id"] = max(scan["last_message_id"], row.id)
+                    if group and row.conversation_id != group[0].conversation_id:
+                        record = self._record(group, format, include_cancelled)
+                        if record is not None:
+                            yield record
+                        group = []
+                    group.append(row)
+            if group:
+                record = self._record(group, format, include_cancelled)
+                if record is not None:
+                    yield record
+
+    @staticmethod
+    def _record(rows: List[Any], format: str, include_cancelled: bool) -> Optional[Dict[str, Any]]:
+        """Training record of one conversation's rows, None if it has no reply"""
+        messages = []
+        for row in rows:
+            if not include_cancelled and row.role == "assistant" and row.message_metadata:
+                try:
+                    if json.loads(row.message_metadata).get("status") == "cancelled":
+                        continue
+                except (ValueError, AttributeError):
+                    pass
+            messages.append({"role": row.role, "content": row.content})
+        if not any(msg["role"] == "assistant" for msg in messages):
+            return None
+
+        record = {
+            "conversation_id": rows[0].conversation_id,
+            "title": rows[0].title,
+            "first_message_id": min(row.id for row in rows),
+            "last_message_id": max(row.id for row in rows),
+        }
+        if format == "chatml":
+            record["text"] = "\n".join(format_chat_message(msg["role"], msg["content"]) for msg in messages)
+        else:
+            record["messages"] = messages
+        return record
+
+    def stream(
+        self,
+        name: Optional[str] = None,
+        incremental: bool = False,
+        format: str = "messages",
+        compression: Optional[str] = None,
+        **filters,
+    ) -> Iterator[bytes]:
+        """
+        Yield an export as one (compressed) JSONL byte stream
+
+        With a name and incremental, only messages after the name's
+        watermark are read, and the watermark is moved once the last byte
+        has been produced; a consumer that stops early leaves it unchanged.
+
+        Args:
+            name: Export name, required for incremental
+            incremental: Continue from the watermark of `name`
+            format: See records()
+            compression: "none", "gzip" or "zstd", default the exporter's
+            **filters: conversation_ids, updated_since, include_cancelled
+        """
+        compressor = create_compressor(compression or self.compression)
+        if incremental and not name:
+            raise ValueError("An incremental export needs a name")
+        with self._exclusive(name):
+            # Read under the lock, so a run of the same name that is just
+            # finishing cannot hand its messages to this one as well
+            since = self.watermark(name) if incremental else 0
+            scan: Dict[str, Any] = {}
+            written = 0
+            buffer: List[str] = []
+            for record in self.records(format, since_message_id=since, scan=scan, **filters):
+                buffer.append(json.dumps(record, ensure_ascii=False))
+                written += 1
+                if len(buffer) >= 100:
+                    yield compressor.compress(("\n".join(buffer) + "\n").encode("utf-8"))
+                    buffer = []
+            if buffer:
+                yield compressor.compress(("\n".join(buffer) + "\n").encode("utf-8"))
+            yield compressor.flush()
+
+            if incremental:
+                self.set_watermark(name, scan["last_message_id"], written)
+
+    def export(
+        self,
+        name: str = "default",
+        incremental: bool = True,
+        format: str = "messages",
+        compression: Optional[str] = None,
+        **filters,
+    ) -> Dict[str, Any]:
+        """
+        Write an export to files of at most chunk_records records each
+
+        Files go to <output_dir>/<name>/<time>/part-NNNNN<ext> with a
+        manifest.json. They are written to a temporary directory that is
+        renamed into place when complete, and only then is the watermark
+        moved, so an interrupted export is simply repeated next time.
+
+        Args:
+            name: Export name, also the watermark's name
+            incremental: Only export messages after the watermark
+            format: See records()
+            compression: "none", "gzip" or "zstd", default the exporter's
+            **filters: conversation_ids, updated_since, include_cancelled
+
+        Returns:
+            The manifest: counts, message id range, files and their sizes
+        """
+        compression = compression or self.compression
+        create_compressor(compression)  # Fail before reading anything
+        if format not in EXPORT_FORMATS:
+            raise ValueError(f"Unknown export format: {format}")
+        with self._exclusive(name):
+            since = self.watermark(name) if incremental else 0
+            started = time.perf_counter()
+            stamp = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S-%f")
+            target = self.output_dir / name / stamp
+            tmp = self.output_dir / name / f".{stamp}.tmp"
+            tmp.mkdir(parents=True, exist_ok=True)
+
+            scan: Dict[str, Any] = {}
+            files: List[Dict[str, Any]] = []
+            total = 0
+            f = None
+            compressor = None
+            try:
+                for record in self.records(format, since_message_id=since, scan=scan, **filters):
+                    if f is None:
+                        path = tmp / f"part-{len(files):05d}{FILE_EXTENSIONS[compression]}"
+                        f = open(path, "wb")
+                        compressor = create_compressor(compression)
+                        files.append({"file": path.name, "records": 0})
+                    f.write(compressor.compress((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")))
+                    files[-1]["records"] += 1
+                    total += 1
+                    if files[-1]["records"] >= self.chunk_records:
+                        f.write(compressor.flush())
+                        f.close()
+                        f = None
+                if f is not None:
+                    f.write(compressor.flush())
+                    f.close()
+                    f = None
+
+                manifest = {
+                    "name": name,
+                    "format": format,
+                    "compression": compression,
+                    "incremental": incremental,
+                    "since_message_id": since,
+                    "last_message_id": scan["last_message_id"],
+                    "messages_read": scan["messages"],
+                    "records": total,
+                    "files": [dict(entry, bytes=(tmp / entry["file"]).stat().st_size) for entry in files],
+                    "created_at": stamp,
+                    "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+                }
+                if files:
+                    (tmp / "manifest.json").write_text(json.dumps(manifest, indent=2))
+                    os.replace(tmp, target)
+                    manifest["path"] = str(target)
+                else:
+                    manifest["path"] = None
+            finally:
+                if f is not None:
+                    f.close()
+                if tmp.exists():
+                    shutil.rmtree(tmp, ignore_errors=True)
+
+            if incremental:
+                self.set_watermark(name, scan["last_message_id"], total)
+            logger.info(
+                f"Exported {total} conversation records ({scan['messages']} messages read) "
+                f"as {name} in {manifest['elapsed_ms']:.0f} ms"
+            )
+            return manifest
+
+    @contextmanager
+    def _exclusive(self, name: Optional[str]):
+        """
+        Refuse a second concurrent export with the same name
+
+        Unnamed exports share no watermark and are not limited.
+        """
+        if name is None:
+            yield
+            return
+        with self._lock:
+            if name in self._running:
+                raise ExportInProgressError(f"Export {name} is already running")
+            self._running.add(name)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._running.discard(name)
+
+    def watermark(self, name: str) -> int:
+        """Last message id exported under a name, 0 if never exported"""
+        w = self.watermarks
+        with self.engine.connect() as conn:
+            value = conn.execute(select(w.c.last_message_id).where(w.c.name == name)).scalar()
+        return value or 0
+
+    def set_watermark(self, name: str, last_message_id: int, records: int = 0):
+        """Move a name's watermark and add to its record count"""
+        w = self.watermarks
+        now = datetime.now(timezone.utc)
+        with self.engine.begin() as conn:
+            updated = conn.execute(
+                update(w)
+                .where(w.c.name == name)
+                .values(
+                    last_message_id=last_message_id,
+                    records=w.c.records + records,
+                    exported_at=now,
+                )
+            ).rowcount
+            if not updated:
+                conn.execute(
+                    insert(w).values(
+                        name=name,
+                        last_message_id=last_message_id,
+                        records=records,
+                        exported_at=now,
+                    )
+                )
+
+    def reset_watermark(self, name: str) -> bool:
+        """Forget a name's watermark, so its next export starts from the beginning"""
+        w = self.watermarks
+        with self.engine.begin() as conn:
+            return conn.execute(delete(w).where(w.c.name == name)).rowcount > 0
+
+    def list_watermarks(self) -> List[Dict[str, Any]]:
+        w = self.watermarks
+        with self.engine.connect() as conn:
+            rows = conn.execute(select(w).order_by(w.c.name)).all()
+        return [
+            {
+                "name": row.name,
+                "last_message_id": row.last_message_id,
+                "records": row.records,
+                "exported_at": row.exported_at.isoformat(),
+            }
+            for row in rows
+        ]
+
+
+def _naive_utc(value: datetime) -> datetime:
+    """Timestamps are stored as naive UTC"""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def read_export(path) -> Iterator[Dict[str, Any]]:
+    """
+    Yield the records of an export
+
+    Args:
+        path: Export directory with a manifest.json, or one JSONL file
+            (.jsonl, .jsonl.gz or .jsonl.zst)
+    """
+    path = Path(path)
+    if path.is_dir():
+        manifest = json.loads((path / "manifest.json").read_text())
+        files = [path / entry["file"] for entry in manifest["files"]]
+    else:
+        files = [path]
+    for file in files:
+        with _open_text(file) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _open_text(path: Path):
+    if path.name.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    if path.name.endswith(".zst"):
+        if zstandard is None:
+            raise ValueError("Reading zstd exports needs the zstandard package")
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+        return io.TextIOWrapper(reader, encoding="utf-8")
+    return open(path, encoding="utf-8")
+
+
+class ChatTokenizer:
+    """
+    Tokenizes conversations exactly as LLMService builds prompts
+
+    BOS, then every message as format_chat_message(...) + "\\n", each
+    tokenized on its own with special tokens parsed. Only the vocabulary
+    of the model is loaded.
+    """
+
+    def __init__(self, model_path):
+        from llama_cpp import Llama
+
+        self.llm = Llama(model_path=str(model_path), vocab_only=True, verbose=False)
+        self.bos = self.llm.tokenize(b"", add_bos=True, special=True)
+        self.header = self._tokenize(ASSISTANT_HEADER)
+        end = self._tokenize("<|im_end|>")
+        # Without a single end-of-turn token the separator is learned too
+        self.end = end[0] if len(end) == 1 else None
+
+    def _tokenize(self, text: str) -> List[int]:
+        return self.llm.tokenize(text.encode("utf-8"), add_bos=False, special=True)
+
+    def conversation(self, messages: List[dict]) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Token ids of a conversation and its loss mask
+
+        The mask is 1 on the tokens of assistant replies, from after the
+        "<|im_start|>assistant\\n" header through <|im_end|>: what the model
+        generates. System and user turns are context only.
+
+        Returns:
+            (int32 token ids, uint8 mask), None without any assistant tokens
+        """
+        tokens = list(self.bos)
+        mask = [0] * len(tokens)
+        for msg in messages:
+            role = msg.get("role", "user")
+            ids = self._tokenize(format_chat_message(role, msg.get("content", "")) + "\n")
+            targets = [0] * len(ids)
+            if role == "assistant":
+                start = 0
+                while start < min(len(ids), len(self.header)) and ids[start] == self.header[start]:
+                    start += 1
+                stop = len(ids)
+                if self.end is not None and self.end in ids:
+                    stop = len(ids) - ids[::-1].index(self.end)
+                targets[start:stop] = [1] * (stop - start)
+            tokens.extend(ids)
+            mask.extend(targets)
+        if not any(mask):
+            return None
+        return np.array(tokens, dtype=np.int32), np.array(mask, dtype=np.uint8)
+
+
+# Tokenizer of a packing worker process, set by _init_tokenizer
+_tokenizer: Optional[ChatTokenizer] = None
+
+
+def _init_tokenizer(model_path: str):
+    global _tokenizer
+    _tokenizer = ChatTokenizer(model_path)
+
+
+def _tokenize_batch(conversations: List[List[dict]]) -> list:
+    return [_tokenizer.conversation(messages) for messages in conversations]
+
+
+def _batches(records: Iterable[Dict[str, Any]], size: int) -> Iterator[List[List[dict]]]:
+    """Message lists of records, in lists of `size`"""
+    batch = []
+    for record in records:
+        if "messages" not in record:
+            raise ValueError("Datasets are built from exports in the messages format")
+        batch.append(record["messages"])
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class _ShardWriter:
+    """Writes packed sequences to memory-mapped .npy shards of fixed size"""
+
+    def __init__(self, directory: Path, n_ctx: int, shard_sequences: int):
+        self.directory = directory
+        self.n_ctx = n_ctx
+        self.shard_sequences = shard_sequences
+        self.shards: List[Dict[str, Any]] = []
+        self.sequences = 0
+        self._arrays: Optional[Dict[str, np.ndarray]] = None
+        self._rows = 0
+        self._tokens = 0
+        self._targets = 0
+
+    def write(self, documents: List[Tuple[np.ndarray, np.ndarray]]):
+        """Add one sequence, the documents back to back, then padding"""
+        if self._arrays is None:
+            self._arrays = {
+                kind: open_memmap(
+                    self.directory / self._file(len(self.shards), kind),
+                    mode="w+",
+                    dtype=dtype,
+                    shape=(self.shard_sequences, self.n_ctx),
+                )
+                for kind, dtype in SHARD_ARRAYS.items()
+            }
+        # New .npy files are zero-filled: padding is token 0, mask 0, segment 0
+        tokens, mask, segments = (self._arrays[kind][self._rows] for kind in SHARD_ARRAYS)
+        pos = 0
+        for segment, (ids, targets) in enumerate(documents, 1):
+            end = pos + len(ids)
+            tokens[pos:end] = ids
+            mask[pos:end] = targets
+            segments[pos:end] = segment
+            self._targets += int(targets.sum())
+            pos = end
+        self._tokens += pos
+        self._rows += 1
+        self.sequences += 1
+        if self._rows == self.shard_sequences:
+            self._finish_shard()
+
+    def close(self):
+        if self._arrays is not None:
+            self._finish_shard()
+
+    @staticmethod
+    def _file(index: int, kind: str) -> str:
+        return f"shard-{index:05d}.{kind}.npy"
+
+    def _finish_shard(self):
+        index = len(self.shards)
+        for kind, array in self._arrays.items():
+            array.flush()
+            if self._rows < self.shard_sequences:
+                # The last shard is copied to a file of its actual length
+                path = self.directory / self._file(index, kind)
+                tmp = path.with_suffix(".tmp")
+                final = open_memmap(tmp, mode="w+", dtype=array.dtype, shape=(self._rows, self.n_ctx))
+                final[:] = array[: self._rows]
+                final.flush()
+                del final
+                os.replace(tmp, path)
+        self.shards.append(
+            {
+                "sequences": self._rows,
+                "tokens": self._tokens,
+                "target_tokens": self._targets,
+                "files": {kind: self._file(index, kind) for kind in SHARD_ARRAYS},
+            }
+        )
+        self._arrays = None
+        self._rows = self._tokens = self._targets = 0
+
+
+class SequencePacker:
+    """
+    Builds packed token datasets for fine-tuning from exported conversations
+
+    Conversations are tokenized in a pool of processes with ChatTokenizer,
+    then packed into sequences of exactly n_ctx tokens: each conversation
+    goes into the fullest of OPEN_SEQUENCES partly filled sequences it fits
+    in, and when none has room the fullest is written out. Conversations
+    longer than n_ctx are cut into n_ctx pieces.
+
+    Each shard is three .npy files of shape (sequences, n_ctx) that
+    training jobs open with np.load(..., mmap_mode="r"):
+
+        tokens     int32 token ids, 0 in padding
+        loss_mask  uint8, 1 where the token is a training target
+        segments   int32, 1.. per conversation within the row, 0 in padding
+
+    Segments let a trainer keep attention within a conversation. index.json
+    lists the shards and the settings they were built with.
+    """
+
+    def __init__(self, output_dir, n_ctx: int = 8192, workers: int = 4, shard_sequences: int = 1024):
+        """
+        Args:
+            output_dir: Directory datasets are written to
+            n_ctx: Default sequence length
+            workers: Tokenizer processes, 0 or 1 tokenizes in this process
+            shard_sequences: Sequences per shard
+        """
+        self.output_dir = Path(output_dir)
+        self.n_ctx = n_ctx
+        self.workers = workers
+        self.shard_sequences = shard_sequences
+
+    def tokenize(self, records: Iterable[Dict[str, Any]], model_path) -> Iterator[Optional[tuple]]:
+        """
+        Yield ChatTokenizer.conversation() of each record, in order
+
+        At most two batches per worker are in flight, so records are read
+        only as fast as they are tokenized.
+        """
+        batches = _batches(records, TOKENIZE_BATCH)
+        if self.workers <= 1:
+            tokenizer = ChatTokenizer(model_path)
+            for batch in batches:
+                for messages in batch:
+                    yield tokenizer.conversation(messages)
+            return
+
+        # Spawn, like the inference workers, so no parent threads are inherited
+        with ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_tokenizer,
+            initargs=(str(model_path),),
+        ) as pool:
+            pending = deque()
+            for batch in batches:
+                pending.append(pool.submit(_tokenize_batch, batch))
+                if len(pending) >= self.workers * 2:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
+    def pack(
+        self,
+        records: Iterable[Dict[str, Any]],
+        model_path,
+        name: str = "default",
+        n_ctx: Optional[int] = None,
+        sources: Optional[List[str]] = None,
+        progress: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Tokenize and pack records into a dataset under <output_dir>/<name>/<time>
+
+        Args:
+            records: Records in the "messages" format, see TrainingExporter
+            model_path: GGUF file whose tokenizer is used
+            name: Dataset name
+            n_ctx: Sequence length, default the packer's
+            sources: Where the records came from, kept in the index
+            progress: Dict kept updated with the conversations, skipped,
+                split and sequences counts so far
+
+        Returns:
+            The dataset index, also written to index.json
+        """
+        n_ctx = n_ctx or self.n_ctx
+        if n_ctx < 2:
+            raise ValueError("n_ctx must be at least 2")
+        started = time.perf_counter()
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S-%f")
+        target = self.output_dir / name / stamp
+        tmp = self.output_dir / name / f".{stamp}.tmp"
+        tmp.mkdir(parents=True, exist_ok=True)
+
+        writer = _ShardWriter(tmp, n_ctx, self.shard_sequences)
+        # [tokens used, documents] of the sequences being filled
+        open_sequences: List[list] = []
+        stats = {"conversations": 0, "skipped": 0, "split": 0}
+
+        def place(document):
+            size = len(document[0])
+            best = None
+            for sequence in open_sequences:
+                if sequence[0] + size <= n_ctx and (best is None or sequence[0] > best[0]):
+                    best = sequence
+            if best is None:
+                if len(open_sequences) >= OPEN_SEQUENCES:
+                    fullest = max(open_sequences, key=lambda sequence: sequence[0])
+                    open_sequences.remove(fullest)
+                    writer.write(fullest[1])
+                best = [0, []]
+                open_sequences.append(best)
+            best[0] += size
+            best[1].append(document)
+
+        try:
+            for tokenized in self.tokenize(records, model_path):
+                if tokenized is None:
+                    stats["skipped"] += 1
+                else:
+                    stats["conversations"] += 1
+                    tokens, mask = tokenized
+                    if len(tokens) > n_ctx:
+                        stats["split"] += 1
+                    for start in range(0, len(tokens), n_ctx):
+                        piece = (tokens[start:start + n_ctx], mask[start:start + n_ctx])
+                        if piece[1].any():
+                            place(piece)
+                if progress is not None:
+                    progress.update(stats, sequences=writer.sequences)
+            for sequence in sorted(open_sequences, key=lambda sequence: -sequence[0]):
+                writer.write(sequence[1])
+            writer.close()
+            if progress is not None:
+                progress.update(stats, sequences=writer.sequences)
+
+            sequences = sum(shard["sequences"] for shard in writer.shards)
+            tokens = sum(shard["tokens"] for shard in writer.shards)
+            elapsed = time.perf_counter() - started
+            index = {
+                "name": name,
+                "model": Path(model_path).name,
+                "template": "chatml",
+                "n_ctx": n_ctx,
+                "pad_token_id": 0,
+                "dtypes": {kind: np.dtype(dtype).name for kind, dtype in SHARD_ARRAYS.items()},
+                "shards": writer.shards,
+                "sequences": sequences,
+                "tokens": tokens,
+                "target_tokens": sum(shard["target_tokens"] for shard in writer.shards),
+                "padding": round(1 - tokens / (sequences * n_ctx), 4) if sequences else 0.0,
+                **stats,
+                "sources": sources or [],
+                "created_at": stamp,
+                "elapsed_ms": round(elapsed * 1000, 1),
+                "tokens_per_second": round(tokens / elapsed) if elapsed > 0 else None,
+            }
+            if sequences:
+                (tmp / "index.json").write_text(json.dumps(index, indent=2))
+                os.replace(tmp, target)
+                index["path"] = str(target)
+            else:
+                index["path"] = None
+        finally:
+            if tmp.exists():
+                shutil.rmtree(tmp, ignore_errors=True)
+
+        logger.info(
+            f"Packed {stats['conversations']} conversations into {index['sequences']} sequences "
+            f"of {n_ctx} tokens ({index['padding']:.1%} padding) in {index['elapsed_ms']:.0f} ms"
+        )
+        return index
+
+
+class DatasetJobs:
+    """
+    Runs SequencePacker jobs on a background thread
+
+    Packing a large export takes minutes, longer than a request should
+    wait. submit() queues a job and returns it at once; jobs run one at a
+    time, since each already uses the packer's process pool. A job's
+    status goes queued, running, then done (with the dataset's index) or
+    failed (with the error), and its progress counts are updated as it
+    runs.
+    """
+
+    def __init__(self, packer: SequencePacker):
+        self.packer = packer
+        self._jobs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="dataset-builder", daemon=True)
+        self._thread.start()
+
+    def submit(
+        self,
+        records: Iterable[Dict[str, Any]],
+        model_path: str,
+        name: str = "default",
+        n_ctx: Optional[int] = None,
+        sources: Optional[List[str]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Queue a dataset build
+
+        Args:
+            records: Training records in "messages" format, read lazily by
+                the background thread
+            model_path: Path of the GGUF model whose tokenizer is used
+            name: Dataset name
+            n_ctx: Tokens per sequence (default: the packer's)
+            sources: Where the records come from, recorded in the index
+
+        Returns:
+            The job, with the id to query its status by
+        """
+        job = {
+            "id": uuid.uuid4().hex,
+            "name": name,
+            "status": "queued",
+            "model": os.path.basename(model_path),
+            "n_ctx": n_ctx or self.packer.n_ctx,
+            "sources": sources or [],
+            "progress": {},
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "started_at": None,
+            "finished_at": None,
+            "index": None,
+            "error": None,
+        }
+        with self._lock:
+            self._jobs[job["id"]] = job
+            self._prune()
+            snapshot = self._copy(job)
+        self._queue.put((job, records, model_path))
+        logger.info(f"Queued dataset job {job['id']} for {name}")
+        return snapshot
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """A job's current state, None if unknown"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return self._copy(job) if job is not None else None
+
+    def list(self) -> List[Dict[str, Any]]:
+        """All known jobs, newest first"""
+        with self._lock:
+            return [self._copy(job) for job in reversed(self._jobs.values())]
+
+    @staticmethod
+    def _copy(job: Dict[str, Any]) -> Dict[str, Any]:
+        return dict(job, progress=dict(job["progress"]))
+
+    def _prune(self):
+        """Forget the oldest finished jobs beyond MAX_FINISHED_JOBS"""
+        finished = [job_id for job_id, job in self._jobs.items() if job["status"] in ("done", "failed")]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+
+    def _run(self):
+        while True:
+            job, records, model_path = self._queue.get()
+            with self._lock:
+                job["status"] = "running"
+                job["started_at"] = datetime.now(timezone.utc).isoformat()
+            try:
+                index = self.packer.pack(
+                    records, model_path, name=job["name"], n_ctx=job["n_ctx"],
+                    sources=job["sources"], progress=job["progress"],
+                )
+                with self._lock:
+                    job.update(status="done", index=index, finished_at=datetime.now(timezone.utc).isoformat())
+            except Exception as e:
+                logger.error(f"Dataset job {job['id']} failed: {e}")
+                with self._lock:
+                    job.update(status="failed", error=str(e), finished_at=datetime.now(timezone.utc).isoformat())
+
+
+def iter_packed_shards(path) -> Iterator[Dict[str, np.ndarray]]:
+    """
+    Yield the arrays of each shard of a packed dataset, memory-mapped read-only
+
+    Args:
+        path: Dataset directory with an index.json
+    """
+    path = Path(path)
+    index = json.loads((path / "index.json").read_text())
+    for shard in index["shards"]:
+        yield {kind: np.load(path / shard["files"][kind], mmap_mode="r") for kind in SHARD_ARRAYS}
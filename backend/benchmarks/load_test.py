@@ -0,0 +1,464 @@
+"""
+Load test for the chat API
+
+Replays recorded multi-turn conversations against /api/chat (streaming and
+non-streaming) and /api/conversations from concurrent simulated users, and
+reports p50/p95/p99 latency, time to first token, throughput and database
+time. Results are saved as JSON so runs can be compared across commits.
+
+By default the app is started in-process with the fake LLM backend, so no
+model or GPU is needed:
+
+    cd backend
+    python -m benchmarks.load_test --users 8 --iterations 5
+
+Use --url to target a server that is already running instead (database time
+is only measured in-process), and --compare to print the change against an
+earlier result file.
+"""
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+import argparse
+import json
+import logging
+import math
+import random
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+BENCHMARK_DIR = Path(__file__).parent
+DEFAULT_CONVERSATIONS = BENCHMARK_DIR / "conversations.json"
+DEFAULT_RESULTS_DIR = BENCHMARK_DIR / "results"
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    """p50/p95/p99, mean and max of a list of values (nearest rank)"""
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "mean": None, "max": None}
+    ordered = sorted(values)
+
+    def rank(p):
+        return round(ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)], 2)
+
+    return {
+        "p50": rank(50),
+        "p95": rank(95),
+        "p99": rank(99),
+        "mean": round(sum(ordered) / len(ordered), 2),
+        "max": round(ordered[-1], 2),
+    }
+
+
+class Recorder:
+    """Thread-safe collection of per-request measurements"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.error_samples: List[str] = []
+        self.ttft: List[float] = []
+        self.completion_tokens = 0
+
+    def record(
+        self,
+        endpoint: str,
+        latency_ms: float,
+        error: Optional[str] = None,
+        ttft_ms: Optional[float] = None,
+        completion_tokens: int = 0,
+    ):
+        with self._lock:
+            self.latencies.setdefault(endpoint, []).append(latency_ms)
+            self.errors.setdefault(endpoint, 0)
+            if error is not None:
+                self.errors[endpoint] += 1
+                if len(self.error_samples) < 10:
+                    self.error_samples.append(f"{endpoint}: {error}")
+            if ttft_ms is not None:
+                self.ttft.append(ttft_ms)
+            self.completion_tokens += completion_tokens
+
+
+class DatabaseTimer:
+    """Times every SQL statement the in-process app runs"""
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+
+        self._lock = threading.Lock()
+        self.durations: List[float] = []
+        event.listen(engine, "before_cursor_execute", self._before)
+        event.listen(engine, "after_cursor_execute", self._after)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("benchmark_started", []).append(time.perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["benchmark_started"].pop()
+        with self._lock:
+            self.durations.append((time.perf_counter() - started) * 1000)
+
+
+def start_app(args):
+    """
+    Start the app with the fake LLM backend on a local port
+
+    Returns:
+        (base url, server, database timer)
+    """
+    from werkzeug.serving import make_server
+    from app import create_app
+    from app.config import Config
+    from app.database import db
+
+    database = Path(tempfile.mkdtemp(prefix="llm-bench-")) / "bench.db"
+
+    class BenchmarkConfig(Config):
+        DEBUG = False
+        SQLALCHEMY_DATABASE_URI = f"sqlite:///{database}"
+        LLM_BACKEND = "fake"
+        INFERENCE_WORKERS = args.workers
+        FAKE_PROMPT_MS_PER_TOKEN = args.prompt_ms_per_token
+        FAKE_TOKEN_MS = args.token_ms
+        MAX_QUEUE_DEPTH = args.max_queue_depth
+        COMPLETION_CACHE_ENABLED = False
+
+    app = create_app(BenchmarkConfig)
+    with app.app_context():
+        db_timer = DatabaseTimer(db.engine)
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", server, db_timer
+
+
+def _request(method: str, url: str, payload: Optional[dict] = None, timeout: float = 300):
+    data = json.dumps(payload).encode("utf-8") if payload is not None else None
+    req = urllib.request.Request(
+        url, data=data, method=method, headers={"Content-Type": "application/json"}
+    )
+    return urllib.request.urlopen(req, timeout=timeout)
+
+
+def _http_error(e: Exception) -> str:
+    if isinstance(e, urllib.error.HTTPError):
+        return f"HTTP {e.code}"
+    return type(e).__name__
+
+
+def call_json(recorder: Recorder, endpoint: str, method: str, url: str, payload: Optional[dict] = None):
+    """Make a JSON request and record its latency. Returns the decoded body or None."""
+    started = time.perf_counter()
+    try:
+        with _request(method, url, payload) as response:
+            body = json.loads(response.read() or b"null")
+    except Exception as e:
+        recorder.record(endpoint, (time.perf_counter() - started) * 1000, error=_http_error(e))
+        return None
+
+    latency_ms = (time.perf_counter() - started) * 1000
+    if endpoint == "chat" and isinstance(body, dict):
+        recorder.record(
+            endpoint,
+            latency_ms,
+            ttft_ms=(body.get("metrics") or {}).get("ttft_ms"),
+            completion_tokens=(body.get("metrics") or {}).get("completion_tokens", 0),
+        )
+    else:
+        recorder.record(endpoint, latency_ms)
+    return body
+
+
+def call_stream(recorder: Recorder, url: str, payload: dict) -> Optional[Dict[str, Any]]:
+    """
+    Make a streaming chat request, timing the first content event
+
+    Returns:
+        Dict with the reply text and conversation id, or None on error
+    """
+    started = time.perf_counter()
+    ttft_ms = None
+    parts = []
+    conversation_id = None
+    summary = {}
+    error = None
+    try:
+        with _request("POST", url, payload) as response:
+            for raw in response:
+                line = raw.decode("utf-8").rstrip("\n")
+                if not line.startswith("data: "):
+                    continue
+                event = json.loads(line[len("data: "):])
+                kind = event["type"]
+                if kind == "done":
+                    break
+                if kind == "token":
+                    if ttft_ms is None:
+                        ttft_ms = (time.perf_counter() - started) * 1000
+                    parts.append(event["text"])
+                elif kind == "conversation_id":
+                    conversation_id = event["conversation_id"]
+                elif kind == "metrics":
+                    summary = event["metrics"]
+                elif kind == "error":
+                    error = event["error"]
+    except Exception as e:
+        error = _http_error(e)
+
+    recorder.record(
+        "chat_stream",
+        (time.perf_counter() - started) * 1000,
+        error=error,
+        ttft_ms=ttft_ms,
+        completion_tokens=summary.get("completion_tokens", 0),
+    )
+    if error is not None:
+        return None
+    return {"text": "".join(parts), "conversation_id": conversation_id}
+
+
+def simulate_user(base_url: str, conversations: list, args, recorder: Recorder, seed: int):
+    """Replay randomly chosen conversations one turn at a time"""
+    rng = random.Random(seed)
+    for _ in range(args.iterations):
+        recorded = rng.choice(conversations)["messages"]
+        system = [m for m in recorded if m["role"] == "system"]
+        history = list(system)
+        conversation_id = None
+
+        for turn in (m for m in recorded if m["role"] == "user"):
+            payload = {"max_tokens": args.max_tokens, "temperature": 0.7}
+            if args.history == "server" and conversation_id is not None:
+                payload["conversation_id"] = conversation_id
+                payload["message"] = turn
+                if system:
+                    payload["system"] = system[0]["content"]
+            else:
+                payload["messages"] = history + [turn]
+                payload["save_conversation"] = True
+                if conversation_id is not None:
+                    payload["conversation_id"] = conversation_id
+
+            if rng.random() < args.stream_ratio:
+                payload["stream"] = True
+                result = call_stream(recorder, f"{base_url}/api/chat", payload)
+                if result is None:
+                    break
+                reply = result["text"]
+                conversation_id = result["conversation_id"] or conversation_id
+            else:
+                body = call_json(recorder, "chat", "POST", f"{base_url}/api/chat", payload)
+                if body is None:
+                    break
+                reply = body["message"]["content"]
+                conversation_id = body.get("conversation_id", conversation_id)
+
+            history += [turn, {"role": "assistant", "content": reply}]
+
+        # What the UI does after a chat: reload the conversation and the sidebar
+        if conversation_id is not None:
+            call_json(recorder, "conversation_get", "GET", f"{base_url}/api/conversations/{conversation_id}")
+        call_json(recorder, "conversation_list", "GET", f"{base_url}/api/conversations")
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=BENCHMARK_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def build_report(args, recorder: Recorder, elapsed: float, db_timer: Optional[DatabaseTimer]) -> Dict[str, Any]:
+    """Summarise a run as a JSON-serialisable dict"""
+    endpoints = {}
+    for name, latencies in sorted(recorder.latencies.items()):
+        endpoints[name] = {
+            "requests": len(latencies),
+            "errors": recorder.errors.get(name, 0),
+            "latency_ms": percentiles(latencies),
+        }
+
+    chat_requests = sum(
+        endpoints[name]["requests"] for name in ("chat", "chat_stream") if name in endpoints
+    )
+    total_requests = sum(e["requests"] for e in endpoints.values())
+
+    report = {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "target": args.url or "in-process (fake backend)",
+            "settings": {
+                "users": args.users,
+                "iterations": args.iterations,
+                "stream_ratio": args.stream_ratio,
+                "history": args.history,
+                "max_tokens": args.max_tokens,
+                "workers": args.workers,
+                "prompt_ms_per_token": args.prompt_ms_per_token,
+                "token_ms": args.token_ms,
+            },
+        },
+        "duration_s": round(elapsed, 2),
+        "endpoints": endpoints,
+        "ttft_ms": percentiles(recorder.ttft),
+        "throughput": {
+            "requests_per_s": round(total_requests / elapsed, 2) if elapsed else None,
+            "chat_requests_per_s": round(chat_requests / elapsed, 2) if elapsed else None,
+            "completion_tokens_per_s": round(recorder.completion_tokens / elapsed, 2) if elapsed else None,
+        },
+        "database": None,
+        "error_samples": recorder.error_samples,
+    }
+    if db_timer is not None:
+        report["database"] = {
+            "queries": len(db_timer.durations),
+            "total_ms": round(sum(db_timer.durations), 2),
+            "query_ms": percentiles(db_timer.durations),
+        }
+    return report
+
+
+def print_report(report: Dict[str, Any]):
+    print(f"\nDuration: {report['duration_s']}s  (commit {report['meta']['commit']})")
+    print(f"{'endpoint':<20}{'requests':>9}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, stats in report["endpoints"].items():
+        latency = stats["latency_ms"]
+        print(
+            f"{name:<20}{stats['requests']:>9}{stats['errors']:>8}"
+            f"{latency['p50']:>10}{latency['p95']:>10}{latency['p99']:>10}"
+        )
+    ttft = report["ttft_ms"]
+    print(f"TTFT ms: p50 {ttft['p50']}  p95 {ttft['p95']}  p99 {ttft['p99']}")
+    throughput = report["throughput"]
+    print(
+        f"Throughput: {throughput['requests_per_s']} req/s, "
+        f"{throughput['chat_requests_per_s']} chat req/s, "
+        f"{throughput['completion_tokens_per_s']} tokens/s"
+    )
+    if report["database"]:
+        database = report["database"]
+        print(
+            f"Database: {database['queries']} queries, {database['total_ms']} ms total, "
+            f"p95 {database['query_ms']['p95']} ms per query"
+        )
+    for sample in report["error_samples"]:
+        print(f"  error: {sample}")
+
+
+def print_comparison(report: Dict[str, Any], baseline: Dict[str, Any]):
+    """Print p50/p95/p99 changes against an earlier run"""
+    print(f"\nCompared with {baseline['meta'].get('commit')} ({baseline['meta'].get('timestamp')}):")
+
+    def delta(new, old):
+        if new is None or old is None:
+            return "n/a"
+        if old == 0:
+            return f"{new}"
+        return f"{new} ({(new - old) / old * 100:+.1f}%)"
+
+    rows = [(name, stats["latency_ms"]) for name, stats in report["endpoints"].items()]
+    rows.append(("ttft", report["ttft_ms"]))
+    old_rows = {name: stats["latency_ms"] for name, stats in baseline["endpoints"].items()}
+    old_rows["ttft"] = baseline["ttft_ms"]
+    for name, latency in rows:
+        old = old_rows.get(name)
+        if old is None:
+            continue
+        print(
+            f"  {name:<18} p50 {delta(latency['p50'], old['p50'])}  "
+            f"p95 {delta(latency['p95'], old['p95'])}  p99 {delta(latency['p99'], old['p99'])}"
+        )
+    print(
+        "  tokens/s "
+        + delta(
+            report["throughput"]["completion_tokens_per_s"],
+            baseline["throughput"]["completion_tokens_per_s"],
+        )
+    )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the chat API")
+    parser.add_argument("--url", help="Base URL of a running server (default: start one in-process)")
+    parser.add_argument("--users", type=int, default=8, help="Concurrent simulated users")
+    parser.add_argument("--iterations", type=int, default=3, help="Conversations replayed per user")
+    parser.add_argument("--stream-ratio", type=float, default=0.5, help="Fraction of chat turns that stream")
+    parser.add_argument(
+        "--history",
+        choices=("client", "server"),
+        default="client",
+        help="Send the full history with every turn, or only the new turn",
+    )
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--conversations", type=Path, default=DEFAULT_CONVERSATIONS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=1, help="Inference workers (in-process only)")
+    parser.add_argument("--prompt-ms-per-token", type=float, default=0.2, help="Fake prompt eval latency")
+    parser.add_argument("--token-ms", type=float, default=5.0, help="Fake per-token latency")
+    parser.add_argument("--max-queue-depth", type=int, default=64, help="Scheduler queue depth (in-process only)")
+    parser.add_argument("--output", type=Path, help="Result file (default: benchmarks/results/<time>-<commit>.json)")
+    parser.add_argument("--compare", type=Path, help="Earlier result file to compare with")
+    parser.add_argument("--verbose", action="store_true", help="Keep the app's request logging")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    conversations = json.loads(args.conversations.read_text())
+
+    server = None
+    db_timer = None
+    base_url = args.url
+    if base_url is None:
+        base_url, server, db_timer = start_app(args)
+        if not args.verbose:
+            logging.getLogger().setLevel(logging.WARNING)
+            logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    base_url = base_url.rstrip("/")
+
+    recorder = Recorder()
+    users = [
+        threading.Thread(
+            target=simulate_user,
+            args=(base_url, conversations, args, recorder, args.seed + i),
+        )
+        for i in range(args.users)
+    ]
+    started = time.perf_counter()
+    for user in users:
+        user.start()
+    for user in users:
+        user.join()
+    elapsed = time.perf_counter() - started
+
+    if server is not None:
+        server.shutdown()
+
+    report = build_report(args, recorder, elapsed, db_timer)
+    print_report(report)
+
+    output = args.output
+    if output is None:
+        DEFAULT_RESULTS_DIR.mkdir(exist_ok=True)
+        output = DEFAULT_RESULTS_DIR / f"{time.strftime('%Y%m%d-%H%M%S')}-{report['meta']['commit'] or 'nogit'}.json"
+    output.write_text(json.dumps(report, indent=2))
+    print(f"\nSaved results to {output}")
+
+    if args.compare is not None:
+        print_comparison(report, json.loads(args.compare.read_text()))
+
+
+if __name__ == "__main__":
+    main()
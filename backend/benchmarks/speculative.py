@@ -0,0 +1,180 @@
+"""
+CPU benchmark of speculative decoding
+
+Runs code- and quote-heavy prompts, whose answers repeat much of the prompt,
+through LLMService on the CPU with speculative decoding off, with prompt
+lookup decoding and (with --draft-model) with a small draft model. Reports
+generation speed, the speed-up over no speculation and the draft acceptance
+rate per prompt category. Sampling is greedy, so every mode should produce
+the same text; answers that differ from the baseline are flagged.
+
+Needs a real GGUF model:
+
+    cd backend
+    python -m benchmarks.speculative --model models/model.gguf
+    python -m benchmarks.speculative --model models/model.gguf --draft-model models/draft.gguf
+"""
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+import argparse
+import json
+import logging
+import time
+
+from .load_test import DEFAULT_RESULTS_DIR, _git_commit, percentiles
+
+BENCHMARK_DIR = Path(__file__).parent
+DEFAULT_PROMPTS = BENCHMARK_DIR / "speculative_prompts.json"
+
+
+def run_mode(mode: str, prompts: List[dict], args) -> List[Dict[str, Any]]:
+    """Generate an answer to every prompt with one decoding mode"""
+    from app.services.llm_service import LLMService
+
+    service = LLMService(
+        model_path=str(args.model),
+        n_ctx=args.n_ctx,
+        n_gpu_layers=0,
+        n_threads=args.threads,
+        speculative="" if mode == "off" else mode,
+        draft_tokens=args.draft_tokens,
+        lookup_ngram_size=args.ngram,
+        draft_model_path=str(args.draft_model) if args.draft_model else None,
+    )
+    try:
+        # First evaluation builds the compute graphs; keep it out of the numbers
+        service.chat([{"role": "user", "content": "Hello"}], max_tokens=4, temperature=0.0)
+
+        results = []
+        for prompt in prompts:
+            for _ in range(args.repeat):
+                # Every run evaluates the whole prompt, as a new chat would
+                service.llm.reset()
+                perf = {}
+                started = time.perf_counter()
+                response = service.chat(
+                    prompt["messages"], max_tokens=args.max_tokens, temperature=0.0, perf=perf
+                )
+                elapsed = time.perf_counter() - started
+                results.append({
+                    "mode": mode,
+                    "category": prompt["category"],
+                    "name": prompt["name"],
+                    "text": response["text"],
+                    "completion_tokens": response["completion_tokens"],
+                    "elapsed_s": round(elapsed, 3),
+                    "eval_tokens_per_s": perf.get("eval_tokens_per_s"),
+                    "draft_tokens": perf.get("draft_tokens"),
+                    "draft_accepted_tokens": perf.get("draft_accepted_tokens"),
+                })
+        return results
+    finally:
+        service.unload_model()
+
+
+def summarize(results: List[Dict[str, Any]], baseline: Dict[str, str]) -> Dict[str, Any]:
+    """Aggregate one mode's results for one category"""
+    tokens = sum(r["completion_tokens"] for r in results)
+    elapsed = sum(r["elapsed_s"] for r in results)
+    proposed = sum(r["draft_tokens"] or 0 for r in results)
+    accepted = sum(r["draft_accepted_tokens"] or 0 for r in results)
+    return {
+        "runs": len(results),
+        "completion_tokens": tokens,
+        "tokens_per_s": round(tokens / elapsed, 2) if elapsed else None,
+        "eval_tokens_per_s": percentiles([r["eval_tokens_per_s"] for r in results if r["eval_tokens_per_s"]]),
+        "draft_tokens": proposed,
+        "draft_acceptance_rate": round(accepted / proposed, 3) if proposed else None,
+        # Greedy decoding: speculation must not change the answer
+        "differs_from_baseline": sorted({r["name"] for r in results if r["text"] != baseline.get(r["name"])}),
+    }
+
+
+def build_report(args, modes: List[str], results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    baseline = {r["name"]: r["text"] for r in results if r["mode"] == modes[0]}
+    categories = sorted({r["category"] for r in results})
+
+    summary: Dict[str, Dict[str, Any]] = {}
+    for mode in modes:
+        summary[mode] = {}
+        for category in categories + ["all"]:
+            selected = [r for r in results if r["mode"] == mode and category in ("all", r["category"])]
+            summary[mode][category] = summarize(selected, baseline)
+
+    for mode in modes:
+        for category, stats in summary[mode].items():
+            base = summary[modes[0]][category]["tokens_per_s"]
+            stats["speedup"] = round(stats["tokens_per_s"] / base, 2) if base and stats["tokens_per_s"] else None
+
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": _git_commit(),
+            "model": Path(args.model).name,
+            "draft_model": Path(args.draft_model).name if args.draft_model else None,
+            "threads": args.threads,
+            "max_tokens": args.max_tokens,
+            "draft_tokens": args.draft_tokens,
+            "ngram": args.ngram,
+            "repeat": args.repeat,
+        },
+        "summary": summary,
+        "runs": [{k: v for k, v in r.items() if k != "text"} for r in results],
+    }
+
+
+def print_report(report: Dict[str, Any]):
+    meta = report["meta"]
+    print(f"\nSpeculative decoding on CPU: {meta['model']}, {meta['threads']} threads, {meta['max_tokens']} max tokens")
+    print(f"{'mode':<15} {'category':<8} {'tok/s':>8} {'speedup':>8} {'accepted':>9}  differs")
+    for mode, categories in report["summary"].items():
+        for category, stats in categories.items():
+            rate = stats["draft_acceptance_rate"]
+            print(
+                f"{mode:<15} {category:<8} {stats['tokens_per_s'] or 0:>8.2f} "
+                f"{stats['speedup'] or 0:>7.2f}x {'-' if rate is None else f'{rate:.1%}':>9}  "
+                f"{', '.join(stats['differs_from_baseline']) or '-'}"
+            )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="CPU benchmark of speculative decoding")
+    parser.add_argument("--model", type=Path, required=True, help="Target .gguf model")
+    parser.add_argument("--draft-model", type=Path, help="Small .gguf model with the same vocabulary, adds the draft mode")
+    parser.add_argument("--prompts", type=Path, default=DEFAULT_PROMPTS)
+    parser.add_argument("--max-tokens", type=int, default=256)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--n-ctx", type=int, default=4096)
+    parser.add_argument("--draft-tokens", type=int, default=10, help="Tokens drafted per step")
+    parser.add_argument("--ngram", type=int, default=2, help="Longest n-gram prompt lookup matches")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per prompt and mode")
+    parser.add_argument("--output", type=Path, help="Result file (default: benchmarks/results/speculative-<time>-<commit>.json)")
+    parser.add_argument("--verbose", action="store_true", help="Keep llama.cpp and service logging")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not args.verbose:
+        logging.basicConfig(level=logging.WARNING)
+    prompts = json.loads(args.prompts.read_text())
+
+    modes = ["off", "prompt_lookup"] + (["draft"] if args.draft_model else [])
+    results = []
+    for mode in modes:
+        print(f"Running {mode}...")
+        results.extend(run_mode(mode, prompts, args))
+
+    report = build_report(args, modes, results)
+    print_report(report)
+
+    output: Optional[Path] = args.output
+    if output is None:
+        DEFAULT_RESULTS_DIR.mkdir(exist_ok=True)
+        output = DEFAULT_RESULTS_DIR / f"speculative-{time.strftime('%Y%m%d-%H%M%S')}-{report['meta']['commit'] or 'nogit'}.json"
+    output.write_text(json.dumps(report, indent=2))
+    print(f"\nSaved results to {output}")
+
+
+if __name__ == "__main__":
+    main()
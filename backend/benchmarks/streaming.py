@@ -0,0 +1,186 @@
+"""
+Benchmark of SSE framing for streamed chats
+
+Streams chat answers from the in-process app (fake LLM backend, so no model
+is needed) with different STREAM_FRAME_MS windows and reports, per
+streamed token, the frames sent, the write syscalls of the process and the
+CPU time of the process. A window of 0 sends one frame per token, as the
+stream did before tokens were coalesced.
+
+    cd backend
+    python -m benchmarks.streaming --windows 0 20 50 --token-ms 5
+
+Syscalls are read from /proc/self/io and are only reported on Linux;
+without them, frames per token is the count of socket writes by the
+server. Syscalls and CPU time cover the whole process, the client threads
+included; the client part is roughly constant per request.
+"""
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+import argparse
+import json
+import logging
+import threading
+import time
+
+from .load_test import DEFAULT_RESULTS_DIR, _git_commit, _request, start_app
+
+
+def _write_syscalls() -> Optional[int]:
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("syscw:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def stream_chat(url: str, payload: dict) -> Dict[str, Any]:
+    """Stream one answer and count its frames"""
+    parts = []
+    frames = 0
+    received = 0
+    tokens = 0
+    with _request("POST", url, payload) as response:
+        for raw in response:
+            received += len(raw)
+            if not raw.startswith(b"data: "):
+                continue
+            frames += 1
+            event = json.loads(raw[len(b"data: "):])
+            if event["type"] == "token":
+                parts.append(event["text"])
+            elif event["type"] == "metrics":
+                tokens = event["metrics"].get("completion_tokens", 0)
+            elif event["type"] == "error":
+                raise RuntimeError(event["error"])
+            elif event["type"] == "done":
+                break
+    return {"text": "".join(parts), "frames": frames, "bytes": received, "tokens": tokens}
+
+
+def run_window(app, base_url: str, window_ms: float, args) -> Dict[str, Any]:
+    """Stream args.requests answers from args.users clients with one frame window"""
+    app.config["STREAM_FRAME_MS"] = window_ms
+    results: List[Dict[str, Any]] = []
+    lock = threading.Lock()
+
+    def user(index):
+        for i in range(args.requests):
+            payload = {
+                "messages": [{"role": "user", "content": f"Tell me a story, part {index}-{i}"}],
+                "stream": True,
+                "max_tokens": args.max_tokens,
+            }
+            result = stream_chat(f"{base_url}/api/chat", payload)
+            with lock:
+                results.append(result)
+
+    users = [threading.Thread(target=user, args=(i,)) for i in range(args.users)]
+    syscalls = _write_syscalls()
+    cpu = time.process_time()
+    started = time.perf_counter()
+    for thread in users:
+        thread.start()
+    for thread in users:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu
+    if syscalls is not None:
+        # Some sandboxed kernels expose the file but never count
+        syscalls = (_write_syscalls() - syscalls) or None
+
+    tokens = sum(r["tokens"] for r in results)
+    frames = sum(r["frames"] for r in results)
+    return {
+        "window_ms": window_ms,
+        "requests": len(results),
+        "tokens": tokens,
+        "frames": frames,
+        "frames_per_token": round(frames / tokens, 3) if tokens else None,
+        "bytes_per_token": round(sum(r["bytes"] for r in results) / tokens, 1) if tokens else None,
+        "write_syscalls_per_token": round(syscalls / tokens, 3) if tokens and syscalls is not None else None,
+        "cpu_us_per_token": round(cpu / tokens * 1e6, 1) if tokens else None,
+        "elapsed_s": round(elapsed, 3),
+        "texts": sorted(r["text"] for r in results),
+    }
+
+
+def build_report(args, runs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    baseline = runs[0]["texts"]
+    for run in runs:
+        # Coalescing must not change what the client receives
+        run["same_text"] = run.pop("texts") == baseline
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": _git_commit(),
+            "users": args.users,
+            "requests": args.requests,
+            "max_tokens": args.max_tokens,
+            "token_ms": args.token_ms,
+        },
+        "runs": runs,
+    }
+
+
+def print_report(report: Dict[str, Any]):
+    meta = report["meta"]
+    print(f"\nSSE framing: {meta['users']} users x {meta['requests']} streams, {meta['max_tokens']} tokens at {meta['token_ms']} ms")
+    print(f"{'window':>8} {'frames/tok':>11} {'bytes/tok':>10} {'writes/tok':>11} {'cpu us/tok':>11}  same text")
+    for run in report["runs"]:
+        writes = run["write_syscalls_per_token"]
+        print(
+            f"{run['window_ms']:>6g}ms {run['frames_per_token']:>11.3f} {run['bytes_per_token']:>10.1f} "
+            f"{'-' if writes is None else f'{writes:.3f}':>11} {run['cpu_us_per_token']:>11.1f}  {run['same_text']}"
+        )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark SSE framing of streamed chats")
+    parser.add_argument("--windows", type=float, nargs="+", default=[0, 20, 50], help="STREAM_FRAME_MS values, the first is the baseline")
+    parser.add_argument("--users", type=int, default=4, help="Concurrent streaming clients")
+    parser.add_argument("--requests", type=int, default=5, help="Streams per client and window")
+    parser.add_argument("--max-tokens", type=int, default=256)
+    parser.add_argument("--token-ms", type=float, default=5.0, help="Fake per-token latency")
+    parser.add_argument("--output", type=Path, help="Result file (default: benchmarks/results/streaming-<time>-<commit>.json)")
+    parser.add_argument("--verbose", action="store_true", help="Keep the app's request logging")
+    args = parser.parse_args(argv)
+    # Settings start_app reads
+    args.workers = 1
+    args.prompt_ms_per_token = 0.0
+    args.max_queue_depth = args.users * 2
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    base_url, server, _ = start_app(args)
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    app = server.app
+
+    runs = []
+    try:
+        for window in args.windows:
+            print(f"Streaming with a {window:g} ms window...")
+            runs.append(run_window(app, base_url, window, args))
+    finally:
+        server.shutdown()
+
+    report = build_report(args, runs)
+    print_report(report)
+
+    output = args.output
+    if output is None:
+        DEFAULT_RESULTS_DIR.mkdir(exist_ok=True)
+        output = DEFAULT_RESULTS_DIR / f"streaming-{time.strftime('%Y%m%d-%H%M%S')}-{report['meta']['commit'] or 'nogit'}.json"
+    output.write_text(json.dumps(report, indent=2))
+    print(f"\nSaved results to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,12 +4,18 @@ import Sidebar from './Sidebar';
 import Message from './Messages';
 import './App.css';
 
+const API_URL = 'http://localhost:5000/api';
+const CHAT_MAX_TOKENS = 8192;
+// Pause in typing after which the server evaluates the chat so far
+const PREFILL_DEBOUNCE_MS = 600;
+
 function App() {
   const [sidebarState, setSidebarState] = useState('hidden');
   const [isExpanded, setIsExpanded] = useState(false);
 
   // Chat state
   const [messages, setMessages] = useState([]);
+  const [conversationId, setConversationId] = useState(null);
   const [input, setInput] = useState('');
   const [isLoading, setIsLoading] = useState(false);
   const [isScrolledUp, setIsScrolledUp] = useState(false);
@@ -21,6 +27,7 @@ function App() {
   const messagesEndRef = useRef(null);
   const inputRef = useRef(null);
   const measureCanvasRef = useRef(null);
+  const prefillAbortRef = useRef(null);
 
   const handleSidebarStateChange = (state) => setSidebarState(state);
 
@@ -56,6 +63,27 @@ function App() {
     }
   }, [input]);
 
+  // While the user types, let the server evaluate the history and the draft
+  // so the reply starts sooner. The server skips this when it is busy and
+  // drops it as soon as a real request arrives.
+  useEffect(() => {
+    if (isLoading || input.trim() === '') return undefined;
+    const timer = setTimeout(() => {
+      prefillAbortRef.current?.abort();
+      const controller = new AbortController();
+      prefillAbortRef.current = controller;
+      const draft = { role: 'user', content: input.trim() };
+      const payload = conversationId
+        ? { conversation_id: conversationId, message: draft }
+        : { messages: [draft] };
+      payload.max_tokens = CHAT_MAX_TOKENS;
+      axios
+        .post(`${API_URL}/chat/prefill`, payload, { signal: controller.signal })
+        .catch(() => {});
+    }, PREFILL_DEBOUNCE_MS);
+    return () => clearTimeout(timer);
+  }, [input, conversationId, isLoading]);
+
   const measureTextWidth = (text, element) => {
     if (!measureCanvasRef.current)
       measureCanvasRef.current = document.createElement('canvas');
@@ -103,14 +131,20 @@ function App() {
     }, 0);
     
     setIsLoading(true);
+    prefillAbortRef.current?.abort();
 
     try {
-      const payload = {
-        messages: [...messages, userMessage],
-        max_tokens: 8192,
-        temperature: 0.7,
-      };
-      const response = await axios.post('http://localhost:5000/api/chat', payload);
+      // Once the conversation is saved the server keeps its history,
+      // so only the new turn is sent
+      const payload = conversationId
+        ? { conversation_id: conversationId, message: userMessage }
+        : { messages: [userMessage], save_conversation: true };
+      payload.max_tokens = CHAT_MAX_TOKENS;
+      payload.temperature = 0.7;
+      const response = await axios.post(`${API_URL}/chat`, payload);
+      if (response?.data?.conversation_id) {
+        setConversationId(response.data.conversation_id);
+      }
       const assistantMessage = {
         role: 'assistant',
         content: response?.data?.message?.content ?? 'No response',